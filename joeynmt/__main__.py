@@ -3,13 +3,16 @@ import argparse
 from joeynmt.training import train
 from joeynmt.prediction import test
 from joeynmt.prediction import translate
+from joeynmt.data import preprocess
 
 
 def main():
     ap = argparse.ArgumentParser("Joey NMT")
 
-    ap.add_argument("mode", choices=["train", "test", "translate"],
-                    help="train a model or test or translate")
+    ap.add_argument("mode", choices=["train", "test", "translate",
+                                     "preprocess"],
+                    help="train a model or test or translate, or preprocess "
+                         "the training data")
 
     ap.add_argument("config_path", type=str,
                     help="path to YAML config file")
@@ -33,6 +36,8 @@ def main():
     elif args.mode == "translate":
         translate(cfg_file=args.config_path, ckpt=args.ckpt,
                   output_path=args.output_path)
+    elif args.mode == "preprocess":
+        preprocess(cfg_file=args.config_path)
     else:
         raise ValueError("Unknown mode")
 
@@ -0,0 +1,130 @@
+# coding: utf-8
+
+"""
+Adaptive softmax output layer
+"""
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from joeynmt.helpers import ConfigurationError
+
+
+class AdaptiveSoftmax(nn.AdaptiveLogSoftmaxWithLoss):
+    """
+    Adaptive softmax (Grave et al., 2017: Efficient softmax approximation for
+    GPUs) as output layer of a decoder: the most frequent tokens (the head)
+    and one token per cluster of less frequent tokens (the tails) are scored
+    by a small output layer, and the tokens of a cluster are only scored
+    where they are needed, with a projection of smaller size.
+
+    The clusters are ranges of vocabulary indices, which `build_vocab` sorts
+    by frequency (after the special tokens).
+    """
+
+    def __init__(self, input_size: int, vocab_size: int, cutoffs: List[int],
+                 div_value: float = 4.) -> None:
+        """
+        :param input_size: size of the decoder outputs (attentional vectors)
+        :param vocab_size: target vocabulary size
+        :param cutoffs: vocabulary indices where the head and the clusters
+            end (increasing, below `vocab_size`), e.g. [2000, 10000] for
+            a head of 2000 tokens, a cluster of 8000 and one of the rest
+        :param div_value: the projection of each cluster is this much smaller
+            than the one of the cluster before
+        """
+        if not cutoffs or sorted(set(cutoffs)) != list(cutoffs) \
+                or cutoffs[0] <= 0 or cutoffs[-1] >= vocab_size:
+            raise ConfigurationError(
+                "Adaptive softmax cutoffs must be increasing and between 0 "
+                "and the vocabulary size ({}), got {}.".format(vocab_size,
+                                                               cutoffs))
+        super(AdaptiveSoftmax, self).__init__(
+            in_features=input_size, n_classes=vocab_size,
+            cutoffs=list(cutoffs), div_value=div_value, head_bias=False)
+
+    @property
+    def out_features(self) -> int:
+        """
+        Size of the output: the vocabulary size
+
+        :return:
+        """
+        return self.n_classes
+
+    # pylint: disable=arguments-differ
+    def forward(self, att_vectors: Tensor) -> Tensor:
+        """
+        Log probabilities of all tokens (normalized, so that they can be used
+        like the logits of a linear output layer).
+
+        :param att_vectors: decoder outputs, shape (..., input_size)
+        :return: log probabilities, shape (..., vocab_size)
+        """
+        log_probs = self.log_prob(att_vectors.reshape(-1, self.in_features))
+        return log_probs.view(list(att_vectors.size())[:-1]
+                              + [self.n_classes])
+
+    def target_log_probs(self, att_vectors: Tensor, target: Tensor) \
+            -> Tensor:
+        """
+        Log probabilities of the target tokens only, computing each cluster
+        only for the targets in it (for training).
+
+        :param att_vectors: decoder outputs, shape (..., input_size)
+        :param target: target token indices, shape (...)
+        :return: log probabilities, same shape as `target`
+        """
+        output = super(AdaptiveSoftmax, self).forward(
+            att_vectors.reshape(-1, self.in_features),
+            target.reshape(-1)).output
+        return output.view_as(target)
+
+    # pylint: disable=too-many-locals
+    def topk(self, att_vectors: Tensor, k: int) -> (Tensor, Tensor):
+        """
+        The k most likely tokens and their log probabilities, exactly.
+        A cluster is only computed for the rows where its log probability is
+        above the k-th best log probability found so far, since the tokens
+        of a cluster cannot be more likely than the cluster.
+
+        :param att_vectors: decoder outputs, shape (..., input_size)
+        :param k: number of tokens (at most the vocabulary size)
+        :return:
+            - log probabilities, shape (..., k), best first,
+            - token indices, shape (..., k)
+        """
+        shape = list(att_vectors.size())[:-1]
+        att_vectors = att_vectors.reshape(-1, self.in_features)
+        num_rows = att_vectors.size(0)
+        k = min(k, self.n_classes)
+        head_log_probs = F.log_softmax(self.head(att_vectors), dim=1)
+        scores, ids = head_log_probs[:, :self.shortlist_size].topk(
+            min(k, self.shortlist_size), dim=1)
+
+        for i in range(self.n_clusters):
+            cluster_log_probs = head_log_probs[:, self.shortlist_size + i]
+            if scores.size(1) < k:
+                rows = torch.arange(num_rows, device=att_vectors.device)
+            else:
+                rows = (cluster_log_probs > scores[:, -1]).nonzero().view(-1)
+            if rows.numel() == 0:
+                continue
+            tail_log_probs = F.log_softmax(
+                self.tail[i](att_vectors.index_select(0, rows)), dim=1) \
+                + cluster_log_probs.index_select(0, rows).unsqueeze(1)
+            tail_scores, tail_ids = tail_log_probs.topk(
+                min(k, tail_log_probs.size(1)), dim=1)
+            cluster_scores = scores.new_full(
+                [num_rows, tail_scores.size(1)], float("-inf"))
+            cluster_scores[rows] = tail_scores
+            cluster_ids = ids.new_zeros([num_rows, tail_ids.size(1)])
+            cluster_ids[rows] = tail_ids + self.cutoffs[i]
+            # merge with the best tokens so far
+            scores, index = torch.cat([scores, cluster_scores], dim=1).topk(
+                min(k, scores.size(1) + cluster_scores.size(1)), dim=1)
+            ids = torch.cat([ids, cluster_ids], dim=1).gather(1, index)
+        return scores.view(shape + [k]), ids.view(shape + [k])
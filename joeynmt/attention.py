@@ -46,20 +46,28 @@ class BahdanauAttention(AttentionMechanism):
     #pylint: disable=arguments-differ
     def forward(self, query: Tensor = None,
                 mask: Tensor = None,
-                values: Tensor = None):
+                values: Tensor = None,
+                check_shapes: bool = True):
         """
         Bahdanau MLP attention forward pass.
 
+        There can be several queries per source sentence (e.g. the hypotheses
+        of a beam), in consecutive rows: the keys and values of a sentence
+        are then broadcast to all its queries instead of being copied.
+
         :param query: the item (decoder state) to compare with the keys/memory,
-            shape (batch_size, 1, decoder.hidden_size)
+            shape (batch_size * queries per sentence, 1, decoder.hidden_size)
         :param mask: mask out keys position (0 in invalid positions, 1 else),
             shape (batch_size, 1, src_length)
         :param values: values (encoder states),
             shape (batch_size, src_length, encoder.hidden_size)
+        :param check_shapes: check the shapes of the inputs
         :return: context vector of shape (batch_size, 1, value_size),
             attention probabilities of shape (batch_size, 1, src_length)
         """
-        self._check_input_shapes_forward(query=query, mask=mask, values=values)
+        if check_shapes:
+            self._check_input_shapes_forward(query=query, mask=mask,
+                                             values=values)
 
         assert mask is not None, "mask is required"
         assert self.proj_keys is not None,\
@@ -71,23 +79,28 @@ class BahdanauAttention(AttentionMechanism):
 
         # Calculate scores.
         # proj_keys: batch x src_len x hidden_size
-        # proj_query: batch x 1 x hidden_size
-        scores = self.energy_layer(torch.tanh(self.proj_query + self.proj_keys))
-        # scores: batch x src_len x 1
+        # proj_query: batch x queries x 1 x hidden_size
+        batch_size = values.size(0)
+        proj_query = self.proj_query.view(
+            batch_size, -1, 1, self.proj_query.size(2))
+        scores = self.energy_layer(
+            torch.tanh(proj_query + self.proj_keys.unsqueeze(1)))
+        # scores: batch x queries x src_len x 1
 
-        scores = scores.squeeze(2).unsqueeze(1)
-        # scores: batch x 1 x time
+        scores = scores.squeeze(3)
+        # scores: batch x queries x time
 
         # mask out invalid positions by filling the masked out parts with -inf
         scores = torch.where(mask, scores, scores.new_full([1], float('-inf')))
 
         # turn scores to probabilities
-        alphas = F.softmax(scores, dim=-1)  # batch x 1 x time
+        alphas = F.softmax(scores, dim=-1)  # batch x queries x time
 
         # the context vector is the weighted sum of the values
-        context = alphas @ values  # batch x 1 x value_size
+        context = alphas @ values  # batch x queries x value_size
 
-        return context, alphas
+        return context.view(query.size(0), 1, -1), \
+            alphas.view(query.size(0), 1, -1)
 
     def compute_proj_keys(self, keys: Tensor):
         """
@@ -120,7 +133,8 @@ class BahdanauAttention(AttentionMechanism):
         :param values:
         :return:
         """
-        assert query.shape[0] == values.shape[0] == mask.shape[0]
+        assert values.shape[0] == mask.shape[0]
+        assert query.shape[0] % values.shape[0] == 0
         assert query.shape[1] == 1 == mask.shape[1]
         assert query.shape[2] == self.query_layer.in_features
         assert values.shape[2] == self.key_layer.in_features
@@ -155,40 +169,50 @@ class LuongAttention(AttentionMechanism):
     # pylint: disable=arguments-differ
     def forward(self, query: torch.Tensor = None,
                 mask: torch.Tensor = None,
-                values: torch.Tensor = None):
+                values: torch.Tensor = None,
+                check_shapes: bool = True):
         """
         Luong (multiplicative / bilinear) attention forward pass.
         Computes context vectors and attention scores for a given query and
         all masked values and returns them.
 
+        There can be several queries per source sentence (e.g. the hypotheses
+        of a beam), in consecutive rows: the keys and values of a sentence
+        are then broadcast to all its queries instead of being copied.
+
         :param query: the item (decoder state) to compare with the keys/memory,
-            shape (batch_size, 1, decoder.hidden_size)
+            shape (batch_size * queries per sentence, 1, decoder.hidden_size)
         :param mask: mask out keys position (0 in invalid positions, 1 else),
             shape (batch_size, 1, src_length)
         :param values: values (encoder states),
             shape (batch_size, src_length, encoder.hidden_size)
+        :param check_shapes: check the shapes of the inputs
         :return: context vector of shape (batch_size, 1, value_size),
             attention probabilities of shape (batch_size, 1, src_length)
         """
-        self._check_input_shapes_forward(query=query, mask=mask, values=values)
+        if check_shapes:
+            self._check_input_shapes_forward(query=query, mask=mask,
+                                             values=values)
 
         assert self.proj_keys is not None,\
             "projection keys have to get pre-computed"
         assert mask is not None, "mask is required"
 
-        # scores: batch_size x 1 x src_length
-        scores = query @ self.proj_keys.transpose(1, 2)
+        # scores: batch_size x queries x src_length
+        scores = query.reshape(values.size(0), -1, query.size(2)) \
+            @ self.proj_keys.transpose(1, 2)
 
         # mask out invalid positions by filling the masked out parts with -inf
         scores = torch.where(mask, scores, scores.new_full([1], float('-inf')))
 
         # turn scores to probabilities
-        alphas = F.softmax(scores, dim=-1)  # batch x 1 x src_len
+        alphas = F.softmax(scores, dim=-1)  # batch x queries x src_len
 
         # the context vector is the weighted sum of the values
-        context = alphas @ values  # batch x 1 x values_size
+        context = alphas @ values  # batch x queries x values_size
 
-        return context, alphas
+        return context.view(query.size(0), 1, -1), \
+            alphas.view(query.size(0), 1, -1)
 
     def compute_proj_keys(self, keys: Tensor):
         """
@@ -213,7 +237,8 @@ class LuongAttention(AttentionMechanism):
         :param values:
         :return:
         """
-        assert query.shape[0] == values.shape[0] == mask.shape[0]
+        assert values.shape[0] == mask.shape[0]
+        assert query.shape[0] % values.shape[0] == 0
         assert query.shape[1] == 1 == mask.shape[1]
         assert query.shape[2] == self.key_layer.out_features
         assert values.shape[2] == self.key_layer.in_features
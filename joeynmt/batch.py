@@ -3,6 +3,9 @@
 """
 Implementation of a mini-batch.
 """
+import queue
+import threading
+
 import numpy as np
 import torch
 
@@ -12,7 +15,8 @@ class Batch:
     Input is a batch from a torch text iterator.
     """
 
-    def __init__(self, torch_batch, pad_index, use_cuda=False):
+    def __init__(self, torch_batch, pad_index, use_cuda=False,
+                 sentence_weights=False):
         """
         Create a new joey batch from a torch batch.
         This batch extends torch text's batch attributes with src and trg
@@ -22,6 +26,9 @@ class Batch:
         :param torch_batch:
         :param pad_index:
         :param use_cuda:
+        :param sentence_weights: the torch batch contains one weight per
+            sentence instead of one per token, it is broadcast to all target
+            tokens (incl. </s>) after moving the batch to the GPU
         """
         self.src, self.src_lengths = torch_batch.src
         self.src_mask = (self.src != pad_index).unsqueeze(-2)
@@ -31,6 +38,7 @@ class Batch:
         self.trg_mask = None
         self.trg_lengths = None
         self.ntokens = None
+        self.weights = None
         self.use_cuda = use_cuda
 
         if hasattr(torch_batch, "trg"):
@@ -45,39 +53,51 @@ class Batch:
             self.ntokens = (self.trg != pad_index).data.sum().item()
 
             if hasattr(torch_batch, "weights"):
-                # one weight per token given
-                # pad remaining areas with 0s
-                weights = np.zeros(shape=self.trg.size())
-                # iterate over batch
-                for i, weight_seq in enumerate(torch_batch.weights):
-                    # iterate over trg tokens
-                    for j, w in enumerate(weight_seq):
-                        weights[i, j] = w
+                all_weights = np.concatenate(
+                    [np.asarray(w, dtype=np.float32)
+                     for w in torch_batch.weights])
+                if sentence_weights:
+                    self.weights = torch.from_numpy(all_weights)
+                else:
+                    # one weight per token given
+                    # pad remaining areas with 0s
+                    weights = np.zeros(shape=self.trg.size(),
+                                       dtype=np.float32)
+                    lengths = np.array([len(w) for w in torch_batch.weights])
+                    # fill the non-padded positions row by row
+                    positions = np.arange(weights.shape[1])
+                    weights[positions[None, :] < lengths[:, None]] = \
+                        all_weights
                     # add one artificial weight for </s>
-                    weights[i, len(weight_seq)] = 1.0
-                self.weights = torch.from_numpy(weights).float().to(
-                    self.trg.device)
-            else:
-                self.weights = None
+                    weights[np.arange(len(lengths)), lengths] = 1.0
+                    self.weights = torch.from_numpy(weights)
 
         if use_cuda:
             self._make_cuda()
 
+        if sentence_weights and self.weights is not None:
+            self.weights = self.weights.unsqueeze(1) * \
+                self.trg_mask.type_as(self.weights)
+
     def _make_cuda(self):
         """
-        Move the batch to GPU
+        Move the batch to GPU.
+        Copies from page-locked memory, so that they don't block the host.
 
         :return:
         """
-        self.src = self.src.cuda()
-        self.src_mask = self.src_mask.cuda()
+        def to_cuda(tensor):
+            return tensor.pin_memory().cuda(non_blocking=True)
+
+        self.src = to_cuda(self.src)
+        self.src_mask = to_cuda(self.src_mask)
 
         if self.trg_input is not None:
-            self.trg_input = self.trg_input.cuda()
-            self.trg = self.trg.cuda()
-            self.trg_mask = self.trg_mask.cuda()
+            self.trg_input = to_cuda(self.trg_input)
+            self.trg = to_cuda(self.trg)
+            self.trg_mask = to_cuda(self.trg_mask)
         if self.weights is not None:
-            self.weights = self.weights.cuda()
+            self.weights = to_cuda(self.weights)
 
     def sort_by_src_lengths(self):
         """
@@ -86,18 +106,22 @@ class Batch:
         :return:
         """
         _, perm_index = self.src_lengths.sort(0, descending=True)
-        rev_index = [0]*perm_index.size(0)
-        for new_pos, old_pos in enumerate(perm_index.cpu().numpy()):
-            rev_index[old_pos] = new_pos
+        # inverse permutation
+        rev_index = np.empty(perm_index.size(0), dtype=np.int64)
+        rev_index[perm_index.cpu().numpy()] = np.arange(perm_index.size(0))
+        # select on the device of the batch
+        device_perm_index = perm_index.to(self.src.device)
 
         sorted_src_lengths = self.src_lengths[perm_index]
-        sorted_src = self.src[perm_index]
-        sorted_src_mask = self.src_mask[perm_index]
+        sorted_src = self.src[device_perm_index]
+        sorted_src_mask = self.src_mask[device_perm_index]
         if self.trg_input is not None:
-            sorted_trg_input = self.trg_input[perm_index]
+            sorted_trg_input = self.trg_input[device_perm_index]
             sorted_trg_lengths = self.trg_lengths[perm_index]
-            sorted_trg_mask = self.trg_mask[perm_index]
-            sorted_trg = self.trg[perm_index]
+            sorted_trg_mask = self.trg_mask[device_perm_index]
+            sorted_trg = self.trg[device_perm_index]
+            if self.weights is not None:
+                self.weights = self.weights[device_perm_index]
 
         self.src = sorted_src
         self.src_lengths = sorted_src_lengths
@@ -109,7 +133,120 @@ class Batch:
             self.trg_lengths = sorted_trg_lengths
             self.trg = sorted_trg
 
-        if self.use_cuda:
-            self._make_cuda()
-
         return rev_index
+
+
+class TokenAccumulator:
+    """
+    Decides after which batches of batch_type "token" the parameters are
+    updated, so that an update covers about `batch_multiplier * batch_size`
+    tokens.
+
+    Batches are measured like `TokenBatchSizeFn` measures them: padded
+    source with </s> plus padded target with <s> and </s>. The iterator
+    ends a batch before it exceeds `batch_size`, so batches mostly stay
+    below it. An update is therefore made as soon as more than
+    `(batch_multiplier - 1) * batch_size` tokens have been accumulated:
+    after every batch for `batch_multiplier` 1, and never for more than
+    `batch_multiplier * batch_size` tokens.
+    """
+
+    def __init__(self, batch_size: int, batch_multiplier: int = 1) -> None:
+        """
+        :param batch_size: size of the batches in tokens
+        :param batch_multiplier: number of batch sizes per update
+        """
+        self.threshold = (batch_multiplier - 1) * batch_size
+        self.tokens = 0
+
+    def add(self, batch: Batch) -> bool:
+        """
+        Count the tokens of a batch.
+
+        :param batch: batch with targets
+        :return: whether to update after this batch
+        """
+        # the target tensors lack one of <s> and </s>
+        self.tokens += batch.src.numel() + batch.trg.numel() + batch.nseqs
+        if self.tokens > self.threshold:
+            self.tokens = 0
+            return True
+        return False
+
+
+class BatchPrefetcher:
+    """
+    Creates joey batches from a torchtext iterator.
+
+    If `num_batches` > 0, the batches are created (i.e. numericalized,
+    padded and moved to the GPU) in a background thread while the model is
+    busy with earlier batches, and up to `num_batches` batches are kept
+    ready.
+    """
+
+    def __init__(self, data_iter, pad_index: int, use_cuda: bool = False,
+                 num_batches: int = 0, sentence_weights: bool = False) \
+            -> None:
+        """
+        :param data_iter: torchtext iterator
+        :param pad_index:
+        :param use_cuda:
+        :param num_batches: number of batches to prepare in advance,
+            0 creates the batches when they are needed
+        :param sentence_weights: weights are given per sentence,
+            see `Batch`
+        """
+        self.data_iter = data_iter
+        self.pad_index = pad_index
+        self.use_cuda = use_cuda
+        self.num_batches = num_batches
+        self.sentence_weights = sentence_weights
+
+    def _make_batch(self, torch_batch) -> Batch:
+        return Batch(torch_batch, self.pad_index, use_cuda=self.use_cuda,
+                     sentence_weights=self.sentence_weights)
+
+    def __iter__(self):
+        if self.num_batches <= 0:
+            for torch_batch in self.data_iter:
+                yield self._make_batch(torch_batch)
+            return
+
+        batches = queue.Queue(maxsize=self.num_batches)
+        stop = threading.Event()
+        end = object()
+
+        def put(item) -> bool:
+            # wait for space in the queue unless the consumer has stopped
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for torch_batch in self.data_iter:
+                    if not put(self._make_batch(torch_batch)):
+                        return
+                put(end)
+            except Exception as error:  # pylint: disable=broad-except
+                # raised again in the consuming thread
+                put(error)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # also stops the producer if iteration ends early
+            stop.set()
+            producer.join()
@@ -3,9 +3,21 @@
 Data module
 """
 import sys
+import io
 import os
 import os.path
-from typing import Optional
+import glob
+import random
+import itertools
+import functools
+import multiprocessing
+import shutil
+import hashlib
+import json
+from collections import Counter
+from typing import Optional, List, Tuple, Iterable
+
+import numpy as np
 
 from torchtext.datasets import TranslationDataset
 from torchtext import data
@@ -13,6 +25,7 @@ from torchtext.data import Dataset, Iterator, Field
 
 from joeynmt.constants import UNK_TOKEN, EOS_TOKEN, BOS_TOKEN, PAD_TOKEN
 from joeynmt.vocabulary import build_vocab, Vocabulary
+from joeynmt.helpers import ConfigurationError, load_config
 
 
 def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
@@ -26,6 +39,33 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
     The training data is filtered to include sentences up to `max_sent_length`
     on source and target side.
 
+    If `cache_dir` is specified, the numericalized training data and the
+    vocabularies are stored there (see `binarize_data`) and are memory-mapped
+    in later calls instead of being processed again.
+
+    With `num_workers` > 1, the training data files are split into ranges of
+    lines that are tokenized, filtered and counted by a pool of worker
+    processes (see `load_parallel`). This is experimental.
+
+    Feedback weights for the training targets are given per target token or,
+    with `feedback_level` "sentence", per target sentence. With
+    `keep_zero_feedback` < 1, only this fraction of the training examples
+    with all-zero feedback is kept (after building the vocabularies and
+    after caching, so that every call draws a new sample); the number of
+    dropped examples and tokens is stored in the `zero_feedback_dropped`
+    attribute of the training data.
+
+    If `streaming` is True, the training data is not loaded into memory but
+    read from its files whenever it is iterated over
+    (see `StreamingTranslationDataset`). In that case, `train` may contain
+    wildcards to select several shards, e.g. "data/train.*" for the files
+    "data/train.0.de", "data/train.1.de", ...
+
+    `train` may also be a list of corpora (see `get_train_corpora`). Their
+    vocabularies are built jointly, but they are kept as separate datasets
+    that are sampled from by weight and `temperature` during training
+    (see `MultiCorpusDataset`).
+
     :param data_cfg: configuration dictionary for data
         ("data" part of configuation file)
     :return:
@@ -38,17 +78,32 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
     # load data from files
     src_lang = data_cfg["src"]
     trg_lang = data_cfg["trg"]
-    train_path = data_cfg["train"]
 
     ## changed to allow no dev_path
     dev_path = data_cfg.get("dev", None)
-    feedback_suffix = data_cfg.get("feedback", None)
     test_path = data_cfg.get("test", None)
     level = data_cfg["level"]
     lowercase = data_cfg["lowercase"]
     max_sent_length = data_cfg["max_sent_length"]
+    streaming = data_cfg.get("streaming", False)
+    num_workers = data_cfg.get("num_workers", 1)
+    feedback_level = data_cfg.get("feedback_level", "token")
+    if feedback_level not in ["token", "sentence"]:
+        raise ConfigurationError("Invalid feedback level. "
+                                 "Valid options: 'token', 'sentence'.")
+    keep_zero_feedback = data_cfg.get("keep_zero_feedback", 1.0)
+    if keep_zero_feedback < 1.0 and streaming:
+        raise ConfigurationError("Examples with zero feedback can only be "
+                                 "dropped from data that is loaded into "
+                                 "memory, not from streamed data.")
 
-    tok_fun = lambda s: list(s) if level == "char" else s.split()
+    # module-level functions, so that the fields can be sent to workers
+    tok_fun = tokenize_chars if level == "char" else str.split
+
+    # preprocessed training data and vocabularies
+    cache_path = None
+    if data_cfg.get("cache_dir", None) is not None:
+        cache_path = get_cache_path(data_cfg)
 
     src_field = data.Field(init_token=None, eos_token=EOS_TOKEN,
                            pad_token=PAD_TOKEN, tokenize=tok_fun,
@@ -62,43 +117,105 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
                            batch_first=True, lower=lowercase,
                            include_lengths=True)
 
-    # use feedback information as well
-    if feedback_suffix is not None:
-        weight_field = data.RawField()
-        # token or sentence weights are given for training target
-        train_data = WeightedTranslationDataset(
-            level=level,
-            path=train_path,
-            exts=("." + src_lang, "." + trg_lang, "." + feedback_suffix),
-            fields=(src_field, trg_field, weight_field),
-            filter_pred=
-            lambda x: len(vars(x)['src']) <= max_sent_length and
-                      len(vars(x)['trg']) <= max_sent_length)
+    # one or more training corpora, each with its own feedback (if any)
+    corpora = get_train_corpora(data_cfg)
+    if len(corpora) > 1 and cache_path is not None:
+        corpus_cache_paths = [os.path.join(cache_path, str(i))
+                              for i in range(len(corpora))]
+    else:
+        corpus_cache_paths = [cache_path]
+
+    if cache_path is not None and os.path.isfile(
+            os.path.join(cache_path, "done")):
+        # reuse the preprocessed training data
+        train_datasets = [
+            BinarizedDataset(path=corpus_cache_path,
+                             weights=corpus["feedback"] is not None)
+            for corpus, corpus_cache_path in zip(corpora, corpus_cache_paths)]
+        src_vocab = train_datasets[0].src_vocab
+        trg_vocab = train_datasets[0].trg_vocab
+    else:
+        filter_pred = functools.partial(filter_by_length, max_sent_length)
+        train_datasets, src_counters, trg_counters = [], [], []
+        for corpus in corpora:
+            train_exts = ("." + src_lang, "." + trg_lang)
+            train_fields = [("src", src_field), ("trg", trg_field)]
+            # use feedback information as well:
+            # token or sentence weights are given for training target
+            if corpus["feedback"] is not None:
+                train_exts += ("." + corpus["feedback"],)
+                train_fields.append(("weights", data.RawField()))
+            corpus_data, src_counter, trg_counter = _load_train_corpus(
+                path=corpus["path"], exts=train_exts, fields=train_fields,
+                level=level, feedback_level=feedback_level,
+                filter_pred=filter_pred, streaming=streaming,
+                num_workers=num_workers)
+            train_datasets.append(corpus_data)
+            src_counters.append(src_counter)
+            trg_counters.append(trg_counter)
+
+        src_max_size = data_cfg.get("src_voc_limit", sys.maxsize)
+        src_min_freq = data_cfg.get("src_voc_min_freq", 1)
+        trg_max_size = data_cfg.get("trg_voc_limit", sys.maxsize)
+        trg_min_freq = data_cfg.get("trg_voc_min_freq", 1)
+
+        src_vocab_file = data_cfg.get("src_vocab", None)
+        trg_vocab_file = data_cfg.get("trg_vocab", None)
+
+        # token counts of all corpora together
+        src_counter, trg_counter = Counter(), Counter()
+        if src_vocab_file is None or trg_vocab_file is None:
+            for corpus_data, corpus_src_counter, corpus_trg_counter in zip(
+                    train_datasets, src_counters, trg_counters):
+                if corpus_src_counter is None and streaming:
+                    # count both sides in a single pass over the files
+                    corpus_src_counter, corpus_trg_counter = \
+                        corpus_data.count_tokens(num_workers=num_workers)
+                elif corpus_src_counter is None:
+                    corpus_src_counter, corpus_trg_counter = \
+                        count_tokens(corpus_data)
+                src_counter.update(corpus_src_counter)
+                trg_counter.update(corpus_trg_counter)
+
+        src_vocab = build_vocab(field="src", min_freq=src_min_freq,
+                                max_size=src_max_size,
+                                dataset=None, vocab_file=src_vocab_file,
+                                counter=src_counter)
+        trg_vocab = build_vocab(field="trg", min_freq=trg_min_freq,
+                                max_size=trg_max_size,
+                                dataset=None, vocab_file=trg_vocab_file,
+                                counter=trg_counter)
+
+        if cache_path is not None:
+            for i, (corpus, corpus_cache_path) in enumerate(
+                    zip(corpora, corpus_cache_paths)):
+                binarize_data(dataset=train_datasets[i], src_vocab=src_vocab,
+                              trg_vocab=trg_vocab, path=corpus_cache_path)
+                train_datasets[i] = BinarizedDataset(
+                    path=corpus_cache_path,
+                    weights=corpus["feedback"] is not None)
+            # complete only when all corpora are written
+            open(os.path.join(cache_path, "done"), "w").close()
 
+    # the cache keeps all examples, the sample is drawn for every run
+    zero_feedback_dropped = None
+    if keep_zero_feedback < 1.0:
+        zero_feedback_dropped = (0, 0, 0)
+        for corpus, corpus_data in zip(corpora, train_datasets):
+            if corpus["feedback"] is not None:
+                zero_feedback_dropped = tuple(
+                    total + dropped for total, dropped in zip(
+                        zero_feedback_dropped, sample_zero_feedback(
+                            corpus_data, keep_ratio=keep_zero_feedback)))
+
+    if len(train_datasets) > 1:
+        train_data = MultiCorpusDataset(
+            datasets=train_datasets, names=[c["path"] for c in corpora],
+            weights=[c["weight"] for c in corpora],
+            temperature=data_cfg.get("temperature", 1.0))
     else:
-        train_data = TranslationDataset(path=train_path,
-                                        exts=("." + src_lang, "." + trg_lang),
-                                        fields=(src_field, trg_field),
-                                        filter_pred=
-                                        lambda x: len(vars(x)['src'])
-                                        <= max_sent_length
-                                        and len(vars(x)['trg'])
-                                        <= max_sent_length)
-
-    src_max_size = data_cfg.get("src_voc_limit", sys.maxsize)
-    src_min_freq = data_cfg.get("src_voc_min_freq", 1)
-    trg_max_size = data_cfg.get("trg_voc_limit", sys.maxsize)
-    trg_min_freq = data_cfg.get("trg_voc_min_freq", 1)
-
-    src_vocab_file = data_cfg.get("src_vocab", None)
-    trg_vocab_file = data_cfg.get("trg_vocab", None)
-
-    src_vocab = build_vocab(field="src", min_freq=src_min_freq,
-                            max_size=src_max_size,
-                            dataset=train_data, vocab_file=src_vocab_file)
-    trg_vocab = build_vocab(field="trg", min_freq=trg_min_freq,
-                            max_size=trg_max_size,
-                            dataset=train_data, vocab_file=trg_vocab_file)
+        train_data = train_datasets[0]
+    train_data.zero_feedback_dropped = zero_feedback_dropped
 
     # modified for no dev set cases
     dev_data = None
@@ -127,30 +244,422 @@ def load_data(data_cfg: dict) -> (Dataset, Dataset, Optional[Dataset],
     return train_data, dev_data, test_data, src_vocab, trg_vocab
 
 
-def make_data_iter(dataset: Dataset, batch_size: int, train: bool = False,
-                   shuffle: bool = False) -> Iterator:
+def get_train_corpora(data_cfg: dict) -> List[dict]:
+    """
+    Read the training corpora from the data configuration.
+
+    `train` is either the path prefix of a single corpus or a list of
+    corpora, each given as path prefix or as dictionary with the keys
+    `path`, `weight` (default: 1.0) and `feedback` (feedback suffix,
+    default: the `feedback` of the data configuration).
+
+    :param data_cfg: configuration dictionary for data
+    :return: list of corpora with the keys `path`, `weight` and `feedback`
+    """
+    train = data_cfg["train"]
+    default_feedback = data_cfg.get("feedback", None)
+    if isinstance(train, str):
+        train = [train]
+    if not train:
+        raise ConfigurationError("No training data given.")
+
+    corpora = []
+    for corpus in train:
+        if isinstance(corpus, str):
+            corpus = {"path": corpus}
+        if "path" not in corpus:
+            raise ConfigurationError("Every training corpus needs a path.")
+        corpora.append({"path": corpus["path"],
+                        "weight": corpus.get("weight", 1.0),
+                        "feedback": corpus.get("feedback", default_feedback)})
+    return corpora
+
+
+def _load_train_corpus(path: str, exts: Tuple[str, ...], fields: list,
+                       level: str, feedback_level: str, filter_pred,
+                       streaming: bool, num_workers: int) \
+        -> Tuple[Dataset, Optional[Counter], Optional[Counter]]:
+    """
+    Load one training corpus.
+
+    :param path: path prefix of the data files
+    :param exts: extensions for source, target (and weights)
+    :param fields: list of (name, field) pairs
+    :param level: char or word or bpe
+    :param feedback_level: one weight per "token" or per "sentence"
+    :param filter_pred: examples for which it returns False are skipped
+    :param streaming: read the data lazily (`StreamingTranslationDataset`)
+    :param num_workers: number of processes to load the data with
+    :return: dataset, source and target token counts if they were counted
+        while loading (otherwise None)
+    """
+    src_counter, trg_counter = None, None
+    if streaming:
+        dataset = StreamingTranslationDataset(
+            path=path, exts=exts, fields=fields, level=level,
+            feedback_level=feedback_level, filter_pred=filter_pred)
+    elif num_workers > 1:
+        examples, src_counter, trg_counter, _ = load_parallel(
+            shards=[path], exts=exts, fields=fields, level=level,
+            feedback_level=feedback_level, filter_pred=filter_pred,
+            num_workers=num_workers)
+        dataset = Dataset(examples, fields)
+        if "weights" in dataset.fields:
+            dataset.weights_buffer, dataset.weights_offsets = \
+                pack_weights(dataset.examples)
+    elif len(exts) > 2:
+        dataset = WeightedTranslationDataset(
+            level=level, path=path, exts=exts, fields=fields,
+            feedback_level=feedback_level, filter_pred=filter_pred)
+    else:
+        dataset = TranslationDataset(path=path, exts=exts, fields=fields,
+                                     filter_pred=filter_pred)
+    return dataset, src_counter, trg_counter
+
+
+def count_tokens(dataset: Dataset) -> Tuple[Counter, Counter]:
+    """
+    Count source and target token frequencies of a dataset.
+
+    :param dataset: dataset with src and trg
+    :return: source counter, target counter
+    """
+    src_counter, trg_counter = Counter(), Counter()
+    for example in dataset.examples:
+        src_counter.update(example.src)
+        trg_counter.update(example.trg)
+    return src_counter, trg_counter
+
+
+def tokenize_chars(text: str) -> List[str]:
+    """
+    Split a string into characters (segmentation level "char").
+
+    :param text: string to split
+    :return: list of characters
+    """
+    return list(text)
+
+
+def filter_by_length(max_sent_length: int, example: data.Example) -> bool:
+    """
+    Check that source and target of an example are not too long.
+
+    :param max_sent_length: maximum number of tokens on either side
+    :param example: example to check
+    :return: True if the example should be kept
+    """
+    return len(vars(example)['src']) <= max_sent_length and \
+        len(vars(example)['trg']) <= max_sent_length
+
+
+def make_example(lines: Tuple[str, ...], fields: list, level: str,
+                 feedback_level: str = "token") -> Optional[data.Example]:
+    """
+    Create a training example from one line of source, target
+    (and weights) each.
+
+    :param lines: source and target (and weights) lines
+    :param fields: list of (name, field) pairs
+    :param level: char or word or bpe
+    :param feedback_level: one weight per "token" or per "sentence"
+    :return: example, None if source or target are empty
+    """
+    if len(lines) > 2:
+        return WeightedTranslationDataset.make_example(
+            *lines, fields=fields, level=level,
+            feedback_level=feedback_level)
+    src_line, trg_line = lines[0].strip(), lines[1].strip()
+    if src_line == '' or trg_line == '':
+        return None
+    return data.Example.fromlist([src_line, trg_line], fields)
+
+
+def _count_lines(path: str) -> int:
+    """
+    Count the newlines in a file without decoding it.
+
+    :param path: path to the file
+    :return: number of newlines
+    """
+    count = 0
+    with open(path, "rb") as open_file:
+        for block in iter(lambda: open_file.read(1 << 20), b""):
+            count += block.count(b"\n")
+    return count
+
+
+def _count_newlines(task: Tuple[str, int, int]) -> int:
+    """
+    Count the newlines in a byte range of a file.
+    Runs in a worker process of `load_parallel`.
+
+    :param task: path to the file, first byte and end of the range
+    :return: number of newlines
+    """
+    path, start, end = task
+    count = 0
+    with open(path, "rb") as open_file:
+        open_file.seek(start)
+        while start < end:
+            block = open_file.read(min(1 << 20, end - start))
+            if not block:
+                break
+            count += block.count(b"\n")
+            start += len(block)
+    return count
+
+
+def _line_position(path: str, sizes: List[int], counts: List[int],
+                   line_number: int) -> Tuple[int, int]:
+    """
+    Locate the start of a line from the newline counts of the byte ranges
+    of a file, without reading it.
+
+    :param path: path to the file (for the error message)
+    :param sizes: sizes of the consecutive byte ranges of the file
+    :param counts: number of newlines in every byte range
+    :param line_number: (0-based) line number
+    :return: first byte of the range in which the line starts and the
+        number of lines to skip from there
+    """
+    start, lines = 0, 0
+    for size, count in zip(sizes, counts):
+        # line `line_number` starts after newline number `line_number`
+        if lines + count >= line_number:
+            return start, line_number - lines
+        start += size
+        lines += count
+    raise ValueError("{} has less than {} lines".format(path, line_number))
+
+
+def _load_chunk(task: tuple) \
+        -> Tuple[Optional[List[tuple]], Counter, Counter, int]:
+    """
+    Tokenize, filter and count a range of lines of parallel files.
+    Runs in a worker process of `load_parallel`.
+
+    :param task: paths to the files, a byte offset and a number of lines
+        to skip from there for each file (see `_line_position`), number of
+        lines (None: until the end), fields, level, feedback level, filter
+        predicate and whether to return the examples
+    :return:
+        - examples as tuples of field values (None if they are not kept),
+          which are much faster to send back than `Example` objects
+        - source token counts
+        - target token counts
+        - number of examples
+    """
+    paths, offsets, num_lines, fields, level, feedback_level, filter_pred, \
+        keep_examples = task
+    examples = [] if keep_examples else None
+    src_counter, trg_counter = Counter(), Counter()
+    num_examples = 0
+    # equal tokens share one string, which is pickled only once
+    tokens = {}
+    files = []
+    try:
+        for path, (offset, skip) in zip(paths, offsets):
+            binary_file = open(path, "rb")
+            files.append(io.TextIOWrapper(binary_file))
+            binary_file.seek(offset)
+            for _ in range(skip):
+                binary_file.readline()
+        for lines in itertools.islice(zip(*files), num_lines):
+            example = make_example(lines, fields, level, feedback_level)
+            if example is None or (filter_pred is not None and
+                                   not filter_pred(example)):
+                continue
+            src_counter.update(example.src)
+            trg_counter.update(example.trg)
+            num_examples += 1
+            if keep_examples:
+                example.src = [tokens.setdefault(token, token)
+                               for token in example.src]
+                example.trg = [tokens.setdefault(token, token)
+                               for token in example.trg]
+                examples.append(tuple(getattr(example, name)
+                                      for name, _ in fields))
+    finally:
+        for open_file in files:
+            open_file.close()
+    return examples, src_counter, trg_counter, num_examples
+
+
+def load_parallel(shards: List[str], exts: Tuple[str, ...], fields: list,
+                  level: str, feedback_level: str = "token",
+                  filter_pred=None, num_workers: int = 1,
+                  keep_examples: bool = True) \
+        -> Tuple[Optional[List[data.Example]], Counter, Counter, int]:
+    """
+    Load parallel data with a pool of worker processes.
+
+    Every shard is split into `num_workers` ranges of lines, which are
+    tokenized, filtered and counted by the workers. The examples are
+    returned in the order of the files, the token counts are merged.
+    To find the ranges, the workers first count the newlines in equal byte
+    ranges of every file, so that no process reads a whole file first.
+    This is experimental: it only pays off with several CPU cores and
+    files that are expensive to tokenize.
+
+    :param shards: path prefixes of the data files
+    :param exts: extensions to the prefixes for source, target (and weights)
+    :param fields: list of (name, field) pairs, must be picklable
+    :param level: char or word or bpe
+    :param feedback_level: one weight per "token" or per "sentence"
+    :param filter_pred: examples for which it returns False are skipped,
+        must be picklable
+    :param num_workers: number of worker processes
+    :param keep_examples: if False, only count the examples and tokens
+    :return:
+        - examples (None if they are not kept)
+        - source token counts
+        - target token counts
+        - number of examples
+    """
+    paths = [[os.path.expanduser(shard + ext) for ext in exts]
+             for shard in shards]
+    ranges = {}
+    for path in itertools.chain(*paths):
+        file_size = os.path.getsize(path)
+        bounds = [i * file_size // num_workers
+                  for i in range(num_workers + 1)]
+        ranges[path] = list(zip(bounds[:-1], bounds[1:]))
+
+    with multiprocessing.Pool(num_workers) as pool:
+        count_tasks = [(path, start, end) for path, path_ranges
+                       in ranges.items() for start, end in path_ranges]
+        newline_counts = iter(pool.map(_count_newlines, count_tasks))
+        counts = {path: [next(newline_counts) for _ in path_ranges]
+                  for path, path_ranges in ranges.items()}
+
+        tasks = []
+        for shard_paths in paths:
+            num_lines = sum(counts[shard_paths[0]])
+            starts = sorted(set(i * num_lines // num_workers
+                                for i in range(num_workers)))
+            for i, start in enumerate(starts):
+                # the last range also includes a final line without newline
+                length = starts[i+1] - start if i + 1 < len(starts) else None
+                offsets = [_line_position(
+                    path, [end - begin for begin, end in ranges[path]],
+                    counts[path], start) for path in shard_paths]
+                tasks.append((shard_paths, offsets, length, fields, level,
+                              feedback_level, filter_pred, keep_examples))
+        results = pool.map(_load_chunk, tasks)
+
+    examples = [] if keep_examples else None
+    src_counter, trg_counter = Counter(), Counter()
+    num_examples = 0
+    for chunk_examples, chunk_src_counter, chunk_trg_counter, chunk_size \
+            in results:
+        if keep_examples:
+            for values in chunk_examples:
+                example = data.Example()
+                for (name, _), value in zip(fields, values):
+                    setattr(example, name, value)
+                examples.append(example)
+        src_counter.update(chunk_src_counter)
+        trg_counter.update(chunk_trg_counter)
+        num_examples += chunk_size
+    return examples, src_counter, trg_counter, num_examples
+
+
+class TokenBatchSizeFn:
+    """
+    Batch size function for torchtext iterators that measures the size of a
+    batch in tokens instead of sentences.
+
+    The size of a batch is the number of source plus target tokens it will
+    have after padding, i.e. the number of examples times the length of
+    the longest source (plus </s>) plus the number of examples times the
+    length of the longest target (plus <s> and </s>).
+    Monolingual examples only count source tokens.
+
+    Keeps track of the longest sequences of the batch under construction,
+    so every iterator needs its own instance.
+    """
+
+    def __init__(self) -> None:
+        self.max_src_in_batch = 0
+        self.max_trg_in_batch = 0
+
+    def __call__(self, new, count: int, sofar: int) -> int:
+        """
+        :param new: example that is added to the batch
+        :param count: number of examples in the batch including `new`
+        :param sofar: size of the batch before adding `new` (unused)
+        :return: number of padded tokens in the batch including `new`
+        """
+        # pylint: disable=unused-argument
+        if count == 1:
+            self.max_src_in_batch = 0
+            self.max_trg_in_batch = 0
+        self.max_src_in_batch = max(self.max_src_in_batch, len(new.src) + 1)
+        if hasattr(new, "trg"):  # no targets for monolingual data
+            self.max_trg_in_batch = max(self.max_trg_in_batch,
+                                        len(new.trg) + 2)
+        return count * (self.max_src_in_batch + self.max_trg_in_batch)
+
+
+def make_data_iter(dataset: Dataset, batch_size: int,
+                   batch_type: str = "sentence", train: bool = False,
+                   shuffle: bool = False, buffer_size: int = None) -> Iterator:
     """
     Returns a torchtext iterator for a torchtext dataset.
 
+    For training on several corpora, every batch is taken from one of them
+    (see `MultiCorpusIterator`).
+
+    If a `buffer_size` is given for training, the data is not bucketed and
+    shuffled as a whole, but only `buffer_size` examples at a time
+    (see `BufferedBucketIterator`), e.g. for streamed datasets.
+
     :param dataset: torchtext dataset containing src and optionally trg
     :param batch_size: size of the batches the iterator prepares
+    :param batch_type: measure batch size by sentence count ("sentence") or
+        by the number of padded source and target tokens ("token")
     :param train: whether it's training time, when turned off,
         bucketing, sorting within batches and shuffling is disabled
     :param shuffle: whether to shuffle the data before each epoch
         (no effect if set to True for testing)
+    :param buffer_size: number of training examples to hold in memory
     :return: torchtext iterator
     """
-    if train:
+    if batch_type == "tokens":  # accepted as alias
+        batch_type = "token"
+    if batch_type not in ["sentence", "token"]:
+        raise ConfigurationError("Invalid batch type. "
+                                 "Valid options: 'sentence', 'token'.")
+    batch_size_fn = TokenBatchSizeFn() if batch_type == "token" else None
+
+    if train and isinstance(dataset, MultiCorpusDataset):
+        # batches of the corpora are interleaved
+        data_iter = MultiCorpusIterator(
+            dataset=dataset,
+            iterators=[make_data_iter(corpus, batch_size=batch_size,
+                                      batch_type=batch_type, train=True,
+                                      shuffle=shuffle,
+                                      buffer_size=buffer_size)
+                       for corpus in dataset.datasets])
+    elif train and buffer_size is not None:
+        # bucket and shuffle inside a fixed-size buffer
+        data_iter = BufferedBucketIterator(
+            dataset=dataset, batch_size=batch_size, buffer_size=buffer_size,
+            batch_size_fn=batch_size_fn, sort_key=lambda x: len(x.src),
+            shuffle=shuffle)
+    elif train:
         # optionally shuffle and sort during training
         data_iter = data.BucketIterator(
             repeat=False, sort=False, dataset=dataset,
-            batch_size=batch_size, train=True, sort_within_batch=True,
+            batch_size=batch_size, batch_size_fn=batch_size_fn,
+            train=True, sort_within_batch=True,
             sort_key=lambda x: len(x.src), shuffle=shuffle)
     else:
         # don't sort/shuffle for validation/inference
         data_iter = data.Iterator(
             repeat=False, dataset=dataset, batch_size=batch_size,
-            train=False, sort=False)
+            batch_size_fn=batch_size_fn, train=False, sort=False)
 
     return data_iter
 
@@ -195,14 +704,19 @@ class MonoDataset(Dataset):
 class WeightedTranslationDataset(Dataset):
     """ Defines a parallel dataset with weights for the targets. """
 
-    def __init__(self, path, exts, fields, level, **kwargs):
+    def __init__(self, path, exts, fields, level, feedback_level="token",
+                 **kwargs):
         """Create a TranslationDataset given paths and fields.
 
+        The weights of all examples are stored in one float32 array
+        (`weights_buffer`), every example holds a view on its part of it.
+
         :param path: Prefix of path to the data file
         :param ext: Containing the extension to path for this language.
         :param field: Containing the fields that will be used for data.
         :param kwargs: Passed to the constructor of data.Dataset.
         :param level: char or word or bpe
+        :param feedback_level: one weight per "token" or per "sentence"
         """
 
         if not isinstance(fields[0], (tuple, list)):
@@ -217,26 +731,627 @@ class WeightedTranslationDataset(Dataset):
                 open(feedback_path) as feedback_file:
             for src_line, trg_line, weights_line in \
                     zip(src_file, trg_file, feedback_file):
-                src_line, trg_line = src_line.strip(), trg_line.strip()
-                weights = [float(weight) for weight in
-                           weights_line.strip().split(" ")]
-                if src_line != '' and trg_line != '':
-                    # there must be feedback for every token
-                    if level == "char":
-                        char_weights = []
-                        # distribute feedback from tokens over chars
-                        assert len(trg_line.split()) == len(weights)
-                        for trg_token, token_weight in zip(trg_line.split(),
-                                                           weights):
-                            # replicate weight for every char in trg token
-                            # and for following whitespace
-                            char_weights.extend(
-                                (len(trg_token)+1)*[token_weight])
-                        # remove last added weight for whitespace
-                        weights = char_weights[:-1]
-                    assert len(weights) == len(fields[1][1].tokenize(trg_line))
-                    examples.append(data.Example.fromlist(
-                        [src_line, trg_line, weights], fields))
+                example = self.make_example(src_line, trg_line, weights_line,
+                                            fields, level, feedback_level)
+                if example is not None:
+                    examples.append(example)
 
         super(WeightedTranslationDataset, self).__init__(examples,
                                                          fields, **kwargs)
+        self.weights_buffer, self.weights_offsets = pack_weights(
+            self.examples)
+
+    @staticmethod
+    def make_example(src_line: str, trg_line: str, weights_line: str,
+                     fields: list, level: str, feedback_level: str = "token") \
+            -> Optional[data.Example]:
+        """
+        Create an example from one line of each file.
+
+        :param src_line: source sentence
+        :param trg_line: target sentence
+        :param weights_line: one weight per target token (or one weight)
+        :param fields: list of (name, field) pairs for src, trg and weights
+        :param level: char or word or bpe
+        :param feedback_level: one weight per "token" or per "sentence"
+        :return: example with weights as float32 array,
+            None if source or target are empty
+        """
+        src_line, trg_line = src_line.strip(), trg_line.strip()
+        if src_line == '' or trg_line == '':
+            return None
+        weights = np.array(weights_line.split(), dtype=np.float32)
+        if feedback_level == "sentence":
+            assert len(weights) == 1
+        else:
+            # there must be feedback for every token
+            if level == "char":
+                # distribute feedback from tokens over chars:
+                # replicate weight for every char in trg token
+                # and for following whitespace
+                trg_tokens = trg_line.split()
+                assert len(trg_tokens) == len(weights)
+                weights = np.repeat(weights, [len(t) + 1 for t in trg_tokens])
+                # remove last added weight for whitespace
+                weights = weights[:-1]
+            assert len(weights) == len(fields[1][1].tokenize(trg_line))
+        example = data.Example.fromlist([src_line, trg_line], fields[:2])
+        example.weights = weights
+        return example
+
+
+def pack_weights(examples: List[data.Example]) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Copy the weights of all examples into one contiguous float32 array and
+    replace them by views on it.
+
+    :param examples: examples with weights
+    :return:
+        - array of all weights
+        - offsets of the weights of every example in it (plus the total)
+    """
+    offsets = np.zeros(len(examples) + 1, dtype=np.int64)
+    np.cumsum([len(ex.weights) for ex in examples], out=offsets[1:])
+    weights_buffer = np.empty(offsets[-1], dtype=np.float32)
+    for ex, start, end in zip(examples, offsets[:-1], offsets[1:]):
+        weights_buffer[start:end] = ex.weights
+        ex.weights = weights_buffer[start:end]
+    return weights_buffer, offsets
+
+
+def sample_zero_feedback(dataset: Dataset, keep_ratio: float) \
+        -> Tuple[int, int, int]:
+    """
+    Drop examples whose weights are all zero, except for a random fraction
+    `keep_ratio` of them. Their only contribution to the loss is through
+    the artificial weight of the </s> token (token-level feedback).
+    The weights of the remaining examples of an in-memory dataset are packed
+    again, a `BinarizedDataset` only hides the dropped examples.
+
+    :param dataset: in-memory or binarized dataset with weights
+    :param keep_ratio: probability to keep an example with zero feedback
+    :return: number of dropped examples, their source and target tokens
+        (incl. </s>, <s>)
+    """
+    kept = []
+    dropped_examples, dropped_src_tokens, dropped_trg_tokens = 0, 0, 0
+    for i, ex in enumerate(dataset.examples):
+        if ex.weights.any() or random.random() < keep_ratio:
+            kept.append(i)
+        else:
+            dropped_examples += 1
+            dropped_src_tokens += len(ex.src) + 1
+            dropped_trg_tokens += len(ex.trg) + 1
+    if isinstance(dataset, BinarizedDataset):
+        dataset.select(kept)
+    else:
+        dataset.examples = [dataset.examples[i] for i in kept]
+        dataset.weights_buffer, dataset.weights_offsets = \
+            pack_weights(dataset.examples)
+    return dropped_examples, dropped_src_tokens, dropped_trg_tokens
+
+
+def get_shards(path: str, ext: str) -> List[str]:
+    """
+    Find all data files matching a path prefix that may contain wildcards.
+
+    :param path: prefix of path to the data files, e.g. "data/train.*"
+    :param ext: extension of one of the languages, e.g. ".de"
+    :return: sorted path prefixes of all matching files
+    """
+    paths = sorted(glob.glob(os.path.expanduser(path) + ext))
+    if not paths:
+        raise FileNotFoundError("No data files found for {}".format(
+            path + ext))
+    return [shard[:-len(ext)] for shard in paths]
+
+
+class StreamingTranslationDataset(Dataset):
+    """
+    Parallel dataset (optionally with target weights) that is read from
+    one or more shards of files whenever it is iterated over,
+    instead of being held in memory.
+
+    It only supports sequential access, so it has to be batched with
+    `BufferedBucketIterator`. Its length is not known up front:
+    `num_examples` is only set once a pass over the data has counted them
+    (see `count_tokens`).
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, path: str, exts: Tuple[str, ...], fields: tuple,
+                 level: str, feedback_level: str = "token",
+                 filter_pred=None) -> None:
+        """
+        Create a streaming dataset given paths and fields.
+
+        :param path: Prefix of path to the data files, may contain wildcards
+            to select several shards (see `get_shards`)
+        :param exts: Extensions to path for source, target (and weights).
+        :param fields: Fields for source, target (and weights).
+        :param level: char or word or bpe
+        :param feedback_level: one weight per "token" or per "sentence"
+        :param filter_pred: Examples for which it returns False are skipped.
+        """
+        if not isinstance(fields[0], (tuple, list)):
+            fields = list(zip(["src", "trg", "weights"], fields))
+        self._field_list = fields
+        self.fields = dict(fields)
+        self.exts = exts
+        self.level = level
+        self.feedback_level = feedback_level
+        self.filter_pred = filter_pred
+        self.shards = get_shards(path, exts[0])
+        self.num_examples = None
+
+    @property
+    def examples(self) -> "StreamingTranslationDataset":
+        # examples are created while iterating
+        return self
+
+    def iter_examples(self, shuffle_shards: bool = False) \
+            -> Iterable[data.Example]:
+        """
+        Read the examples from all shards.
+
+        :param shuffle_shards: read the shards in random order
+        :return: generator of examples
+        """
+        shards = list(self.shards)
+        if shuffle_shards:
+            random.shuffle(shards)
+        for shard in shards:
+            files = [open(shard + ext) for ext in self.exts]
+            try:
+                for lines in zip(*files):
+                    example = make_example(lines, self._field_list,
+                                           self.level, self.feedback_level)
+                    if example is not None and (
+                            self.filter_pred is None or
+                            self.filter_pred(example)):
+                        yield example
+            finally:
+                for file in files:
+                    file.close()
+
+    def count_tokens(self, num_workers: int = 1) -> Tuple[Counter, Counter]:
+        """
+        Count source and target token frequencies in one pass over the data.
+
+        :param num_workers: number of worker processes (see `load_parallel`)
+        :return: source counter, target counter
+        """
+        if num_workers > 1:
+            _, src_counter, trg_counter, num_examples = load_parallel(
+                shards=self.shards, exts=self.exts, fields=self._field_list,
+                level=self.level, feedback_level=self.feedback_level,
+                filter_pred=self.filter_pred,
+                num_workers=num_workers, keep_examples=False)
+        else:
+            src_counter, trg_counter = Counter(), Counter()
+            num_examples = 0
+            for example in self:
+                src_counter.update(example.src)
+                trg_counter.update(example.trg)
+                num_examples += 1
+        self.num_examples = num_examples
+        return src_counter, trg_counter
+
+    def __iter__(self) -> Iterable[data.Example]:
+        return self.iter_examples()
+
+    def __len__(self) -> int:
+        # counting would need a pass over all files
+        raise TypeError("The length of streamed data is not known, "
+                        "see `num_examples`.")
+
+
+class BufferedBucketIterator:
+    """
+    Training iterator that only holds a fixed number of examples in memory.
+
+    Examples are read in chunks of `buffer_size`. Each chunk is sorted by
+    length and split into batches, which are yielded in random order
+    (if `shuffle`). For streamed datasets, the shards are read in random
+    order as well.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: int, buffer_size: int,
+                 batch_size_fn=None, sort_key=None,
+                 shuffle: bool = False) -> None:
+        """
+        :param dataset: dataset to iterate over
+        :param batch_size: size of the batches
+        :param buffer_size: number of examples to bucket at once
+        :param batch_size_fn: function to compute the size of a batch,
+            see torchtext iterators
+        :param sort_key: key to bucket and sort examples by
+        :param shuffle: whether to shuffle the data
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.batch_size_fn = batch_size_fn
+        self.sort_key = sort_key
+        self.shuffle = shuffle
+
+    def __iter__(self) -> Iterable[data.Batch]:
+        if isinstance(self.dataset, StreamingTranslationDataset):
+            examples = self.dataset.iter_examples(shuffle_shards=self.shuffle)
+        else:
+            examples = iter(self.dataset)
+        buffer = []
+        for example in examples:
+            buffer.append(example)
+            if len(buffer) == self.buffer_size:
+                yield from self._make_batches(buffer)
+                buffer = []
+        if buffer:
+            yield from self._make_batches(buffer)
+
+    def _make_batches(self, buffer: List[data.Example]) \
+            -> Iterable[data.Batch]:
+        if self.shuffle:
+            # random order among examples of the same length
+            random.shuffle(buffer)
+        buffer.sort(key=self.sort_key)
+        minibatches = list(data.batch(buffer, self.batch_size,
+                                      self.batch_size_fn))
+        if self.shuffle:
+            random.shuffle(minibatches)
+        for minibatch in minibatches:
+            # sort within batch for packing in the encoder
+            minibatch.sort(key=self.sort_key, reverse=True)
+            yield data.Batch(minibatch, self.dataset)
+
+
+class MultiCorpusDataset(Dataset):
+    """
+    Training data consisting of several corpora (datasets), which are
+    sampled from with fixed probabilities (see `MultiCorpusIterator`).
+
+    The probability of corpus i is proportional to (w_i * n_i)^(1/T) with
+    the weight w_i and size n_i of the corpus and the temperature T.
+    T = 1 samples the (weighted) corpora in proportion to their size,
+    larger temperatures move the distribution towards uniform.
+    The size of a streamed corpus is the number of examples counted while
+    building the vocabularies, or else the number of lines of its source
+    files (before filtering by length).
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, datasets: List[Dataset], names: List[str],
+                 weights: List[float], temperature: float = 1.0) -> None:
+        """
+        :param datasets: one dataset per corpus
+        :param names: names of the corpora, e.g. their paths
+        :param weights: sampling weight of each corpus
+        :param temperature: sampling temperature
+        """
+        if temperature <= 0:
+            raise ConfigurationError("The temperature must be positive.")
+        self.datasets = datasets
+        self.names = names
+        # corpora with and without weights may be mixed
+        self.fields = {}
+        for dataset in datasets:
+            self.fields.update(dataset.fields)
+        sizes = np.array([corpus_size(dataset) for dataset in datasets],
+                         dtype=np.float64)
+        # the sizes are fixed up front, so that the length of the data is
+        # known without reading streamed corpora
+        self.num_examples = int(sizes.sum())
+        scores = (np.array(weights, dtype=np.float64) * sizes) \
+            ** (1.0 / temperature)
+        if scores.sum() <= 0:
+            raise ConfigurationError("No training corpus can be sampled.")
+        self.probabilities = (scores / scores.sum()).tolist()
+
+    @property
+    def examples(self) -> "MultiCorpusDataset":
+        return self
+
+    def __iter__(self) -> Iterable[data.Example]:
+        return itertools.chain.from_iterable(self.datasets)
+
+    def __len__(self) -> int:
+        return self.num_examples
+
+
+def corpus_size(dataset: Dataset) -> int:
+    """
+    Number of examples of a training corpus, without a pass over streamed
+    data: if their examples were not counted, the lines of their source
+    files are counted instead (see `MultiCorpusDataset`).
+
+    :param dataset: in-memory, binarized or streamed dataset
+    :return: number of examples
+    """
+    if not isinstance(dataset, StreamingTranslationDataset):
+        return len(dataset)
+    if dataset.num_examples is not None:
+        return dataset.num_examples
+    return sum(_count_lines(shard + dataset.exts[0])
+               for shard in dataset.shards)
+
+
+class MultiCorpusIterator:
+    """
+    Training iterator that interleaves the batches of several corpora.
+
+    For every batch, a corpus is sampled according to the probabilities of
+    the `MultiCorpusDataset` and the next batch of its own iterator is
+    taken. An exhausted corpus iterator starts a new (reshuffled) pass over
+    its corpus. One epoch ends when as many examples as all corpora contain
+    together have been yielded.
+    """
+
+    def __init__(self, dataset: MultiCorpusDataset, iterators: list) -> None:
+        """
+        :param dataset: the corpora and their sampling probabilities
+        :param iterators: one training iterator per corpus
+        """
+        self.dataset = dataset
+        self.iterators = iterators
+        # ongoing passes over the corpora, continued in the next epoch
+        self._batches = [None] * len(iterators)
+
+    def _next_batch(self, i: int) -> data.Batch:
+        if self._batches[i] is not None:
+            batch = next(self._batches[i], None)
+            if batch is not None:
+                return batch
+        self._batches[i] = iter(self.iterators[i])
+        return next(self._batches[i])
+
+    def __iter__(self) -> Iterable[data.Batch]:
+        epoch_size = len(self.dataset)
+        corpus_ids = list(range(len(self.iterators)))
+        num_examples = 0
+        while num_examples < epoch_size:
+            i = random.choices(corpus_ids,
+                               weights=self.dataset.probabilities)[0]
+            batch = self._next_batch(i)
+            num_examples += batch.batch_size
+            yield batch
+
+
+# bump when the layout of the preprocessed data changes
+CACHE_VERSION = 2
+
+# data configuration entries that determine the preprocessed training data
+# (examples with zero feedback are sampled after loading the cache)
+CACHE_CONFIG_KEYS = ["src", "trg", "train", "feedback", "feedback_level",
+                     "level", "lowercase", "max_sent_length",
+                     "src_voc_limit", "src_voc_min_freq", "trg_voc_limit",
+                     "trg_voc_min_freq", "src_vocab", "trg_vocab"]
+
+
+def get_cache_path(data_cfg: dict) -> str:
+    """
+    Determine where the preprocessed training data for the given data
+    configuration is stored.
+
+    The directory name is a hash of all configuration entries that affect the
+    training data or the vocabularies and of the contents of the training
+    data (and vocabulary) files, so that the cache is not reused when any of
+    them changes. Several training corpora are stored in subdirectories,
+    their sampling weights are not part of the hash.
+
+    :param data_cfg: configuration dictionary for data
+    :return: path to the cache directory for this configuration
+    """
+    hasher = hashlib.sha1()
+    corpora = get_train_corpora(data_cfg)
+    relevant_cfg = {key: data_cfg.get(key, None) for key in CACHE_CONFIG_KEYS}
+    # the mix of the corpora can be changed without preprocessing again
+    relevant_cfg["train"] = [[corpus["path"], corpus["feedback"]]
+                             for corpus in corpora]
+    relevant_cfg["version"] = CACHE_VERSION
+    hasher.update(json.dumps(relevant_cfg, sort_keys=True).encode("utf-8"))
+
+    files = []
+    for corpus in corpora:
+        exts = [data_cfg["src"], data_cfg["trg"]]
+        if corpus["feedback"] is not None:
+            exts.append(corpus["feedback"])
+        files += [shard + "." + ext
+                  for shard in get_shards(corpus["path"],
+                                          "." + data_cfg["src"])
+                  for ext in exts]
+    files += [data_cfg[key] for key in ["src_vocab", "trg_vocab"]
+              if data_cfg.get(key, None) is not None]
+    for file in files:
+        with open(os.path.expanduser(file), "rb") as open_file:
+            for chunk in iter(lambda: open_file.read(1 << 20), b""):
+                hasher.update(chunk)
+
+    return os.path.join(data_cfg["cache_dir"], hasher.hexdigest())
+
+
+def _write_sequences(sequences, path: str, dtype: type) -> None:
+    """
+    Write sequences of numbers to one flat binary array `path.bin`
+    and their start offsets (plus the total length) to `path.idx`.
+
+    :param sequences: iterable of lists of numbers
+    :param path: path prefix of the files
+    :param dtype: numpy data type of the numbers
+    """
+    offsets = [0]
+    with open(path + ".bin", "wb") as bin_file:
+        for seq in sequences:
+            bin_file.write(np.asarray(seq, dtype=dtype).tobytes())
+            offsets.append(offsets[-1] + len(seq))
+    np.asarray(offsets, dtype=np.int64).tofile(path + ".idx")
+
+
+def binarize_data(dataset: Dataset, src_vocab: Vocabulary,
+                  trg_vocab: Vocabulary, path: str) -> None:
+    """
+    Store a (weighted) translation dataset in numericalized form.
+
+    Source and target token IDs are written as flat int32 arrays
+    (`src.bin`, `trg.bin`), weights as flat float32 array (`weights.bin`),
+    each with an int64 array of offsets (`*.idx`), so that the data can be
+    memory-mapped by `BinarizedDataset`. The vocabularies are stored
+    alongside.
+
+    :param dataset: dataset with tokenized src and trg (and weights)
+    :param src_vocab: source vocabulary
+    :param trg_vocab: target vocabulary
+    :param path: directory to write the data to
+    """
+    # write to temporary directory first, so that interrupted runs
+    # don't leave an incomplete cache behind
+    tmp_path = path + ".tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    _write_sequences(([src_vocab.stoi[t] for t in ex.src]
+                      for ex in dataset.examples),
+                     os.path.join(tmp_path, "src"), np.int32)
+    _write_sequences(([trg_vocab.stoi[t] for t in ex.trg]
+                      for ex in dataset.examples),
+                     os.path.join(tmp_path, "trg"), np.int32)
+    if "weights" in dataset.fields:
+        _write_sequences((ex.weights for ex in dataset.examples),
+                         os.path.join(tmp_path, "weights"), np.float32)
+    src_vocab.to_file(os.path.join(tmp_path, "src_vocab.txt"))
+    trg_vocab.to_file(os.path.join(tmp_path, "trg_vocab.txt"))
+    open(os.path.join(tmp_path, "done"), "w").close()
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class _MemoryMappedSequences:
+    """ Read-only view on sequences written by `_write_sequences`. """
+
+    def __init__(self, path: str, dtype: type, as_list: bool = True) -> None:
+        """
+        :param path: path prefix of the files
+        :param dtype: numpy data type of the numbers
+        :param as_list: return sequences as lists instead of array views
+        """
+        self.as_list = as_list
+        self.offsets = np.fromfile(path + ".idx", dtype=np.int64)
+        if self.offsets[-1] > 0:
+            self.values = np.memmap(path + ".bin", dtype=dtype, mode="r")
+        else:  # empty files can't be memory-mapped
+            self.values = np.zeros(0, dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> List:
+        sequence = self.values[self.offsets[i]:self.offsets[i+1]]
+        return sequence.tolist() if self.as_list else sequence
+
+
+class BinarizedDataset(Dataset):
+    """
+    Parallel dataset of token IDs (and optionally weights),
+    memory-mapped from files written by `binarize_data`.
+
+    Examples are only created when they are accessed, `src` and `trg`
+    contain token IDs instead of tokens. The fields map these IDs directly
+    to tensors, so no vocabulary lookup is needed when batching.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, path: str, weights: bool = False) -> None:
+        """
+        Load a binarized dataset.
+
+        :param path: directory the dataset was written to
+        :param weights: load the target weights as well
+        """
+        self.src_vocab = Vocabulary(file=os.path.join(path, "src_vocab.txt"))
+        self.trg_vocab = Vocabulary(file=os.path.join(path, "trg_vocab.txt"))
+        src_field = data.Field(use_vocab=False, init_token=None,
+                               eos_token=self.src_vocab.stoi[EOS_TOKEN],
+                               pad_token=self.src_vocab.stoi[PAD_TOKEN],
+                               batch_first=True, include_lengths=True)
+        trg_field = data.Field(use_vocab=False,
+                               init_token=self.trg_vocab.stoi[BOS_TOKEN],
+                               eos_token=self.trg_vocab.stoi[EOS_TOKEN],
+                               pad_token=self.trg_vocab.stoi[PAD_TOKEN],
+                               batch_first=True, include_lengths=True)
+        self.fields = {"src": src_field, "trg": trg_field}
+
+        self._sequences = {
+            "src": _MemoryMappedSequences(os.path.join(path, "src"),
+                                          np.int32),
+            "trg": _MemoryMappedSequences(os.path.join(path, "trg"),
+                                          np.int32)}
+        if weights:
+            self.fields["weights"] = data.RawField()
+            self._sequences["weights"] = _MemoryMappedSequences(
+                os.path.join(path, "weights"), np.float32, as_list=False)
+        # positions of the visible examples in the files, None for all
+        self._indices = None
+
+    @property
+    def examples(self) -> "BinarizedDataset":
+        # examples are created on access
+        return self
+
+    def select(self, indices: List[int]) -> None:
+        """
+        Only keep some of the examples.
+
+        :param indices: indices of the examples to keep
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        self._indices = indices if self._indices is None \
+            else self._indices[indices]
+
+    def __getitem__(self, i: int) -> data.Example:
+        if self._indices is not None:
+            i = self._indices[i]
+        example = data.Example()
+        for name, sequences in self._sequences.items():
+            setattr(example, name, sequences[i])
+        return example
+
+    def __len__(self) -> int:
+        if self._indices is not None:
+            return len(self._indices)
+        return len(self._sequences["src"])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def preprocess(cfg_file: str) -> None:
+    """
+    Preprocess the training data as specified in the configuration and store
+    it in the configured `cache_dir`, so that it is memory-mapped by
+    `load_data` instead of being loaded again for training and testing.
+
+    :param cfg_file: path to configuration yaml file
+    """
+    cfg = load_config(cfg_file)
+    data_cfg = cfg["data"]
+    if data_cfg.get("cache_dir", None) is None:
+        raise ConfigurationError("Specify a 'cache_dir' in the data "
+                                 "configuration to store preprocessed data.")
+
+    cache_path = get_cache_path(data_cfg)
+    if os.path.isfile(os.path.join(cache_path, "done")):
+        print("Preprocessed data is up to date: {}".format(cache_path))
+        return
+
+    train_data, _, _, src_vocab, trg_vocab = load_data(data_cfg)
+    # the examples with zero feedback are all cached
+    num_examples = len(train_data)
+    if train_data.zero_feedback_dropped is not None:
+        num_examples += train_data.zero_feedback_dropped[0]
+    print("Preprocessed {} training examples (vocabulary sizes: src {}, "
+          "trg {}) to: {}".format(num_examples, len(src_vocab),
+                                  len(trg_vocab), cache_path))
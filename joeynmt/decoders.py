@@ -3,14 +3,20 @@
 """
 Various decoders
 """
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from joeynmt.adaptive_softmax import AdaptiveSoftmax
 from joeynmt.attention import BahdanauAttention, LuongAttention
 from joeynmt.encoders import Encoder
-from joeynmt.helpers import freeze_params, ConfigurationError
+from joeynmt.helpers import freeze_params, pad_to_length, clones, \
+    subsequent_mask, ConfigurationError
+from joeynmt.sru import SRU
+from joeynmt.transformer_layers import PositionalEncoding, \
+    TransformerDecoderLayer
 
 
 # pylint: disable=abstract-method
@@ -28,6 +34,117 @@ class Decoder(nn.Module):
         return self._output_size
 
 
+class RecurrentDecoderState:
+    """
+    State of a recurrent decoder for decoding one step at a time: the
+    encoder states with their projections (keys) for the attention, the
+    source mask, the hidden state and the previous attention vector.
+    Rows can be selected or reordered, e.g. for beam search.
+
+    The encoder states, keys and source mask are stored once per source
+    sentence. There can be several hypotheses (rows of the hidden state and
+    attention vector) per sentence, in consecutive rows, e.g. the beam of
+    each sentence in beam search.
+    """
+
+    def __init__(self, hidden, prev_att_vector: Tensor,
+                 encoder_output: Tensor, src_mask: Tensor,
+                 proj_keys: Optional[Tensor]) -> None:
+        """
+        :param hidden: decoder hidden state,
+            shape (num_layers, hypotheses, hidden_size), a tuple for LSTMs
+        :param prev_att_vector: previous attention vector,
+            shape (hypotheses, 1, hidden_size)
+        :param encoder_output: encoder states,
+            shape (batch_size, src_length, encoder.output_size)
+        :param src_mask: source mask, shape (batch_size, 1, src_length)
+        :param proj_keys: projected encoder states (keys) for the attention,
+            shape (batch_size, src_length, hidden_size), None if the attention
+            does not pre-compute keys
+        """
+        self.hidden = hidden
+        self.prev_att_vector = prev_att_vector
+        self.encoder_output = encoder_output
+        self.src_mask = src_mask
+        self.proj_keys = proj_keys
+
+    def index_select(self, index: Tensor) -> "RecurrentDecoderState":
+        """
+        Select rows (batch entries) of a state with one hypothesis per
+        source sentence.
+
+        :param index: indices of the rows to keep, in the new order
+        :return: new state with len(index) rows
+        """
+        return self.select_hypotheses(index, sentence_index=index)
+
+    def select_hypotheses(self, index: Tensor,
+                          sentence_index: Optional[Tensor] = None) \
+            -> "RecurrentDecoderState":
+        """
+        Select hypotheses of the state, e.g. to reorder a beam.
+
+        :param index: indices of the hypotheses to keep, in the new order
+        :param sentence_index: indices of the source sentences to keep, in
+            the new order, None to keep the encoder states of all sentences
+            (they are not copied)
+        :return: new state with len(index) hypotheses
+        """
+        if isinstance(self.hidden, tuple):
+            # for LSTMs, states are tuples of tensors
+            hidden = tuple(h.index_select(1, index) for h in self.hidden)
+        else:
+            hidden = self.hidden.index_select(1, index)
+        encoder_output = self.encoder_output
+        src_mask = self.src_mask
+        proj_keys = self.proj_keys
+        if sentence_index is not None:
+            encoder_output = encoder_output.index_select(0, sentence_index)
+            src_mask = src_mask.index_select(0, sentence_index)
+            if proj_keys is not None:
+                proj_keys = proj_keys.index_select(0, sentence_index)
+        return RecurrentDecoderState(
+            hidden=hidden,
+            prev_att_vector=self.prev_att_vector.index_select(0, index),
+            encoder_output=encoder_output, src_mask=src_mask,
+            proj_keys=proj_keys)
+
+    def index_copy(self, index: Tensor,
+                   state: "RecurrentDecoderState") -> "RecurrentDecoderState":
+        """
+        Replace rows of the state with the rows of another state, e.g. to
+        start decoding new sentences in some rows. The encoder states of
+        both are padded to the same source length.
+
+        :param index: rows to replace
+        :param state: state with len(index) rows
+        :return: new state
+        """
+        src_length = max(self.src_mask.size(2), state.src_mask.size(2))
+
+        def copy(tensor, new_tensor, dim=0, pad_dim=None, value=0):
+            if pad_dim is not None:
+                tensor = pad_to_length(tensor, pad_dim, src_length, value)
+                new_tensor = pad_to_length(new_tensor, pad_dim, src_length,
+                                           value)
+            return tensor.index_copy(dim, index, new_tensor)
+
+        if isinstance(self.hidden, tuple):
+            hidden = tuple(copy(h, new_h, dim=1)
+                           for h, new_h in zip(self.hidden, state.hidden))
+        else:
+            hidden = copy(self.hidden, state.hidden, dim=1)
+        return RecurrentDecoderState(
+            hidden=hidden,
+            prev_att_vector=copy(self.prev_att_vector, state.prev_att_vector),
+            encoder_output=copy(self.encoder_output, state.encoder_output,
+                                pad_dim=1),
+            src_mask=copy(self.src_mask, state.src_mask, pad_dim=2,
+                          value=False),
+            proj_keys=copy(self.proj_keys, state.proj_keys, pad_dim=1)
+            if self.proj_keys is not None else None)
+
+
 # pylint: disable=arguments-differ,too-many-arguments
 # pylint: disable=too-many-instance-attributes, unused-argument
 class RecurrentDecoder(Decoder):
@@ -46,11 +163,14 @@ class RecurrentDecoder(Decoder):
                  init_hidden: str = "bridge",
                  input_feeding: bool = True,
                  freeze: bool = False,
+                 adaptive_softmax: Optional[dict] = None,
+                 skip_padding: bool = False,
                  **kwargs) -> None:
         """
         Create a recurrent decoder with attention.
 
-        :param rnn_type: rnn type, valid options: "lstm", "gru"
+        :param rnn_type: rnn type, valid options: "lstm", "gru", "sru"
+            (see `SRU`)
         :param emb_size: target embedding size
         :param hidden_size: size of the RNN
         :param encoder: encoder connected to this decoder
@@ -66,6 +186,11 @@ class RecurrentDecoder(Decoder):
             (only if they have the same size)
         :param input_feeding: Use Luong's input feeding.
         :param freeze: Freeze the parameters of the decoder during training.
+        :param adaptive_softmax: if given, use an adaptive softmax as output
+            layer, with the options of `AdaptiveSoftmax` (`cutoffs`,
+            `div_value`), so that the outputs are log probabilities
+        :param skip_padding: if the target lengths are given (in training),
+            only compute the decoder for the targets that have not ended
         :param kwargs:
         """
 
@@ -77,8 +202,10 @@ class RecurrentDecoder(Decoder):
         self.hidden_size = hidden_size
         self.emb_size = emb_size
 
-        rnn = nn.GRU if rnn_type == "gru" else nn.LSTM
+        rnn = nn.GRU if rnn_type == "gru" \
+            else SRU if rnn_type == "sru" else nn.LSTM
 
+        self.skip_padding = skip_padding
         self.input_feeding = input_feeding
         if self.input_feeding: # Luong-style
             # combine embedded prev word +attention vector before feeding to rnn
@@ -96,7 +223,12 @@ class RecurrentDecoder(Decoder):
         self.att_vector_layer = nn.Linear(
             hidden_size + encoder.output_size, hidden_size, bias=True)
 
-        self.output_layer = nn.Linear(hidden_size, vocab_size, bias=False)
+        if adaptive_softmax is not None:
+            self.output_layer = AdaptiveSoftmax(
+                input_size=hidden_size, vocab_size=vocab_size,
+                **adaptive_softmax)
+        else:
+            self.output_layer = nn.Linear(hidden_size, vocab_size, bias=False)
         self._output_size = vocab_size
 
         if attention == "bahdanau":
@@ -150,9 +282,10 @@ class RecurrentDecoder(Decoder):
         assert prev_att_vector.shape[1:] == torch.Size(
             [1, self.hidden_size])
         assert prev_att_vector.shape[0] == prev_embed.shape[0]
-        assert encoder_output.shape[0] == prev_embed.shape[0]
+        # several hypotheses per source sentence share its encoder states
+        assert prev_embed.shape[0] % encoder_output.shape[0] == 0
         assert len(encoder_output.shape) == 3
-        assert src_mask.shape[0] == prev_embed.shape[0]
+        assert src_mask.shape[0] == encoder_output.shape[0]
         assert src_mask.shape[1] == 1
         assert src_mask.shape[2] == encoder_output.shape[1]
         if isinstance(hidden, tuple):  # for lstm
@@ -202,7 +335,8 @@ class RecurrentDecoder(Decoder):
                       prev_att_vector: Tensor,  # context or att vector
                       encoder_output: Tensor,
                       src_mask: Tensor,
-                      hidden: Tensor) -> (Tensor, Tensor, Tensor):
+                      hidden: Tensor,
+                      check_shapes: bool = True) -> (Tensor, Tensor, Tensor):
         """
         Perform a single decoder step (1 token).
 
@@ -220,6 +354,7 @@ class RecurrentDecoder(Decoder):
             shape (batch_size, 1, src_length)
         :param hidden: previous hidden state,
             shape (num_layers, batch_size, hidden_size)
+        :param check_shapes: check the shapes of the inputs
         :return:
             - att_vector: new attention vector (batch_size, 1, hidden_size),
             - hidden: new hidden state with shape (batch_size, 1, hidden_size),
@@ -227,11 +362,11 @@ class RecurrentDecoder(Decoder):
         """
 
         # shape checks
-        self._check_shapes_input_forward_step(prev_embed=prev_embed,
-                                              prev_att_vector=prev_att_vector,
-                                              encoder_output=encoder_output,
-                                              src_mask=src_mask,
-                                              hidden=hidden)
+        if check_shapes:
+            self._check_shapes_input_forward_step(
+                prev_embed=prev_embed, prev_att_vector=prev_att_vector,
+                encoder_output=encoder_output, src_mask=src_mask,
+                hidden=hidden)
 
         if self.input_feeding:
             # concatenate the input with the previous attention vector
@@ -242,19 +377,16 @@ class RecurrentDecoder(Decoder):
         rnn_input = self.rnn_input_dropout(rnn_input)
 
         # rnn_input: batch x 1 x emb+2*enc_size
-        _, hidden = self.rnn(rnn_input, hidden)
-
-        # use new (top) decoder layer as attention query
-        if isinstance(hidden, tuple):
-            query = hidden[0][-1].unsqueeze(1)
-        else:
-            query = hidden[-1].unsqueeze(1)  # [#layers, B, D] -> [B, 1, D]
+        # use new (top) decoder layer output as attention query (the top
+        # layer of the hidden state for GRUs and LSTMs, not for SRUs)
+        query, hidden = self.rnn(rnn_input, hidden)  # [B, 1, D]
 
         # compute context vector using attention mechanism
         # only use last layer for attention mechanism
         # key projections are pre-computed
         context, att_probs = self.attention(
-            query=query, values=encoder_output, mask=src_mask)
+            query=query, values=encoder_output, mask=src_mask,
+            check_shapes=check_shapes)
 
         # return attention vector (Luong)
         # combine context with decoder hidden state before prediction
@@ -267,6 +399,61 @@ class RecurrentDecoder(Decoder):
         # output: batch x 1 x hidden_size
         return att_vector, hidden, att_probs
 
+    def _forward_sequence(self, trg_embed: Tensor, encoder_output: Tensor,
+                          src_mask: Tensor, hidden: Tensor,
+                          trg_lengths: Optional[Tensor] = None) \
+            -> (Tensor, Tensor, Tensor):
+        """
+        Perform all decoder steps at once, without input feeding: the RNN
+        runs over the whole target sequence in one call, and the attention
+        is computed for all its outputs (queries) together.
+        Same results as `self._forward_step` for each step.
+
+        :param trg_embed: embedded target inputs,
+            shape (batch_size, unrol_steps, embed_size)
+        :param encoder_output: encoder hidden states for attention context,
+            shape (batch_size, src_length, encoder.output_size)
+        :param src_mask: src mask, 1s for area before <eos>, 0s elsewhere
+            shape (batch_size, 1, src_length)
+        :param hidden: initial hidden state,
+            shape (num_layers, batch_size, hidden_size)
+        :param trg_lengths: if given, the RNN only runs over this many steps
+            of each target (packed), its outputs after them are zeros
+        :return:
+            - att_vectors: attention vectors
+                (batch_size, unrol_steps, hidden_size),
+            - hidden: last hidden state (num_layers, batch_size, hidden_size),
+            - att_probs: attention probabilities
+                (batch_size, unrol_steps, src_len)
+        """
+        rnn_input = self.rnn_input_dropout(trg_embed)
+        batch_size, unrol_steps = rnn_input.size(0), rnn_input.size(1)
+
+        # rnn_output: batch x unrol_steps x hidden_size (top layer)
+        if trg_lengths is not None:
+            packed = pack_padded_sequence(
+                rnn_input, trg_lengths.clamp(min=1, max=unrol_steps).cpu(),
+                batch_first=True, enforce_sorted=False)
+            rnn_output, hidden = self.rnn(packed, hidden)
+            rnn_output, _ = pad_packed_sequence(
+                rnn_output, batch_first=True, total_length=unrol_steps)
+        else:
+            rnn_output, hidden = self.rnn(rnn_input, hidden)
+
+        # the top layer outputs of all steps are the queries, in consecutive
+        # rows per sentence
+        context, att_probs = self.attention(
+            query=rnn_output.reshape(batch_size * unrol_steps, 1, -1),
+            values=encoder_output, mask=src_mask)
+
+        att_vector_input = torch.cat(
+            [rnn_output, context.view(batch_size, unrol_steps, -1)], dim=2)
+        att_vector_input = self.hidden_dropout(att_vector_input)
+
+        att_vectors = torch.tanh(self.att_vector_layer(att_vector_input))
+        return att_vectors, hidden, att_probs.view(batch_size, unrol_steps,
+                                                   -1)
+
     def forward(self,
                 trg_embed: Tensor,
                 encoder_output: Tensor,
@@ -274,7 +461,9 @@ class RecurrentDecoder(Decoder):
                 src_mask: Tensor,
                 unrol_steps: int,
                 hidden: Tensor = None,
-                prev_att_vector: Tensor = None) \
+                prev_att_vector: Tensor = None,
+                compute_outputs: bool = True,
+                trg_lengths: Optional[Tensor] = None) \
             -> (Tensor, Tensor, Tensor, Tensor):
         """
          Unroll the decoder one step at a time for `unrol_steps` steps.
@@ -289,6 +478,16 @@ class RecurrentDecoder(Decoder):
          In this case, `hidden` and `prev_att_vector` are fed from the output
          of the previous call of this function (from the 2nd step on).
 
+         Without input feeding, the steps do not depend on the previous
+         attention vectors, so all steps are computed at once
+         (see `_forward_sequence`).
+
+         With `self.skip_padding` and given `trg_lengths` (in training), the
+         decoder only runs on the targets that have not ended yet. The
+         outputs, attention vectors and attention probabilities after the
+         end of a target are then zeros (the loss ignores them), and the
+         returned hidden state of a target is the one after its last step.
+
          `src_mask` is needed to mask out the areas of the encoder states that
          should not receive any attention,
          which is everything after the first <eos>.
@@ -315,8 +514,14 @@ class RecurrentDecoder(Decoder):
         :param prev_att_vector: previous attentional vector,
             if not given it's initialized with zeros,
             shape (batch_size, 1, hidden_size)
+        :param compute_outputs: apply the output layer, if False the outputs
+            are None (e.g. when only the scores of the targets are needed)
+        :param trg_lengths: number of target steps of each batch entry (the
+            non-padded positions of the targets), shape (batch_size),
+            only used with `self.skip_padding`
         :return:
-            - outputs: shape (batch_size, unrol_steps, vocab_size),
+            - outputs: shape (batch_size, unrol_steps, vocab_size), logits
+                (log probabilities with an adaptive softmax),
             - hidden: last hidden state (num_layers, batch_size, hidden_size),
             - att_probs: attention probabilities
                 with shape (batch_size, unrol_steps, src_length),
@@ -343,6 +548,56 @@ class RecurrentDecoder(Decoder):
         if hasattr(self.attention, "compute_proj_keys"):
             self.attention.compute_proj_keys(keys=encoder_output)
 
+        if not self.skip_padding:
+            trg_lengths = None
+        if not self.input_feeding:
+            att_vectors, hidden, att_probs = self._forward_sequence(
+                trg_embed=trg_embed[:, :unrol_steps],
+                encoder_output=encoder_output, src_mask=src_mask,
+                hidden=hidden, trg_lengths=trg_lengths)
+        elif trg_lengths is not None:
+            att_vectors, hidden, att_probs = self._unroll_shrinking(
+                trg_embed=trg_embed, encoder_output=encoder_output,
+                src_mask=src_mask, unrol_steps=unrol_steps, hidden=hidden,
+                trg_lengths=trg_lengths, prev_att_vector=prev_att_vector)
+        else:
+            att_vectors, hidden, att_probs = self._unroll(
+                trg_embed=trg_embed, encoder_output=encoder_output,
+                src_mask=src_mask, unrol_steps=unrol_steps, hidden=hidden,
+                prev_att_vector=prev_att_vector)
+        # att_vectors: batch, unrol_steps, hidden_size
+        # att_probs: batch, unrol_steps, src_length
+        outputs = self.output_layer(att_vectors) if compute_outputs else None
+        # outputs: batch, unrol_steps, vocab_size
+        return outputs, hidden, att_probs, att_vectors
+
+    def _unroll(self, trg_embed: Tensor, encoder_output: Tensor,
+                src_mask: Tensor, unrol_steps: int, hidden: Tensor,
+                prev_att_vector: Optional[Tensor] = None) \
+            -> (Tensor, Tensor, Tensor):
+        """
+        Unroll the decoder one step at a time for `unrol_steps` steps with
+        `self._forward_step`.
+
+        :param trg_embed: embedded target inputs,
+            shape (batch_size, trg_length, embed_size)
+        :param encoder_output: encoder hidden states for attention context,
+            shape (batch_size, src_length, encoder.output_size)
+        :param src_mask: src mask, 1s for area before <eos>, 0s elsewhere
+            shape (batch_size, 1, src_length)
+        :param unrol_steps: number of steps to unrol the decoder RNN
+        :param hidden: initial hidden state,
+            shape (num_layers, batch_size, hidden_size)
+        :param prev_att_vector: previous attentional vector,
+            if not given it's initialized with zeros,
+            shape (batch_size, 1, hidden_size)
+        :return:
+            - att_vectors: attention vectors
+                (batch_size, unrol_steps, hidden_size),
+            - hidden: last hidden state (num_layers, batch_size, hidden_size),
+            - att_probs: attention probabilities
+                (batch_size, unrol_steps, src_len)
+        """
         # here we store all intermediate attention vectors (used for prediction)
         att_vectors = []
         att_probs = []
@@ -366,13 +621,170 @@ class RecurrentDecoder(Decoder):
             att_vectors.append(prev_att_vector)
             att_probs.append(att_prob)
 
-        att_vectors = torch.cat(att_vectors, dim=1)
-        # att_vectors: batch, unrol_steps, hidden_size
-        att_probs = torch.cat(att_probs, dim=1)
-        # att_probs: batch, unrol_steps, src_length
-        outputs = self.output_layer(att_vectors)
-        # outputs: batch, unrol_steps, vocab_size
-        return outputs, hidden, att_probs, att_vectors
+        return torch.cat(att_vectors, dim=1), hidden, \
+            torch.cat(att_probs, dim=1)
+
+    # pylint: disable=too-many-locals
+    def _unroll_shrinking(self, trg_embed: Tensor, encoder_output: Tensor,
+                          src_mask: Tensor, unrol_steps: int, hidden: Tensor,
+                          trg_lengths: Tensor,
+                          prev_att_vector: Optional[Tensor] = None) \
+            -> (Tensor, Tensor, Tensor):
+        """
+        Unroll the decoder one step at a time like `self._unroll`, but only
+        for the targets that have not ended: the batch is sorted by target
+        length, so that the unfinished targets are the first rows, and each
+        step only runs on them. The results are sorted back.
+
+        :param trg_embed: embedded target inputs,
+            shape (batch_size, trg_length, embed_size)
+        :param encoder_output: encoder hidden states for attention context,
+            shape (batch_size, src_length, encoder.output_size)
+        :param src_mask: src mask, 1s for area before <eos>, 0s elsewhere
+            shape (batch_size, 1, src_length)
+        :param unrol_steps: number of steps to unrol the decoder RNN
+        :param hidden: initial hidden state,
+            shape (num_layers, batch_size, hidden_size)
+        :param trg_lengths: number of steps of each target,
+            shape (batch_size)
+        :param prev_att_vector: previous attentional vector,
+            if not given it's initialized with zeros,
+            shape (batch_size, 1, hidden_size)
+        :return:
+            - att_vectors: attention vectors, zeros after the end of each
+                target (batch_size, unrol_steps, hidden_size),
+            - hidden: hidden state after the last step of each target
+                (num_layers, batch_size, hidden_size),
+            - att_probs: attention probabilities, zeros after the end of
+                each target (batch_size, unrol_steps, src_len)
+        """
+        batch_size = encoder_output.size(0)
+        if prev_att_vector is None:
+            with torch.no_grad():
+                prev_att_vector = encoder_output.new_zeros(
+                    [batch_size, 1, self.hidden_size])
+
+        # sort by target length, longest first
+        order = trg_lengths.argsort(descending=True)
+        lengths = trg_lengths.index_select(0, order).tolist()
+        state = RecurrentDecoderState(
+            hidden=hidden, prev_att_vector=prev_att_vector,
+            encoder_output=encoder_output, src_mask=src_mask,
+            proj_keys=getattr(self.attention, "proj_keys", None)
+        ).index_select(order)
+        trg_embed = trg_embed.index_select(0, order)
+
+        att_vectors = encoder_output.new_zeros(
+            [batch_size, unrol_steps, self.hidden_size])
+        att_probs = encoder_output.new_zeros(
+            [batch_size, unrol_steps, src_mask.size(2)])
+        # hidden states of the ended targets, last rows first
+        final_hidden = []
+
+        def rows(tensor, start, end):
+            if isinstance(tensor, tuple):  # for lstm
+                return tuple(t[:, start:end] for t in tensor)
+            return tensor[:, start:end]
+
+        active = batch_size
+        for i in range(unrol_steps):
+            ended = active
+            while ended > 0 and lengths[ended - 1] <= i:
+                ended -= 1
+            if ended < active:
+                final_hidden.append(rows(state.hidden, ended, active))
+                if ended == 0:
+                    break
+                state = state.index_select(
+                    torch.arange(ended, device=encoder_output.device))
+                active = ended
+
+            if state.proj_keys is not None:
+                self.attention.proj_keys = state.proj_keys
+            att_vector, hidden, att_prob = self._forward_step(
+                prev_embed=trg_embed[:active, i].unsqueeze(1),
+                prev_att_vector=state.prev_att_vector,
+                encoder_output=state.encoder_output,
+                src_mask=state.src_mask, hidden=state.hidden)
+            state = RecurrentDecoderState(
+                hidden=hidden, prev_att_vector=att_vector,
+                encoder_output=state.encoder_output, src_mask=state.src_mask,
+                proj_keys=state.proj_keys)
+            att_vectors[:active, i] = att_vector.squeeze(1)
+            att_probs[:active, i] = att_prob.squeeze(1)
+        else:
+            final_hidden.append(rows(state.hidden, 0, active))
+
+        # sort back to the original order
+        reverse = order.argsort()
+        final_hidden = final_hidden[::-1]
+        if isinstance(final_hidden[0], tuple):
+            hidden = tuple(torch.cat(h, dim=1).index_select(1, reverse)
+                           for h in zip(*final_hidden))
+        else:
+            hidden = torch.cat(final_hidden, dim=1).index_select(1, reverse)
+        return att_vectors.index_select(0, reverse), hidden, \
+            att_probs.index_select(0, reverse)
+
+    def init_state(self, encoder_output: Tensor, encoder_hidden: Tensor,
+                   src_mask: Tensor) -> RecurrentDecoderState:
+        """
+        Initial state for decoding one step at a time with `self.step`.
+        The keys for the attention are projected once here.
+
+        :param encoder_output: hidden states from the encoder,
+            shape (batch_size, src_length, encoder.output_size)
+        :param encoder_hidden: last state from the encoder,
+            shape (batch_size x encoder.output_size)
+        :param src_mask: mask for src states: 0s for padded areas,
+            1s for the rest, shape (batch_size, 1, src_length)
+        :return: decoder state
+        """
+        proj_keys = None
+        if hasattr(self.attention, "compute_proj_keys"):
+            self.attention.compute_proj_keys(keys=encoder_output)
+            proj_keys = self.attention.proj_keys
+        return RecurrentDecoderState(
+            hidden=self._init_hidden(encoder_hidden),
+            prev_att_vector=encoder_output.new_zeros(
+                [encoder_output.size(0), 1, self.hidden_size]),
+            encoder_output=encoder_output, src_mask=src_mask,
+            proj_keys=proj_keys)
+
+    def step(self, prev_embed: Tensor, state: RecurrentDecoderState,
+             check_shapes: bool = False,
+             output_layer: Optional[Callable[[Tensor], Tensor]] = None) \
+            -> (Tensor, RecurrentDecoderState, Tensor):
+        """
+        Decode a single step from a state created by `self.init_state`,
+        reusing its projected keys.
+
+        :param prev_embed: embedded previous token,
+            shape (batch_size, 1, embed_size)
+        :param state: decoder state after the previous step
+        :param check_shapes: check the shapes of the inputs (off for fast
+            inference)
+        :param output_layer: computes the logits instead of
+            `self.output_layer`, e.g. for a part of the vocabulary only
+        :return:
+            - output: logits (log probabilities with an adaptive softmax),
+              shape (batch_size, 1, vocab_size),
+            - state: decoder state after this step,
+            - att_probs: attention probabilities (batch_size, 1, src_len)
+        """
+        if state.proj_keys is not None:
+            self.attention.proj_keys = state.proj_keys
+        att_vector, hidden, att_probs = self._forward_step(
+            prev_embed=prev_embed, prev_att_vector=state.prev_att_vector,
+            encoder_output=state.encoder_output, src_mask=state.src_mask,
+            hidden=state.hidden, check_shapes=check_shapes)
+        state = RecurrentDecoderState(
+            hidden=hidden, prev_att_vector=att_vector,
+            encoder_output=state.encoder_output, src_mask=state.src_mask,
+            proj_keys=state.proj_keys)
+        if output_layer is None:
+            output_layer = self.output_layer
+        return output_layer(att_vector), state, att_probs
 
     def _init_hidden(self, encoder_final: Tensor = None) \
             -> (Tensor, Optional[Tensor]):
@@ -424,3 +836,249 @@ class RecurrentDecoder(Decoder):
     def __repr__(self):
         return "RecurrentDecoder(rnn=%r, attention=%r)" % (
             self.rnn, self.attention)
+
+
+class TransformerDecoderState:
+    """
+    State of a Transformer decoder for decoding one step at a time: the
+    encoder states with their projections (keys and values) for the
+    attention of each layer, the source mask, and the projected keys and
+    values of the self-attention of each layer for the previous target
+    positions (so that each step only computes its own position).
+    Rows can be selected or reordered, e.g. for beam search.
+
+    As in `RecurrentDecoderState`, the encoder states and their projections
+    are stored once per source sentence, and the hypotheses of a sentence
+    are in consecutive rows.
+    """
+
+    def __init__(self, encoder_output: Tensor, src_mask: Tensor,
+                 memory: List[Tuple[Tensor, Tensor]],
+                 cache: Optional[List[Tuple[Tensor, Tensor]]] = None,
+                 step: int = 0) -> None:
+        """
+        :param encoder_output: encoder states,
+            shape (batch_size, src_length, encoder.output_size)
+        :param src_mask: source mask, shape (batch_size, 1, src_length)
+        :param memory: projected encoder states (keys, values) of each
+            layer, shape (batch_size, num_heads, src_length, head_size)
+        :param cache: projected keys and values of the self-attention of
+            each layer for the previous positions,
+            shape (hypotheses, num_heads, step, head_size), None before the
+            first step
+        :param step: number of decoded positions
+        """
+        self.encoder_output = encoder_output
+        self.src_mask = src_mask
+        self.memory = memory
+        self.cache = cache
+        self.step = step
+
+    def index_select(self, index: Tensor) -> "TransformerDecoderState":
+        """
+        Select rows (batch entries) of a state with one hypothesis per
+        source sentence.
+
+        :param index: indices of the rows to keep, in the new order
+        :return: new state with len(index) rows
+        """
+        return self.select_hypotheses(index, sentence_index=index)
+
+    def select_hypotheses(self, index: Tensor,
+                          sentence_index: Optional[Tensor] = None) \
+            -> "TransformerDecoderState":
+        """
+        Select hypotheses of the state, e.g. to reorder a beam.
+
+        :param index: indices of the hypotheses to keep, in the new order
+        :param sentence_index: indices of the source sentences to keep, in
+            the new order, None to keep the encoder states of all sentences
+            (they are not copied)
+        :return: new state with len(index) hypotheses
+        """
+        encoder_output = self.encoder_output
+        src_mask = self.src_mask
+        memory = self.memory
+        if sentence_index is not None:
+            encoder_output = encoder_output.index_select(0, sentence_index)
+            src_mask = src_mask.index_select(0, sentence_index)
+            memory = [(k.index_select(0, sentence_index),
+                       v.index_select(0, sentence_index)) for k, v in memory]
+        cache = [(k.index_select(0, index), v.index_select(0, index))
+                 for k, v in self.cache] if self.cache is not None else None
+        return TransformerDecoderState(
+            encoder_output=encoder_output, src_mask=src_mask, memory=memory,
+            cache=cache, step=self.step)
+
+
+class TransformerDecoder(Decoder):
+    """
+    Transformer decoder: masked self-attention layers over the target and
+    attention on the encoder states. In training, all target positions
+    are computed at once (teacher forcing); in decoding, one position at
+    a time with cached self-attention keys and values
+    (see `TransformerDecoderState`).
+    """
+
+    # pylint: disable=unused-argument
+    def __init__(self,
+                 hidden_size: int = 512,
+                 ff_size: int = 2048,
+                 num_layers: int = 6,
+                 num_heads: int = 8,
+                 dropout: float = 0.1,
+                 emb_dropout: float = 0.1,
+                 vocab_size: int = 1,
+                 freeze: bool = False,
+                 adaptive_softmax: Optional[dict] = None,
+                 **kwargs) -> None:
+        """
+        Create a Transformer decoder.
+
+        :param hidden_size: model size, the size of the embeddings as well
+        :param ff_size: size of the hidden layer of the feed-forward layers
+        :param num_layers: number of layers
+        :param num_heads: number of attention heads
+        :param dropout: dropout in the layers
+        :param emb_dropout: dropout of the embeddings (with positions)
+        :param vocab_size: target vocabulary size
+        :param freeze: freeze the parameters of the decoder during training
+        :param adaptive_softmax: if given, use an adaptive softmax as output
+            layer (see `RecurrentDecoder`)
+        :param kwargs:
+        """
+        super(TransformerDecoder, self).__init__()
+
+        self.hidden_size = hidden_size
+        self.layers = clones(TransformerDecoderLayer(
+            size=hidden_size, ff_size=ff_size, num_heads=num_heads,
+            dropout=dropout), num_layers)
+        self.layer_norm = nn.LayerNorm(hidden_size, eps=1e-6)
+        self.pe = PositionalEncoding(hidden_size)
+        self.emb_dropout = nn.Dropout(p=emb_dropout)
+
+        if adaptive_softmax is not None:
+            self.output_layer = AdaptiveSoftmax(
+                input_size=hidden_size, vocab_size=vocab_size,
+                **adaptive_softmax)
+        else:
+            self.output_layer = nn.Linear(hidden_size, vocab_size, bias=False)
+        self._output_size = vocab_size
+
+        if freeze:
+            freeze_params(self)
+
+    # pylint: disable=arguments-differ,too-many-arguments
+    def forward(self,
+                trg_embed: Tensor,
+                encoder_output: Tensor,
+                encoder_hidden: Optional[Tensor],
+                src_mask: Tensor,
+                unrol_steps: int,
+                hidden: Tensor = None,
+                prev_att_vector: Tensor = None,
+                compute_outputs: bool = True,
+                trg_lengths: Optional[Tensor] = None) \
+            -> (Tensor, None, Tensor, Tensor):
+        """
+        Decode all target positions at once, each only attending to itself
+        and the positions before it. Padding at the end of the targets does
+        not change the other positions.
+
+        :param trg_embed: embedded target inputs,
+            shape (batch_size, trg_length, embed_size)
+        :param encoder_output: hidden states from the encoder,
+            shape (batch_size, src_length, encoder.output_size)
+        :param encoder_hidden: not used
+        :param src_mask: mask for src states: 0s for padded areas,
+            1s for the rest, shape (batch_size, 1, src_length)
+        :param unrol_steps: number of target positions to decode
+        :param hidden: not used
+        :param prev_att_vector: not used
+        :param compute_outputs: apply the output layer, if False the outputs
+            are None
+        :param trg_lengths: not used
+        :return:
+            - outputs: shape (batch_size, unrol_steps, vocab_size),
+            - hidden: None,
+            - att_probs: attention probabilities of the last layer on the
+                encoder states, with shape
+                (batch_size, unrol_steps, src_length),
+            - att_vectors: outputs of the last layer (inputs of the output
+                layer) with shape (batch_size, unrol_steps, hidden_size)
+        """
+        x = self.emb_dropout(self.pe(trg_embed[:, :unrol_steps]))
+        trg_mask = subsequent_mask(x.size(1)).to(x.device)
+        att_probs = None
+        for layer in self.layers:
+            x, att_probs, _ = layer(
+                x, *layer.src_trg_att.project_keys_values(encoder_output),
+                src_mask=src_mask, trg_mask=trg_mask)
+        x = self.layer_norm(x)
+        outputs = self.output_layer(x) if compute_outputs else None
+        return outputs, None, att_probs, x
+
+    def init_state(self, encoder_output: Tensor,
+                   encoder_hidden: Optional[Tensor],
+                   src_mask: Tensor) -> TransformerDecoderState:
+        """
+        Initial state for decoding one step at a time with `self.step`.
+        The encoder states are projected for the attention of each layer
+        once here.
+
+        :param encoder_output: hidden states from the encoder,
+            shape (batch_size, src_length, encoder.output_size)
+        :param encoder_hidden: not used
+        :param src_mask: mask for src states: 0s for padded areas,
+            1s for the rest, shape (batch_size, 1, src_length)
+        :return: decoder state
+        """
+        return TransformerDecoderState(
+            encoder_output=encoder_output, src_mask=src_mask,
+            memory=[layer.src_trg_att.project_keys_values(encoder_output)
+                    for layer in self.layers])
+
+    def step(self, prev_embed: Tensor, state: TransformerDecoderState,
+             check_shapes: bool = False,
+             output_layer: Optional[Callable[[Tensor], Tensor]] = None) \
+            -> (Tensor, TransformerDecoderState, Tensor):
+        """
+        Decode a single step from a state created by `self.init_state`:
+        only the new position is computed, its self-attention uses the
+        cached keys and values of the previous positions.
+
+        :param prev_embed: embedded previous token,
+            shape (hypotheses, 1, embed_size)
+        :param state: decoder state after the previous step
+        :param check_shapes: check the shapes of the inputs
+        :param output_layer: computes the logits instead of
+            `self.output_layer`, e.g. for a part of the vocabulary only
+        :return:
+            - output: logits (log probabilities with an adaptive softmax),
+              shape (hypotheses, 1, vocab_size),
+            - state: decoder state after this step,
+            - att_probs: attention probabilities (hypotheses, 1, src_len)
+        """
+        if check_shapes:
+            assert prev_embed.shape[1:] == torch.Size([1, self.hidden_size])
+            assert prev_embed.shape[0] % state.encoder_output.shape[0] == 0
+        x = self.emb_dropout(self.pe(prev_embed, offset=state.step))
+        cache = []
+        att_probs = None
+        for i, layer in enumerate(self.layers):
+            x, att_probs, layer_cache = layer(
+                x, *state.memory[i], src_mask=state.src_mask,
+                cache=state.cache[i] if state.cache is not None else None)
+            cache.append(layer_cache)
+        x = self.layer_norm(x)
+        state = TransformerDecoderState(
+            encoder_output=state.encoder_output, src_mask=state.src_mask,
+            memory=state.memory, cache=cache, step=state.step + 1)
+        if output_layer is None:
+            output_layer = self.output_layer
+        return output_layer(x), state, att_probs
+
+    def __repr__(self):
+        return "%s(num_layers=%r, num_heads=%r)" % (
+            self.__class__.__name__, len(self.layers),
+            self.layers[0].trg_trg_att.num_heads)
@@ -9,7 +9,10 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
-from joeynmt.helpers import freeze_params
+from joeynmt.helpers import freeze_params, clones
+from joeynmt.sru import SRU
+from joeynmt.transformer_layers import PositionalEncoding, \
+    TransformerEncoderLayer
 
 #pylint: disable=abstract-method
 class Encoder(nn.Module):
@@ -42,7 +45,7 @@ class RecurrentEncoder(Encoder):
         """
         Create a new recurrent encoder.
 
-        :param rnn_type:
+        :param rnn_type: "gru", "lstm" or "sru" (see `SRU`)
         :param hidden_size:
         :param emb_size:
         :param num_layers:
@@ -58,7 +61,8 @@ class RecurrentEncoder(Encoder):
         self.type = rnn_type
         self.emb_size = emb_size
 
-        rnn = nn.GRU if rnn_type == "gru" else nn.LSTM
+        rnn = nn.GRU if rnn_type == "gru" \
+            else SRU if rnn_type == "sru" else nn.LSTM
 
         self.rnn = rnn(
             emb_size, hidden_size, num_layers, batch_first=True,
@@ -145,3 +149,75 @@ class RecurrentEncoder(Encoder):
     @property
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.rnn)
+
+
+class TransformerEncoder(Encoder):
+    """
+    Transformer encoder: self-attention layers over all source positions
+    at once.
+    """
+
+    #pylint: disable=unused-argument
+    def __init__(self,
+                 hidden_size: int = 512,
+                 ff_size: int = 2048,
+                 num_layers: int = 6,
+                 num_heads: int = 8,
+                 dropout: float = 0.1,
+                 emb_dropout: float = 0.1,
+                 freeze: bool = False,
+                 **kwargs) -> None:
+        """
+        Create a new Transformer encoder.
+
+        :param hidden_size: model size, the size of the embeddings as well
+        :param ff_size: size of the hidden layer of the feed-forward layers
+        :param num_layers: number of layers
+        :param num_heads: number of attention heads
+        :param dropout: dropout in the layers
+        :param emb_dropout: dropout of the embeddings (with positions)
+        :param freeze: freeze the parameters of the encoder during training
+        :param kwargs:
+        """
+        super(TransformerEncoder, self).__init__()
+
+        self.layers = clones(TransformerEncoderLayer(
+            size=hidden_size, ff_size=ff_size, num_heads=num_heads,
+            dropout=dropout), num_layers)
+        self.layer_norm = nn.LayerNorm(hidden_size, eps=1e-6)
+        self.pe = PositionalEncoding(hidden_size)
+        self.emb_dropout = nn.Dropout(p=emb_dropout)
+
+        self._output_size = hidden_size
+
+        if freeze:
+            freeze_params(self)
+
+    #pylint: disable=arguments-differ
+    def forward(self, embed_src: Tensor, src_length: Tensor, mask: Tensor) \
+            -> (Tensor, None):
+        """
+        Encode the embedded source: add position encodings and apply the
+        layers.
+
+        :param embed_src: embedded src inputs,
+            shape (batch_size, src_len, embed_size)
+        :param src_length: length of src inputs
+            (counting tokens before padding), shape (batch_size)
+        :param mask: source mask, 1 at valid tokens,
+            shape (batch_size, 1, src_len)
+        :return:
+            - output: hidden states with shape (batch_size, src_len,
+                hidden_size),
+            - hidden: None, the Transformer decoder does not start from
+                a last encoder state
+        """
+        x = self.emb_dropout(self.pe(embed_src))
+        for layer in self.layers:
+            x = layer(x, mask)
+        return self.layer_norm(x), None
+
+    def __repr__(self):
+        return "%s(num_layers=%r, num_heads=%r)" % (
+            self.__class__.__name__, len(self.layers),
+            self.layers[0].src_src_att.num_heads)
@@ -138,14 +138,37 @@ def log_data_info(train_data: Dataset, valid_data: Dataset, test_data: Dataset,
     :param logging_function:
     """
 
+    def size(dataset: Dataset) -> str:
+        # streamed data has a number of examples once they were counted
+        # (torchtext datasets answer every unknown attribute)
+        if "num_examples" in vars(dataset):
+            return "unknown" if dataset.num_examples is None \
+                else str(dataset.num_examples)
+        return str(len(dataset))
+
     logging_function(
-        "Data set sizes: \n\ttrain %d,\n\tvalid %d,\n\ttest %d",
-            len(train_data), len(valid_data) if valid_data is not None else 0,
+        "Data set sizes: \n\ttrain %s,\n\tvalid %d,\n\ttest %d",
+            size(train_data),
+            len(valid_data) if valid_data is not None else 0,
             len(test_data) if test_data is not None else 0)
 
+    # several training corpora are sampled from with fixed probabilities
+    for name, corpus, probability in zip(
+            getattr(train_data, "names", []),
+            getattr(train_data, "datasets", []),
+            getattr(train_data, "probabilities", [])):
+        logging_function("Training corpus %s: %s examples, sampled with "
+                         "probability %.3f", name, size(corpus), probability)
+
+    # streamed training data can only be iterated over, and
+    # preprocessed training data contains token IDs instead of tokens
+    first_example = next(iter(train_data))
+    first_src = [src_vocab.itos[t] if isinstance(t, int) else t
+                 for t in vars(first_example)['src']]
+    first_trg = [trg_vocab.itos[t] if isinstance(t, int) else t
+                 for t in vars(first_example)['trg']]
     logging_function("First training example:\n\t[SRC] %s\n\t[TRG] %s",
-        " ".join(vars(train_data[0])['src']),
-        " ".join(vars(train_data[0])['trg']))
+        " ".join(first_src), " ".join(first_trg))
 
     logging_function("First 10 words (src): %s", " ".join(
         '(%d) %s' % (i, t) for i, t in enumerate(src_vocab.itos[:10])))
@@ -178,6 +201,26 @@ def bpe_postprocess(string) -> str:
     return string.replace("@@ ", "")
 
 
+def postprocess_sentences(sentences: List[List[str]], level: str) -> List[str]:
+    """
+    Join tokenized sentences to strings and recombine BPE-split tokens.
+
+    All sentences are processed as one newline-separated string,
+    so that BPE merging is done in one pass instead of once per sentence.
+
+    :param sentences: list of tokenized sentences
+    :param level: segmentation level, one of "char", "bpe", "word"
+    :return: list of post-processed sentences
+    """
+    if len(sentences) == 0:
+        return []
+    join_char = " " if level in ["word", "bpe"] else ""
+    text = "\n".join(join_char.join(s) for s in sentences)
+    if level == "bpe":
+        text = bpe_postprocess(text)
+    return text.split("\n")
+
+
 def store_attention_plots(attentions: np.array, targets: List[List[str]],
                           sources: List[List[str]],
                           output_prefix: str, indices: List[int],
@@ -248,36 +291,21 @@ def load_checkpoint(path: str, use_cuda: bool = True) -> dict:
     return checkpoint
 
 
-# from onmt
-def tile(x: Tensor, count: int, dim=0) -> Tensor:
+def pad_to_length(tensor: Tensor, dim: int, size: int, value=0) -> Tensor:
     """
-    Tiles x on dimension dim count times. From OpenNMT. Used for beam search.
+    Pad a tensor with `value` along dimension `dim` to length `size`.
 
-    :param x: tensor to tile
-    :param count: number of tiles
-    :param dim: dimension along which the tensor is tiled
-    :return: tiled tensor
+    :param tensor: tensor to pad
+    :param dim: dimension to pad
+    :param size: minimum length of `dim` after padding
+    :param value: padding value
+    :return: padded tensor (the tensor itself if it is long enough)
     """
-    if isinstance(x, tuple):
-        h, c = x
-        return tile(h, count, dim=dim), tile(c, count, dim=dim)
-
-    perm = list(range(len(x.size())))
-    if dim != 0:
-        perm[0], perm[dim] = perm[dim], perm[0]
-        x = x.permute(perm).contiguous()
-    out_size = list(x.size())
-    out_size[0] *= count
-    batch = x.size(0)
-    x = x.view(batch, -1) \
-        .transpose(0, 1) \
-        .repeat(count, 1) \
-        .transpose(0, 1) \
-        .contiguous() \
-        .view(*out_size)
-    if dim != 0:
-        x = x.permute(perm).contiguous()
-    return x
+    if tensor.size(dim) >= size:
+        return tensor
+    shape = list(tensor.size())
+    shape[dim] = size - tensor.size(dim)
+    return torch.cat([tensor, tensor.new_full(shape, value)], dim=dim)
 
 
 def freeze_params(module: nn.Module) -> None:
@@ -11,6 +11,8 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn.init import _calculate_fan_in_and_fan_out
 
+from joeynmt.sru import SRU
+
 
 def orthogonal_rnn_init_(cell: nn.RNNBase, gain: float = 1.):
     """
@@ -143,16 +145,26 @@ def initialize_model(model: nn.Module, cfg: dict, src_padding_idx: int,
             elif "bias" in name:
                 bias_init_fn_(p)
 
+            elif "layer_norm" in name:
+                # layer normalization weights keep their initialization (1)
+                continue
+
             elif len(p.size()) > 1:
 
                 # RNNs combine multiple matrices is one, which messes up
                 # xavier initialization
                 if init == "xavier" and "rnn" in name:
                     n = 1
+                    rnn = None
                     if "encoder" in name:
                         n = 4 if isinstance(model.encoder.rnn, nn.LSTM) else 3
+                        rnn = model.encoder.rnn
                     elif "decoder" in name:
                         n = 4 if isinstance(model.decoder.rnn, nn.LSTM) else 3
+                        rnn = model.decoder.rnn
+                    if isinstance(rnn, SRU):
+                        # 3 or 4 matrices, depending on the layer input
+                        n = p.size(0) // rnn.hidden_size
                     xavier_uniform_n_(p.data, gain=gain, n=n)
                 else:
                     init_fn_(p)
@@ -170,7 +182,8 @@ def initialize_model(model: nn.Module, cfg: dict, src_padding_idx: int,
         # encoder rnn orthogonal initialization & LSTM forget gate
         if hasattr(model.encoder, "rnn"):
 
-            if orthogonal:
+            # the SRU has no recurrent weights
+            if orthogonal and isinstance(model.encoder.rnn, nn.RNNBase):
                 orthogonal_rnn_init_(model.encoder.rnn)
 
             if isinstance(model.encoder.rnn, nn.LSTM):
@@ -179,7 +192,7 @@ def initialize_model(model: nn.Module, cfg: dict, src_padding_idx: int,
         # decoder rnn orthogonal initialization & LSTM forget gate
         if hasattr(model.decoder, "rnn"):
 
-            if orthogonal:
+            if orthogonal and isinstance(model.decoder.rnn, nn.RNNBase):
                 orthogonal_rnn_init_(model.decoder.rnn)
 
             if isinstance(model.decoder.rnn, nn.LSTM):
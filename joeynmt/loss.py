@@ -18,10 +18,16 @@ class WeightedCrossEntropy(_Loss):
 
     #pylint: disable=arguments-differ
     def forward(self, model_output, target, weights=None):
-        # no reduction
-        token_loss = F.nll_loss(model_output, target,
-                                ignore_index=self.ignore_index,
-                                reduction='none')
+        # model_output: log probs over the vocabulary (n x vocab_size),
+        # or of the targets only (n), e.g. from an adaptive softmax
+        if model_output.dim() == 1:
+            token_loss = -model_output.masked_fill(
+                target.eq(self.ignore_index), 0.)
+        else:
+            # no reduction
+            token_loss = F.nll_loss(model_output, target,
+                                    ignore_index=self.ignore_index,
+                                    reduction='none')
         if weights is not None:
             # multiply by the weights before nll loss
             token_loss *= weights
@@ -5,16 +5,20 @@ Module to represents whole models
 from typing import Optional
 import numpy as np
 
+import torch
 import torch.nn as nn
 from torch import Tensor
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
+from joeynmt.adaptive_softmax import AdaptiveSoftmax
 from joeynmt.initialization import initialize_model
 from joeynmt.embeddings import Embeddings
-from joeynmt.encoders import Encoder, RecurrentEncoder
-from joeynmt.decoders import Decoder, RecurrentDecoder
+from joeynmt.encoders import Encoder, RecurrentEncoder, TransformerEncoder
+from joeynmt.decoders import Decoder, RecurrentDecoder, TransformerDecoder
 from joeynmt.constants import PAD_TOKEN, EOS_TOKEN, BOS_TOKEN
-from joeynmt.search import beam_search, greedy
+from joeynmt.search import beam_search, greedy, output_length_limits
+from joeynmt.shortlist import Shortlist
 from joeynmt.vocabulary import Vocabulary
 from joeynmt.batch import Batch
 from joeynmt.helpers import ConfigurationError
@@ -31,7 +35,8 @@ class Model(nn.Module):
                  src_embed: Embeddings,
                  trg_embed: Embeddings,
                  src_vocab: Vocabulary,
-                 trg_vocab: Vocabulary) -> None:
+                 trg_vocab: Vocabulary,
+                 loss_chunk_size: int = 0) -> None:
         """
         Create a new encoder-decoder model
 
@@ -41,6 +46,9 @@ class Model(nn.Module):
         :param trg_embed: target embedding
         :param src_vocab: source vocabulary
         :param trg_vocab: target vocabulary
+        :param loss_chunk_size: if > 0, the output layer and the loss are
+            computed for this many target positions at a time (see
+            `get_loss_for_batch`)
         """
         super(Model, self).__init__()
 
@@ -53,10 +61,13 @@ class Model(nn.Module):
         self.bos_index = self.trg_vocab.stoi[BOS_TOKEN]
         self.pad_index = self.trg_vocab.stoi[PAD_TOKEN]
         self.eos_index = self.trg_vocab.stoi[EOS_TOKEN]
+        self.loss_chunk_size = loss_chunk_size
 
     #pylint: disable=arguments-differ
     def forward(self, src: Tensor, trg_input: Tensor, src_mask: Tensor,
-                src_lengths: Tensor) -> (Tensor, Tensor, Tensor, Tensor):
+                src_lengths: Tensor, compute_outputs: bool = True,
+                trg_lengths: Optional[Tensor] = None) \
+            -> (Tensor, Tensor, Tensor, Tensor):
         """
         Take in and process masked src and target sequences.
         Use the encoder hidden state to initialize the decoder
@@ -66,6 +77,9 @@ class Model(nn.Module):
         :param trg_input: target input
         :param src_mask: source mask
         :param src_lengths: length of source inputs
+        :param compute_outputs: apply the output layer of the decoder
+        :param trg_lengths: number of target steps of each batch entry, lets
+            the decoder skip the padding (if configured)
         :return: decoder outputs
         """
         encoder_output, encoder_hidden = self.encode(src=src,
@@ -75,13 +89,14 @@ class Model(nn.Module):
         return self.decode(encoder_output=encoder_output,
                            encoder_hidden=encoder_hidden,
                            src_mask=src_mask, trg_input=trg_input,
-                           unrol_steps=unrol_steps)
+                           unrol_steps=unrol_steps,
+                           compute_outputs=compute_outputs,
+                           trg_lengths=trg_lengths)
 
     def encode(self, src: Tensor, src_length: Tensor, src_mask: Tensor) \
             -> (Tensor, Tensor):
         """
         Encodes the source sentence.
-        TODO adapt to transformer
 
         :param src:
         :param src_length:
@@ -92,7 +107,9 @@ class Model(nn.Module):
 
     def decode(self, encoder_output: Tensor, encoder_hidden: Tensor,
                src_mask: Tensor, trg_input: Tensor,
-               unrol_steps: int, decoder_hidden: Tensor = None) \
+               unrol_steps: int, decoder_hidden: Tensor = None,
+               compute_outputs: bool = True,
+               trg_lengths: Optional[Tensor] = None) \
             -> (Tensor, Tensor, Tensor, Tensor):
         """
         Decode, given an encoded source sentence.
@@ -103,6 +120,10 @@ class Model(nn.Module):
         :param trg_input: target inputs
         :param unrol_steps: number of steps to unrol the decoder for
         :param decoder_hidden: decoder hidden state (optional)
+        :param compute_outputs: apply the output layer of the decoder,
+            if False the outputs are None
+        :param trg_lengths: number of target steps of each batch entry, lets
+            the decoder skip the padding (if configured)
         :return: decoder outputs (outputs, hidden, att_probs, att_vectors)
         """
         return self.decoder(trg_embed=self.trg_embed(trg_input),
@@ -110,38 +131,84 @@ class Model(nn.Module):
                             encoder_hidden=encoder_hidden,
                             src_mask=src_mask,
                             unrol_steps=unrol_steps,
-                            hidden=decoder_hidden)
+                            hidden=decoder_hidden,
+                            compute_outputs=compute_outputs,
+                            trg_lengths=trg_lengths)
 
     def get_loss_for_batch(self, batch: Batch, loss_function: nn.Module) \
             -> Tensor:
         """
         Compute non-normalized loss and number of tokens for a batch
 
+        The output layer and the loss are only computed for the target
+        positions that count: not padding and, with feedback, not weighted
+        with zero. With `self.loss_chunk_size`, they are computed for that
+        many positions at a time, and the log probabilities of a chunk are
+        not kept for the backward pass but computed again there (one chunk
+        at a time), so that the memory for them does not grow with the
+        number of target positions.
+
         :param batch: batch to compute loss for
         :param loss_function: loss function, computes for input and target
             a scalar loss for the complete batch
         :return: batch_loss: sum of losses over non-pad elements in the batch
         """
+        adaptive = isinstance(self.decoder.output_layer, AdaptiveSoftmax)
         # pylint: disable=unused-variable
-        out, hidden, att_probs, _ = self.forward(
+        _, hidden, att_probs, att_vectors = self.forward(
             src=batch.src, trg_input=batch.trg_input,
-            src_mask=batch.src_mask, src_lengths=batch.src_lengths)
-
-        # compute log probs
-        log_probs = F.log_softmax(out, dim=-1)
+            src_mask=batch.src_mask, src_lengths=batch.src_lengths,
+            compute_outputs=False, trg_lengths=batch.trg_mask.sum(dim=1))
 
-        # compute batch loss
-        batch_loss = loss_function(
-            model_output=log_probs.contiguous().view(-1, log_probs.size(-1)),
-            target=batch.trg.contiguous().view(-1),
+        # select the positions that count for the loss
+        positions = batch.trg.ne(self.pad_index)
+        if batch.weights is not None:
             # add weights = token-level feedback here
-            weights=batch.weights.contiguous().view(-1)
-            if batch.weights is not None else None)
+            positions &= batch.weights.ne(0)
+        positions = positions.view(-1).nonzero().view(-1)
+        att_vectors = att_vectors.contiguous().view(
+            -1, att_vectors.size(-1)).index_select(0, positions)
+        inputs = [batch.trg.contiguous().view(-1).index_select(0, positions)]
+        if batch.weights is not None:
+            inputs.append(batch.weights.contiguous().view(-1).index_select(
+                0, positions))
+
+        def chunk_loss(chunk_att_vectors: Tensor, target: Tensor,
+                       weights: Optional[Tensor] = None) -> Tensor:
+            # compute log probs
+            if adaptive:
+                # only the log probs of the targets, each tail cluster is
+                # only computed for the targets in it
+                log_probs = self.decoder.output_layer.target_log_probs(
+                    chunk_att_vectors, target)
+            else:
+                log_probs = F.log_softmax(
+                    self.decoder.output_layer(chunk_att_vectors), dim=-1)
+            return loss_function(model_output=log_probs, target=target,
+                                 weights=weights)
+
+        num_positions = positions.size(0)
+        chunk_size = self.loss_chunk_size \
+            if self.loss_chunk_size > 0 else max(num_positions, 1)
+        recompute = self.loss_chunk_size > 0 and torch.is_grad_enabled() \
+            and att_vectors.requires_grad
+        # compute batch loss
+        batch_loss = att_vectors.new_zeros([])
+        for start in range(0, num_positions, chunk_size):
+            chunk = [tensor[start:start + chunk_size]
+                     for tensor in [att_vectors] + inputs]
+            if recompute:
+                batch_loss = batch_loss + checkpoint(chunk_loss, *chunk)
+            else:
+                batch_loss = batch_loss + chunk_loss(*chunk)
         # return batch loss = sum over all elements in batch that are not pad
         return batch_loss
 
     def run_batch(self, batch: Batch, max_output_length: int, beam_size: int,
-                  beam_alpha: float, return_logp: bool = False) \
+                  beam_alpha: float, return_logp: bool = False,
+                  pruning: dict = None, length_ratio: Optional[float] = None,
+                  length_offset: int = 0,
+                  shortlist: Optional[Shortlist] = None) \
             -> (np.array, np.array, Optional[np.array]):
         """
         Get outputs and attentions scores for a given batch
@@ -151,6 +218,14 @@ class Model(nn.Module):
         :param beam_size: size of the beam for beam search, if 0 use greedy
         :param beam_alpha: alpha value for beam search
         :param return_logp: keep track of log probabilities as well
+        :param pruning: pruning options for beam search (`relative_threshold`,
+            `absolute_threshold`, `max_candidates`, see `beam_search`)
+        :param length_ratio: if given, the length of each hypothesis is
+            limited to this ratio of its source length plus `length_offset`
+            (see `output_length_limits`)
+        :param length_offset: added to the length limits of `length_ratio`
+        :param shortlist: if given, only the target tokens it lists for the
+            source words of the batch are scored
         :return:
             - stacked_output: hypotheses for batch,
             - stacked_attention_scores: attention scores for batch
@@ -160,9 +235,16 @@ class Model(nn.Module):
             batch.src, batch.src_lengths,
             batch.src_mask)
 
-        # if maximum output length is not globally specified, adapt to src len
-        if max_output_length is None:
-            max_output_length = int(max(batch.src_lengths.cpu().numpy()) * 1.5)
+        # length limit of each sentence, if not globally specified (or
+        # limited by `length_ratio`), adapted to its src len
+        # (the source lengths stay on the CPU for packing)
+        max_lengths = output_length_limits(
+            batch.src_lengths, max_output_length=max_output_length,
+            ratio=length_ratio, offset=length_offset).to(
+                encoder_output.device)
+        max_output_length = int(max_lengths.max())
+        vocabulary = shortlist.vocabulary(batch.src) \
+            if shortlist is not None else None
 
         # greedy decoding
         if beam_size == 0:
@@ -171,7 +253,8 @@ class Model(nn.Module):
                 src_mask=batch.src_mask, embed=self.trg_embed,
                 bos_index=self.bos_index, decoder=self.decoder,
                 max_output_length=max_output_length, eos_index=self.eos_index,
-                return_logp=return_logp)
+                return_logp=return_logp, max_lengths=max_lengths,
+                shortlist=vocabulary)
             # batch, time, max_src_length
         else:  # beam size > 0
             stacked_output, stacked_attention_scores, logprobs = \
@@ -181,7 +264,9 @@ class Model(nn.Module):
                             max_output_length=max_output_length,
                             alpha=beam_alpha, eos_index=self.eos_index,
                             pad_index=self.pad_index, bos_index=self.bos_index,
-                            decoder=self.decoder, return_logp=return_logp)
+                            decoder=self.decoder, return_logp=return_logp,
+                            max_lengths=max_lengths, shortlist=vocabulary,
+                            **(pruning or {}))
 
         return stacked_output, stacked_attention_scores, logprobs
 
@@ -231,15 +316,45 @@ def build_model(cfg: dict = None,
             **cfg["decoder"]["embeddings"], vocab_size=len(trg_vocab),
             padding_idx=trg_padding_idx)
 
-    encoder = RecurrentEncoder(**cfg["encoder"],
-                               emb_size=src_embed.embedding_dim)
-    decoder = RecurrentDecoder(**cfg["decoder"], encoder=encoder,
-                               vocab_size=len(trg_vocab),
-                               emb_size=trg_embed.embedding_dim)
+    encoder_type = cfg["encoder"].get("type", "recurrent")
+    decoder_type = cfg["decoder"].get("type", "recurrent")
+    if encoder_type == "transformer":
+        if src_embed.embedding_dim != cfg["encoder"]["hidden_size"]:
+            raise ConfigurationError(
+                "For the Transformer, the embedding size has to be the "
+                "hidden size of the encoder.")
+        encoder = TransformerEncoder(**cfg["encoder"],
+                                     emb_size=src_embed.embedding_dim)
+    elif encoder_type == "recurrent":
+        encoder = RecurrentEncoder(**cfg["encoder"],
+                                   emb_size=src_embed.embedding_dim)
+    else:
+        raise ConfigurationError("Unknown encoder type: %s. Valid options: "
+                                 "'recurrent', 'transformer'." % encoder_type)
+    if decoder_type == "transformer":
+        if trg_embed.embedding_dim != cfg["decoder"]["hidden_size"] \
+                or encoder.output_size != cfg["decoder"]["hidden_size"]:
+            raise ConfigurationError(
+                "For the Transformer, the embedding size and the encoder "
+                "output size have to be the hidden size of the decoder.")
+        decoder = TransformerDecoder(**cfg["decoder"], encoder=encoder,
+                                     vocab_size=len(trg_vocab),
+                                     emb_size=trg_embed.embedding_dim)
+    elif decoder_type == "recurrent":
+        if encoder_type != "recurrent":
+            raise ConfigurationError(
+                "A recurrent decoder needs a recurrent encoder.")
+        decoder = RecurrentDecoder(**cfg["decoder"], encoder=encoder,
+                                   vocab_size=len(trg_vocab),
+                                   emb_size=trg_embed.embedding_dim)
+    else:
+        raise ConfigurationError("Unknown decoder type: %s. Valid options: "
+                                 "'recurrent', 'transformer'." % decoder_type)
 
     model = Model(encoder=encoder, decoder=decoder,
                   src_embed=src_embed, trg_embed=trg_embed,
-                  src_vocab=src_vocab, trg_vocab=trg_vocab)
+                  src_vocab=src_vocab, trg_vocab=trg_vocab,
+                  loss_chunk_size=cfg.get("loss_chunk_size", 0))
 
     # custom initialization of model parameters
     initialize_model(model, cfg, src_padding_idx, trg_padding_idx)
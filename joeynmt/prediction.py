@@ -4,29 +4,141 @@ This modules holds methods for generating predictions from a model.
 """
 import os
 import sys
-from typing import List, Optional
+from typing import Iterable, List, Optional, Tuple
 import numpy as np
 
 import torch
 from torchtext.data import Dataset, Field
 
-from joeynmt.helpers import bpe_postprocess, load_config, \
+from joeynmt.helpers import postprocess_sentences, load_config, \
     get_latest_checkpoint, load_checkpoint, store_attention_plots
 from joeynmt.metrics import bleu, chrf, token_accuracy, sequence_accuracy
 from joeynmt.model import build_model, Model
+from joeynmt.decoders import RecurrentDecoder
+from joeynmt.search import continuous_greedy, output_length_limits
+from joeynmt.shortlist import Shortlist
 from joeynmt.batch import Batch
 from joeynmt.data import load_data, make_data_iter, MonoDataset
 from joeynmt.constants import UNK_TOKEN, PAD_TOKEN, EOS_TOKEN
 from joeynmt.vocabulary import Vocabulary
 
 
+def sorted_batches(data: Dataset, batch_size: int, pad_index: int,
+                   use_cuda: bool, batch_type: str = "sentence") \
+        -> Iterable[Tuple[Batch, np.array]]:
+    """
+    Create the batches of a dataset one at a time, each sorted by source
+    length.
+
+    :param data: dataset
+    :param batch_size: batch size
+    :param pad_index: padding index
+    :param use_cuda: if True, move the batches to the GPU
+    :param batch_type: batch type (sentence or token)
+    :return: batches and the reverse index of their sorting
+    """
+    data_iter = make_data_iter(dataset=data, batch_size=batch_size,
+                               batch_type=batch_type, shuffle=False,
+                               train=False)
+    for torch_batch in iter(data_iter):
+        batch = Batch(torch_batch, pad_index, use_cuda=use_cuda)
+        # sort batch now by src length and keep track of order
+        sort_reverse_index = batch.sort_by_src_lengths()
+        yield batch, sort_reverse_index
+
+
+class ValidationCache:
+    """
+    Batches of a fixed dataset (e.g. the development set), prepared once for
+    repeated validations: the batches are sorted by source length and stay
+    on the device, and the sources and references are post-processed once.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, data: Dataset, batch_size: int, pad_index: int,
+                 use_cuda: bool, level: str,
+                 batch_type: str = "sentence") -> None:
+        """
+        :param data: dataset for validation
+        :param batch_size: validation batch size
+        :param pad_index: padding index
+        :param use_cuda: if True, keep the batches on the GPU
+        :param level: segmentation level, one of "char", "bpe", "word"
+        :param batch_type: validation batch type (sentence or token)
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.batch_type = batch_type
+        self.use_cuda = use_cuda
+        self.level = level
+
+        self.batches = []
+        self.sort_reverse_indices = []
+        for batch, sort_reverse_index in sorted_batches(
+                data=data, batch_size=batch_size, pad_index=pad_index,
+                use_cuda=use_cuda, batch_type=batch_type):
+            self.batches.append(batch)
+            self.sort_reverse_indices.append(sort_reverse_index)
+
+        self.sources_raw = [s for s in data.src]
+        self.sources = postprocess_sentences(self.sources_raw, level=level)
+        self.references = postprocess_sentences([t for t in data.trg],
+                                                level=level)
+
+    def matches(self, data: Dataset, batch_size: int, use_cuda: bool,
+                level: str, batch_type: str) -> bool:
+        """
+        Check whether the cached batches were built for these arguments.
+
+        :param data: dataset for validation
+        :param batch_size: validation batch size
+        :param use_cuda: if True, use CUDA
+        :param level: segmentation level
+        :param batch_type: validation batch type (sentence or token)
+        :return: True if the cache can be used
+        """
+        return self.data is data and self.batch_size == batch_size and \
+            self.use_cuda == use_cuda and self.level == level and \
+            self.batch_type == batch_type
+
+
+def encode_sentences(model: Model,
+                     batches: Iterable[Tuple[Batch, np.array]]) \
+        -> Iterable[Tuple[int, torch.Tensor, torch.Tensor]]:
+    """
+    Encode the sentences of sorted batches one batch at a time, when they
+    are needed (see `continuous_greedy`).
+
+    :param model: model module
+    :param batches: batches sorted by source length and the reverse index
+        of their sorting (see `sorted_batches`)
+    :return: index of the sentence in the data, its encoder states and its
+        last encoder state, in the original order of the data
+    """
+    offset = 0
+    for batch, sort_reverse_index in batches:
+        encoder_output, encoder_hidden = model.encode(
+            batch.src, batch.src_lengths, batch.src_mask)
+        src_lengths = batch.src_lengths.tolist()
+        for i, j in enumerate(sort_reverse_index.tolist()):
+            yield offset + i, encoder_output[j, :src_lengths[j]], \
+                encoder_hidden[j]
+        offset += batch.nseqs
+
+
 # pylint: disable=too-many-arguments,too-many-locals,no-member
 def validate_on_data(model: Model, data: Dataset, batch_size: int,
                      use_cuda: bool, max_output_length: int,
                      level: str, eval_metric: Optional[str],
                      loss_function: torch.nn.Module = None,
                      beam_size: int = 0, beam_alpha: int = -1,
-                     return_logp: bool = False) \
+                     return_logp: bool = False,
+                     batch_type: str = "sentence",
+                     cache: ValidationCache = None,
+                     num_slots: int = 0, pruning: dict = None,
+                     length_ratio: Optional[float] = None,
+                     length_offset: int = 0,
+                     shortlist: Optional[Shortlist] = None) \
         -> (float, float, float, List[str], List[List[str]], List[str],
             List[str], List[List[str]], List[np.array], Optional[np.array]):
     """
@@ -48,6 +160,23 @@ def validate_on_data(model: Model, data: Dataset, batch_size: int,
     :param beam_alpha: beam search alpha for length penalty,
         disabled if set to -1 (default).
     :param return_logp: keep track of log probabilities of hypotheses as well
+    :param batch_type: validation batch type (sentence or token)
+    :param cache: batches, sources and references of `data` prepared by an
+        earlier validation (rebuilt if it was built for other arguments),
+        if None the batches are created one at a time
+    :param num_slots: if > 0, greedy decoding keeps this many sentences in
+        the decoder and replaces finished ones with the next sentences
+        (continuous batching, see `continuous_greedy`), instead of decoding
+        one batch after the other (only with a recurrent decoder)
+    :param pruning: pruning options for beam search (`relative_threshold`,
+        `absolute_threshold`, `max_candidates`, see `beam_search`)
+    :param length_ratio: if given, the length of each hypothesis is limited
+        to this ratio of its source length plus `length_offset` (and to
+        `max_output_length`, see `output_length_limits`)
+    :param length_offset: added to the length limits of `length_ratio`
+    :param shortlist: if given, only the target tokens it lists for the
+        source words of a batch are scored (decoding is batch by batch then,
+        even with `num_slots`)
 
     :return:
         - current_valid_score: current validation score [eval_metric],
@@ -61,26 +190,40 @@ def validate_on_data(model: Model, data: Dataset, batch_size: int,
         - valid_attention_scores: attention scores for validation hypotheses
         - valid_logprobs: log probabilities of validation hypotheses
     """
-    valid_iter = make_data_iter(dataset=data, batch_size=batch_size,
-                                shuffle=False, train=False)
-    valid_sources_raw = [s for s in data.src]
     pad_index = model.src_vocab.stoi[PAD_TOKEN]
+    if cache is not None and not cache.matches(
+            data=data, batch_size=batch_size, use_cuda=use_cuda, level=level,
+            batch_type=batch_type):
+        cache = ValidationCache(data=data, batch_size=batch_size,
+                                pad_index=pad_index, use_cuda=use_cuda,
+                                level=level, batch_type=batch_type)
+
+    def batches() -> Iterable[Tuple[Batch, np.array]]:
+        # without a cache, e.g. for test data, only one batch at a time is
+        # kept in memory
+        if cache is not None:
+            return zip(cache.batches, cache.sort_reverse_indices)
+        return sorted_batches(data=data, batch_size=batch_size,
+                              pad_index=pad_index, use_cuda=use_cuda,
+                              batch_type=batch_type)
+
+    valid_sources_raw = cache.sources_raw if cache is not None \
+        else [s for s in data.src]
+    # the slots of continuous batching do not share one shortlist, and
+    # they are at different target positions, which the self-attention
+    # cache of the Transformer decoder does not support
+    continuous = num_slots > 0 and beam_size == 0 and shortlist is None \
+        and isinstance(model.decoder, RecurrentDecoder)
     # disable dropout
     model.eval()
     # don't track gradients during validation
     with torch.no_grad():
-        all_outputs = []
+        decoded_valid = []
         valid_logprobs = []
         valid_attention_scores = []
         total_loss = 0
         total_ntokens = 0
-        for valid_batch in iter(valid_iter):
-            # run as during training to get validation loss (e.g. xent)
-
-            batch = Batch(valid_batch, pad_index, use_cuda=use_cuda)
-            # sort batch now by src length and keep track of order
-            sort_reverse_index = batch.sort_by_src_lengths()
-
+        for batch, sort_reverse_index in batches():
             # run as during training with teacher forcing
             if loss_function is not None and batch.trg is not None:
                 batch_loss = model.get_loss_for_batch(
@@ -88,20 +231,38 @@ def validate_on_data(model: Model, data: Dataset, batch_size: int,
                 total_loss += batch_loss
                 total_ntokens += batch.ntokens
 
+            if continuous:
+                continue
+
             # run as during inference to produce translations
             output, attention_scores, logprobs = model.run_batch(
                 batch=batch, beam_size=beam_size, beam_alpha=beam_alpha,
-                max_output_length=max_output_length, return_logp=return_logp)
+                max_output_length=max_output_length, return_logp=return_logp,
+                pruning=pruning, length_ratio=length_ratio,
+                length_offset=length_offset, shortlist=shortlist)
 
-            # sort outputs back to original order
-            all_outputs.extend(output[sort_reverse_index])
+            # sort outputs back to original order and decode back to symbols
+            decoded_valid.extend(model.trg_vocab.arrays_to_sentences(
+                arrays=output[sort_reverse_index], cut_at_eos=True))
             if logprobs is not None:
                 valid_logprobs.extend(logprobs[sort_reverse_index])
             valid_attention_scores.extend(
                 attention_scores[sort_reverse_index]
                 if attention_scores is not None else [])
 
-        assert len(all_outputs) == len(data)
+        if continuous:
+            output, valid_attention_scores, logprobs = continuous_greedy(
+                encoded=encode_sentences(model, batches()),
+                num_slots=num_slots, embed=model.trg_embed,
+                bos_index=model.bos_index, eos_index=model.eos_index,
+                decoder=model.decoder, max_output_length=max_output_length,
+                return_logp=return_logp, length_ratio=length_ratio,
+                length_offset=length_offset)
+            decoded_valid = model.trg_vocab.arrays_to_sentences(
+                arrays=output, cut_at_eos=True)
+            valid_logprobs = list(logprobs) if logprobs is not None else []
+
+        assert len(decoded_valid) == len(data)
 
         if loss_function is not None and total_ntokens > 0:
             # total validation loss
@@ -112,23 +273,16 @@ def validate_on_data(model: Model, data: Dataset, batch_size: int,
             valid_loss = -1
             valid_ppl = -1
 
-        # decode back to symbols
-        decoded_valid = model.trg_vocab.arrays_to_sentences(arrays=all_outputs,
-                                                            cut_at_eos=True)
-
-        # evaluate with metric on full dataset
-        join_char = " " if level in ["word", "bpe"] else ""
-        valid_sources = [join_char.join(s) for s in data.src]
-        valid_references = [join_char.join(t) for t in data.trg]
-        valid_hypotheses = [join_char.join(t) for t in decoded_valid]
-
-        # post-process
-        if level == "bpe":
-            valid_sources = [bpe_postprocess(s) for s in valid_sources]
-            valid_references = [bpe_postprocess(v)
-                                for v in valid_references]
-            valid_hypotheses = [bpe_postprocess(v) for
-                                v in valid_hypotheses]
+        # post-process for evaluation with metric on full dataset
+        if cache is not None:
+            valid_sources = cache.sources
+            valid_references = cache.references
+        else:
+            valid_sources = postprocess_sentences(valid_sources_raw,
+                                                  level=level)
+            valid_references = postprocess_sentences([t for t in data.trg],
+                                                     level=level)
+        valid_hypotheses = postprocess_sentences(decoded_valid, level=level)
 
         # if references are given, evaluate against them
         if valid_references:
@@ -154,6 +308,31 @@ def validate_on_data(model: Model, data: Dataset, batch_size: int,
         decoded_valid, valid_attention_scores, valid_logprobs
 
 
+def count_length_limit_hits(sources_raw: List[List[str]],
+                            hypotheses_raw: List[List[str]],
+                            max_output_length: Optional[int],
+                            length_ratio: Optional[float] = None,
+                            length_offset: int = 0) -> int:
+    """
+    Count the hypotheses that were stopped at their maximum length instead
+    of ending with </s>.
+
+    :param sources_raw: tokenized sources
+    :param hypotheses_raw: tokenized hypotheses, cut at </s>
+    :param max_output_length: maximum length for generated hypotheses
+    :param length_ratio: ratio of the length limits to the source lengths
+    :param length_offset: added to the length limits of `length_ratio`
+    :return: number of hypotheses that reached their length limit
+    """
+    # sources end with </s> in the model
+    limits = output_length_limits(
+        torch.tensor([len(src) + 1 for src in sources_raw]),
+        max_output_length=max_output_length, ratio=length_ratio,
+        offset=length_offset).tolist()
+    return sum(len(hyp) >= limit
+               for hyp, limit in zip(hypotheses_raw, limits))
+
+
 def test(cfg_file,
          ckpt: str,
          output_path: str = None,
@@ -186,10 +365,13 @@ def test(cfg_file,
             step = "best"
 
     batch_size = cfg["training"]["batch_size"]
+    batch_type = cfg["training"].get("batch_type", "sentence")
     use_cuda = cfg["training"].get("use_cuda", False)
     level = cfg["data"]["level"]
     eval_metric = cfg["training"]["eval_metric"]
     max_output_length = cfg["training"].get("max_output_length", None)
+    length_ratio = cfg["training"].get("max_output_length_ratio", None)
+    length_offset = cfg["training"].get("max_output_length_offset", 0)
 
     # load the data
     _, dev_data, test_data, src_vocab, trg_vocab = load_data(
@@ -211,9 +393,18 @@ def test(cfg_file,
     if "testing" in cfg.keys():
         beam_size = cfg["testing"].get("beam_size", 0)
         beam_alpha = cfg["testing"].get("alpha", -1)
+        num_slots = cfg["testing"].get("num_slots", 0)
+        pruning = cfg["testing"].get("pruning", {})
+        shortlist_path = cfg["testing"].get("shortlist", None)
     else:
         beam_size = 0
         beam_alpha = -1
+        num_slots = 0
+        pruning = {}
+        shortlist_path = None
+    shortlist = Shortlist.load(shortlist_path, src_vocab=src_vocab,
+                               trg_vocab=trg_vocab) \
+        if shortlist_path is not None else None
 
     for data_set_name, data_set in data_to_predict.items():
         if data_set is None:
@@ -223,10 +414,13 @@ def test(cfg_file,
         #pylint: disable=unused-variable
         score, loss, ppl, sources, sources_raw, references, hypotheses, \
         hypotheses_raw, attention_scores, logprobs = validate_on_data(
-            model, data=data_set, batch_size=batch_size, level=level,
+            model, data=data_set, batch_size=batch_size,
+            batch_type=batch_type, level=level,
             max_output_length=max_output_length, eval_metric=eval_metric,
             use_cuda=use_cuda, loss_function=None, beam_size=beam_size,
-            beam_alpha=beam_alpha)
+            beam_alpha=beam_alpha, num_slots=num_slots, pruning=pruning,
+            length_ratio=length_ratio, length_offset=length_offset,
+            shortlist=shortlist)
         #pylint: enable=unused-variable
 
         if "trg" in data_set.fields:
@@ -238,6 +432,12 @@ def test(cfg_file,
         else:
             print("No references given for {} -> no evaluation.".format(
                 data_set_name))
+        print("{:4s}: {} of {} hypotheses reached their maximum length".format(
+            data_set_name, count_length_limit_hits(
+                sources_raw, hypotheses_raw,
+                max_output_length=max_output_length,
+                length_ratio=length_ratio, length_offset=length_offset),
+            len(hypotheses_raw)))
 
         if attention_scores is not None and save_attention:
             attention_path = "{}/{}.{}.att".format(model_dir, data_set_name,
@@ -297,10 +497,13 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
         # pylint: disable=unused-variable
         score, loss, ppl, sources, sources_raw, references, hypotheses, \
         hypotheses_raw, attention_scores, log_probs = validate_on_data(
-            model, data=test_data, batch_size=batch_size, level=level,
+            model, data=test_data, batch_size=batch_size,
+            batch_type=batch_type, level=level,
             max_output_length=max_output_length, eval_metric="",
             use_cuda=use_cuda, loss_function=None, beam_size=beam_size,
-            beam_alpha=beam_alpha, return_logp=return_logp)
+            beam_alpha=beam_alpha, return_logp=return_logp,
+            num_slots=num_slots, pruning=pruning, length_ratio=length_ratio,
+            length_offset=length_offset, shortlist=shortlist)
         return hypotheses, hypotheses_raw
 
     cfg = load_config(cfg_file)
@@ -311,9 +514,12 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
         ckpt = get_latest_checkpoint(model_dir)
 
     batch_size = cfg["training"].get("batch_size", 1)
+    batch_type = cfg["training"].get("batch_type", "sentence")
     use_cuda = cfg["training"].get("use_cuda", False)
     level = cfg["data"]["level"]
     max_output_length = cfg["training"].get("max_output_length", None)
+    length_ratio = cfg["training"].get("max_output_length_ratio", None)
+    length_offset = cfg["training"].get("max_output_length_offset", 0)
 
     # read vocabs
     src_vocab_file = cfg["training"].get(
@@ -351,10 +557,19 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
         beam_size = cfg["testing"].get("beam_size", 0)
         beam_alpha = cfg["testing"].get("alpha", -1)
         return_logp = cfg["testing"].get("return_logp", False)
+        num_slots = cfg["testing"].get("num_slots", 0)
+        pruning = cfg["testing"].get("pruning", {})
+        shortlist_path = cfg["testing"].get("shortlist", None)
     else:
         beam_size = 0
         beam_alpha = -1
         return_logp = False
+        num_slots = 0
+        pruning = {}
+        shortlist_path = None
+    shortlist = Shortlist.load(shortlist_path, src_vocab=src_vocab,
+                               trg_vocab=trg_vocab) \
+        if shortlist_path is not None else None
 
     if not sys.stdin.isatty():
         # file given
@@ -378,6 +593,7 @@ def translate(cfg_file, ckpt: str, output_path: str = None) -> None:
     else:
         # enter interactive mode
         batch_size = 1
+        batch_type = "sentence"
         while True:
             try:
                 src_input = input("\nPlease enter a source sentence "
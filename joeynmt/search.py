@@ -1,24 +1,111 @@
 # coding: utf-8
-from typing import Optional
+import itertools
+import math
+from typing import Callable, Iterable, List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
 from torch import Tensor
 import numpy as np
 
-from joeynmt.helpers import tile
+from joeynmt.adaptive_softmax import AdaptiveSoftmax
+from joeynmt.helpers import pad_to_length, ConfigurationError
 from joeynmt.decoders import Decoder
 from joeynmt.embeddings import Embeddings
 
 
+def output_length_limits(src_lengths: Tensor,
+                         max_output_length: Optional[int] = None,
+                         ratio: Optional[float] = None,
+                         offset: int = 0) -> Tensor:
+    """
+    Maximum output length of each sentence: `ratio` times its source length
+    plus `offset`, at most `max_output_length`. If `ratio` is None, all
+    sentences get `max_output_length`, or 1.5 times their source length
+    (plus `offset`) if that is None as well.
+
+    :param src_lengths: source lengths
+    :param max_output_length: maximum output length of all sentences
+    :param ratio: maximum ratio of output to source length
+    :param offset: added to the length limit given by `ratio`
+    :return: length limits, same shape as `src_lengths`, at least 1
+    """
+    if ratio is None:
+        if max_output_length is not None:
+            return torch.full_like(src_lengths, max_output_length)
+        ratio = 1.5
+    limits = (src_lengths.float() * ratio + offset).long().clamp(min=1)
+    if max_output_length is not None:
+        limits = limits.clamp(max=max_output_length)
+    return limits
+
+
+def shortlist_output_layer(decoder: Decoder, shortlist: Tensor) \
+        -> Callable[[Tensor], Tensor]:
+    """
+    Output layer of the decoder that only computes the logits of the target
+    tokens in the shortlist, for `decoder.step`. Its weights are selected
+    once, so that every decoding step only multiplies with them.
+
+    :param decoder: decoder with an output layer without bias
+    :param shortlist: target token indices (see `Shortlist.vocabulary`)
+    :return: output layer, logits shape (..., len(shortlist))
+    """
+    if isinstance(decoder.output_layer, AdaptiveSoftmax):
+        raise ConfigurationError(
+            "A shortlist cannot be used with an adaptive softmax.")
+    weight = decoder.output_layer.weight.index_select(0, shortlist)
+    return lambda att_vector: F.linear(att_vector, weight)
+
+
+def adaptive_softmax_topk(decoder: Decoder) \
+        -> Optional[Callable[[Tensor, int], Tuple[Tensor, Tensor]]]:
+    """
+    The top-k function of the adaptive softmax of the decoder, if it has
+    one. `decoder.step` then has to return the attention vectors (see
+    `identity`) instead of the log probabilities of all tokens.
+
+    :param decoder: decoder
+    :return: `AdaptiveSoftmax.topk` of the output layer, or None
+    """
+    if isinstance(decoder.output_layer, AdaptiveSoftmax):
+        return decoder.output_layer.topk
+    return None
+
+
+def identity(att_vector: Tensor) -> Tensor:
+    """
+    Output layer for `decoder.step` that returns the attention vectors.
+
+    :param att_vector: attention vectors
+    :return: the same attention vectors
+    """
+    return att_vector
+
+
+# pylint: disable=too-many-locals
 def greedy(src_mask: Tensor, embed: Embeddings, bos_index: int, eos_index: int,
            max_output_length: int, decoder: Decoder,
            encoder_output: Tensor, encoder_hidden: Tensor,
-           return_logp: bool = False)\
+           return_logp: bool = False, stop_check_interval: int = 5,
+           max_lengths: Optional[Tensor] = None,
+           shortlist: Optional[Tensor] = None)\
         -> (np.array, np.array, Optional[np.array]):
     """
     Greedy decoding: in each step, choose the word that gets highest score.
 
+    Outputs, attention scores and the finished state are kept on the device
+    of the model and are copied to the host once after decoding.
+    Every `stop_check_interval` steps (the check waits for the device),
+    finished hypotheses are removed from the decoder state (hidden states,
+    encoder outputs, source mask and projected attention keys), so that the
+    decoder only runs on the unfinished ones, as in `beam_search`. Decoding
+    stops when all hypotheses are finished. Positions after </s> are filled
+    with </s>. Hypotheses that reach their length limit (`max_lengths`) are
+    removed in the same step. With a `shortlist`, only the listed target
+    tokens are scored. With an adaptive softmax, only the tail clusters
+    that can contain the best token are scored (see `AdaptiveSoftmax.topk`).
+
     :param src_mask: mask for source inputs, 0 for positions after </s>
     :param embed: target embedding
     :param bos_index: index of <s> in the vocabulary
@@ -29,257 +116,623 @@ def greedy(src_mask: Tensor, embed: Embeddings, bos_index: int, eos_index: int,
     :param encoder_hidden: encoder last state for decoder initialization
     :param return_logp: return log probability of output as well,
         excluding predictions after </s>
+    :param stop_check_interval: remove finished hypotheses every this many
+        steps
+    :param max_lengths: maximum length of each hypothesis (at most
+        `max_output_length`), if None `max_output_length` for all
+    :param shortlist: if given, the target token indices that can be
+        produced (see `Shortlist.vocabulary`), log probabilities are
+        normalized over them
     :return:
         - stacked_output: output hypotheses (2d array of indices),
         - stacked_attention_scores: attention scores (3d array)
         - log_probs: log probabilities of hypotheses (vector, optional)
     """
     batch_size = src_mask.size(0)
+    device = src_mask.device
     prev_y = src_mask.new_full(size=[batch_size, 1], fill_value=bos_index,
                                dtype=torch.long)
-    output = []
-    attention_scores = []
-    log_probs = np.zeros(batch_size)
-    hidden = None
-    prev_att_vector = None
-    end = np.zeros(batch_size)
-
-    # pylint: disable=unused-variable
+    output = torch.full([batch_size, max_output_length], eos_index,
+                        dtype=torch.long, device=device)
+    attention_scores = encoder_output.new_zeros(
+        [batch_size, max_output_length, encoder_output.size(1)])
+    log_probs = torch.zeros(batch_size, device=device)
+
+    # the projected keys are computed once and shrink with the batch
+    state = decoder.init_state(encoder_output=encoder_output,
+                               encoder_hidden=encoder_hidden,
+                               src_mask=src_mask)
+
+    # original batch positions of the unfinished hypotheses
+    active = torch.arange(batch_size, device=device)
+    # hypotheses that produced </s> since the last removal
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    if max_lengths is None:
+        max_lengths = torch.full([batch_size], max_output_length,
+                                 dtype=torch.long, device=device)
+    else:
+        max_lengths = max_lengths.to(device)
+    # steps after which hypotheses reach their limit and are removed
+    limit_steps = set(max_lengths.tolist())
+    output_layer = shortlist_output_layer(decoder, shortlist) \
+        if shortlist is not None else None
+    topk = adaptive_softmax_topk(decoder)
+    if topk is not None:
+        output_layer = identity
+
     for t in range(max_output_length):
         # decode one single step
-        out, hidden, att_probs, prev_att_vector = decoder(
-            encoder_output=encoder_output,
-            encoder_hidden=encoder_hidden,
-            src_mask=src_mask,
-            trg_embed=embed(prev_y),
-            hidden=hidden,
-            prev_att_vector=prev_att_vector,
-            unrol_steps=1)
+        out, state, att_probs = decoder.step(prev_embed=embed(prev_y),
+                                             state=state,
+                                             output_layer=output_layer)
         # out: batch x time=1 x vocab (logits)
 
         # greedy decoding: choose arg max over vocabulary in each step
-        next_word = torch.argmax(out, dim=-1)  # batch x time=1
-        pred = next_word.squeeze(1).cpu().numpy()
-        output.append(pred)
+        if topk is not None:
+            selected_log_prob, next_word = topk(out.squeeze(1), 1)
+            selected_log_prob = selected_log_prob.squeeze(1)
+        else:
+            next_word = torch.argmax(out, dim=-1)  # batch x time=1
+            if return_logp:
+                log_prob = F.log_softmax(out, dim=2).squeeze(1)
+                selected_log_prob = log_prob.gather(1, next_word).squeeze(1)
+        if shortlist is not None:
+            next_word = shortlist[next_word]
         prev_y = next_word
-        attention_scores.append(att_probs.squeeze(1).cpu().numpy())
-        end += (pred == eos_index)  # check if eos reached
+        next_word = next_word.squeeze(1).masked_fill(finished, eos_index)
+        output[active, t] = next_word
+        attention_scores[active, t] = att_probs.squeeze(1)
+        finished = finished | next_word.eq(eos_index)
 
         if return_logp:
-            end_mask = end < 1  # True for tokens up till eos (incl), then False
-            log_prob = F.log_softmax(out, dim=2).squeeze(1)
-            selected_log_prob = log_prob.index_select(
-                1, next_word.squeeze())[:, 0].cpu().numpy()
-            log_probs += end_mask*selected_log_prob
-
-        # stop when all hyps in batch reach eos
-        if (end > 1).sum() >= batch_size:
+            # only tokens before </s>
+            log_probs[active] += (~finished).type_as(log_probs) \
+                * selected_log_prob
+        finished = finished | max_lengths.le(t + 1)
+
+        if (t + 1) % stop_check_interval == 0 or t + 1 in limit_steps:
+            unfinished = (~finished).nonzero().view(-1)
+            # stop when all hyps in batch reach eos
+            if unfinished.numel() == 0:
+                break
+            if unfinished.numel() < finished.numel():
+                active = active.index_select(0, unfinished)
+                finished = finished.index_select(0, unfinished)
+                max_lengths = max_lengths.index_select(0, unfinished)
+                prev_y = prev_y.index_select(0, unfinished)
+                state = state.index_select(unfinished)
+
+    stacked_output = output.cpu().numpy()  # batch, time
+    # cut after the last </s> that ends a hypothesis
+    is_eos = stacked_output == eos_index
+    lengths = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1) + 1,
+                       max_output_length)
+    length = int(lengths.max()) if batch_size > 0 else 0
+    stacked_output = stacked_output[:, :length]
+    stacked_attention_scores = attention_scores[:, :length].cpu().numpy()
+    return stacked_output, stacked_attention_scores, \
+        log_probs.cpu().numpy()
+
+
+# pylint: disable=too-many-locals,too-many-statements,too-many-branches
+def continuous_greedy(encoded: Iterable[Tuple[int, Tensor, Tensor]],
+                      num_slots: int, embed: Embeddings, bos_index: int,
+                      eos_index: int, decoder: Decoder,
+                      max_output_length: Optional[int] = None,
+                      return_logp: bool = False,
+                      length_ratio: Optional[float] = None,
+                      length_offset: int = 0) \
+        -> (List[np.array], List[np.array], Optional[np.array]):
+    """
+    Greedy decoding with continuous batching: the decoder runs on a fixed
+    number of slots, each holding one sentence. As soon as the hypothesis
+    of a slot ends, the next source sentence is taken from `encoded` and
+    decoded in that slot, so that the batch does not wait for its slowest
+    sentence. Once all sentences are taken, finished slots are removed.
+
+    Checking for finished slots waits for the device in every step.
+
+    :param encoded: sentences as tuples of their index, encoder states
+        (src_length x encoder.output_size) and last encoder state
+        (encoder.output_size), with indices 0 to N-1. Iterated lazily.
+    :param num_slots: number of sentences that are decoded together
+    :param embed: target embedding
+    :param bos_index: index of <s> in the vocabulary
+    :param eos_index: index of </s> in the vocabulary
+    :param decoder: recurrent decoder to use for greedy decoding
+    :param max_output_length: maximum length for the hypotheses,
+        if None 1.5 times the source length (per sentence)
+    :param return_logp: return log probability of output as well,
+        excluding </s>
+    :param length_ratio: if given, the length of a hypothesis is limited to
+        this ratio of its source length plus `length_offset` (see
+        `output_length_limits`)
+    :param length_offset: added to the length limit given by `length_ratio`
+    :return:
+        - outputs: output hypotheses (one array of indices per sentence,
+          ending with </s> if it was produced), ordered by index,
+        - attention_scores: attention scores (one 2d array per sentence)
+        - log_probs: log probabilities of hypotheses (vector, optional)
+    """
+    sentences = iter(encoded)
+    first = next(sentences, None)
+    if first is None:
+        return [], [], np.zeros(0) if return_logp else None
+    sentences = itertools.chain([first], sentences)
+    _, first_output, first_hidden = first
+    device = first_output.device
+
+    # state of the slots, empty slots attend to the first source position
+    slot_ids = [None] * num_slots  # sentence index per slot
+    state = decoder.init_state(
+        encoder_output=first_output.new_zeros(
+            [num_slots, 1, first_output.size(-1)]),
+        encoder_hidden=first_hidden.new_zeros(
+            [num_slots, first_hidden.size(-1)]),
+        src_mask=torch.ones([num_slots, 1, 1], dtype=torch.bool,
+                            device=device))
+    prev_y = torch.full([num_slots, 1], bos_index, dtype=torch.long,
+                        device=device)
+
+    # outputs of the slots, written at each slot's own position
+    steps = torch.zeros(num_slots, dtype=torch.long, device=device)
+    limits = torch.zeros(num_slots, dtype=torch.long, device=device)
+    output = torch.full([num_slots, 1], eos_index, dtype=torch.long,
+                        device=device)
+    attention = first_output.new_zeros([num_slots, 1, 1])
+    log_probs = torch.zeros(num_slots, device=device)
+    src_lengths = [0] * num_slots
+
+    topk = adaptive_softmax_topk(decoder)
+    results = {}
+    exhausted = False
+    while True:
+        # fill the empty slots with new sentences
+        free = [slot for slot, i in enumerate(slot_ids) if i is None]
+        new = list(itertools.islice(sentences, len(free))) \
+            if free and not exhausted else []
+        if len(new) < len(free):
+            exhausted = True
+        if new:
+            slots = torch.tensor(free[:len(new)], device=device)
+            lengths = [e.size(0) for _, e, _ in new]
+            src_len = max(lengths)
+            limit = output_length_limits(
+                torch.tensor(lengths), max_output_length=max_output_length,
+                ratio=length_ratio, offset=length_offset).tolist()
+            state = state.index_copy(slots, decoder.init_state(
+                encoder_output=torch.stack([pad_to_length(e, 0, src_len)
+                                            for _, e, _ in new]),
+                encoder_hidden=torch.stack([h for _, _, h in new]),
+                src_mask=(torch.arange(src_len, device=device)[None, :]
+                          < torch.tensor(lengths, device=device)[:, None]
+                          ).unsqueeze(1)))
+            prev_y[slots] = bos_index
+            steps[slots] = 0
+            limits[slots] = torch.tensor(limit, device=device)
+            output = pad_to_length(output, 1, max(limit), eos_index)
+            output[slots] = eos_index
+            attention = pad_to_length(pad_to_length(
+                attention, 2, state.src_mask.size(2)), 1, output.size(1))
+            attention[slots] = 0
+            log_probs[slots] = 0
+            for slot, (i, _, _), length in zip(free, new, lengths):
+                slot_ids[slot] = i
+                src_lengths[slot] = length
+
+        # remove the empty slots once all sentences are taken
+        occupied = [slot for slot, i in enumerate(slot_ids) if i is not None]
+        if not occupied:
             break
-        # batch, max_src_lengths
-    stacked_output = np.stack(output, axis=1)  # batch, time
-    stacked_attention_scores = np.stack(attention_scores, axis=1)
-    return stacked_output, stacked_attention_scores, log_probs
+        if exhausted and len(occupied) < len(slot_ids):
+            index = torch.tensor(occupied, device=device)
+            slot_ids = [slot_ids[slot] for slot in occupied]
+            src_lengths = [src_lengths[slot] for slot in occupied]
+            state = state.index_select(index)
+            prev_y = prev_y.index_select(0, index)
+            steps = steps.index_select(0, index)
+            limits = limits.index_select(0, index)
+            output = output.index_select(0, index)
+            attention = attention.index_select(0, index)
+            log_probs = log_probs.index_select(0, index)
+
+        # decode one single step in all slots
+        out, state, att_probs = decoder.step(
+            prev_embed=embed(prev_y), state=state,
+            output_layer=identity if topk is not None else None)
+        if topk is not None:
+            selected_log_prob, prev_y = topk(out.squeeze(1), 1)
+        else:
+            prev_y = torch.argmax(out, dim=-1)  # slots x time=1
+            if return_logp:
+                selected_log_prob = F.log_softmax(out, dim=2).squeeze(
+                    1).gather(1, prev_y)
+        next_word = prev_y.squeeze(1)
+        rows = torch.arange(len(slot_ids), device=device)
+        output[rows, steps] = next_word
+        attention[rows, steps] = att_probs.squeeze(1)
+        is_eos = next_word.eq(eos_index)
+        if return_logp:
+            log_probs += (~is_eos).type_as(log_probs) \
+                * selected_log_prob.squeeze(1)
+        steps += 1
+        finished = is_eos | (steps >= limits)
+
+        # hand out the finished hypotheses and free their slots
+        finished_slots = [slot for slot in finished.nonzero().view(-1).tolist()
+                          if slot_ids[slot] is not None]
+        if finished_slots:
+            index = torch.tensor(finished_slots, device=device)
+            finished_steps = steps[index].tolist()
+            finished_output = output[index].cpu().numpy()
+            finished_attention = attention[index].cpu().numpy()
+            finished_log_probs = log_probs[index].tolist()
+            for k, slot in enumerate(finished_slots):
+                results[slot_ids[slot]] = (
+                    finished_output[k, :finished_steps[k]],
+                    finished_attention[k, :finished_steps[k],
+                                       :src_lengths[slot]],
+                    finished_log_probs[k])
+                slot_ids[slot] = None
+        # restart the position of finished and empty slots
+        steps.masked_fill_(finished, 0)
+
+    ordered = [results[i] for i in range(len(results))]
+    outputs = [result[0] for result in ordered]
+    attention_scores = [result[1] for result in ordered]
+    if return_logp:
+        return outputs, attention_scores, \
+            np.array([result[2] for result in ordered])
+    return outputs, attention_scores, None
 
 
-# pylint: disable=too-many-statements, too-many-arguments
+# pylint: disable=too-many-statements, too-many-arguments, too-many-locals
 def beam_search(decoder: Decoder, size: int, bos_index: int, eos_index: int,
                 pad_index: int, encoder_output: Tensor,
                 encoder_hidden: Tensor, src_mask: Tensor,
                 max_output_length: int, alpha: float, embed: Embeddings,
-                n_best: int = 1, return_logp: bool = False) \
+                n_best: int = 1, return_logp: bool = False,
+                relative_threshold: float = 0.,
+                absolute_threshold: float = 0.,
+                max_candidates: int = 0,
+                max_lengths: Optional[Tensor] = None,
+                shortlist: Optional[Tensor] = None) \
         -> (np.array, np.array, Optional[np.array]):
     """
-    Beam search with size k. Follows OpenNMT-py implementation.
+    Beam search with size k.
     In each decoding step, find the k most likely partial hypotheses.
 
-    :param decoder:
+    All hypotheses of the batch are handled together in tensors: in each
+    step, the 2k best expansions of every batch entry are computed, the ones
+    that end with </s> are merged into the n best finished hypotheses of
+    the entry, and the k best of the others are continued. A batch entry is
+    done when its best expansion ends with </s> and n hypotheses have
+    finished, or at its length limit, and is then removed from the batch.
+
+    The words and attention scores of each step are written into buffers
+    for `max_output_length` steps, together with the beam position of the
+    previous hypothesis (backpointer), and the finished hypotheses are only
+    built from them at the end, so that decoding does not copy the
+    hypotheses in every step. The encoder states are kept once per batch
+    entry and shared by its beam (see `RecurrentDecoderState`).
+
+    Expansions are pruned (not continued) if they cannot get a better score
+    than the n-th best finished hypothesis any more: log probabilities only
+    decrease with more words, so the score of a hypothesis is bounded by its
+    log probability divided by the largest length penalty it can still get.
+    Optionally, expansions are also pruned if they are much worse than the
+    best expansion of the batch entry (`relative_threshold`,
+    `absolute_threshold`) or if too many expansions continue the same
+    hypothesis (`max_candidates`), as in Freitag and Al-Onaizan (2017):
+    Beam Search Strategies for Neural Machine Translation.
+    Until n hypotheses have finished, the best expansion that does not end
+    is never pruned by these options.
+    A batch entry is also done when all its expansions are pruned, and the
+    beam only holds as many hypotheses as the batch entry with most
+    hypotheses left needs. With a `shortlist`, only the listed target tokens
+    are scored. With an adaptive softmax, only the 2k best expansions of
+    each hypothesis are computed (see `AdaptiveSoftmax.topk`), since the 2k
+    best expansions of the batch entry are among them.
+
+    :param decoder: decoder to use for beam search
     :param size: size of the beam
-    :param bos_index:
-    :param eos_index:
-    :param pad_index:
-    :param encoder_output:
-    :param encoder_hidden:
-    :param src_mask:
-    :param max_output_length:
+    :param bos_index: index of <s> in the vocabulary
+    :param eos_index: index of </s> in the vocabulary
+    :param pad_index: index of <pad> in the vocabulary
+    :param encoder_output: encoder hidden states for attention
+    :param encoder_hidden: encoder last state for decoder initialization
+    :param src_mask: mask for source inputs, 0 for positions after </s>
+    :param max_output_length: maximum length for the hypotheses
     :param alpha: `alpha` factor for length penalty
-    :param embed:
+    :param embed: target embedding
     :param n_best: return this many hypotheses, <= beam
-    :param return_logp: return the log probabilities as well
+    :param return_logp: return the scores (log probabilities divided by
+        the length penalty) as well
+    :param relative_threshold: if > 0, prune expansions with a probability
+        below `relative_threshold` times the probability of the best
+        expansion
+    :param absolute_threshold: if > 0, prune expansions with a score more
+        than `absolute_threshold` below the score of the best expansion
+    :param max_candidates: if > 0, continue at most this many expansions of
+        the same hypothesis
+    :param max_lengths: maximum length of the hypotheses of each batch entry
+        (at most `max_output_length`), if None `max_output_length` for all
+    :param shortlist: if given, the target token indices that can be
+        produced (see `Shortlist.vocabulary`), log probabilities are
+        normalized over them
     :return:
-        - stacked_output: output hypotheses (2d array of indices),
+        - stacked_output: output hypotheses (2d array of indices, the n_best
+          hypotheses of each sentence in consecutive rows, best first),
         - stacked_attention_scores: attention scores (3d array)
-        - log_probs: hypotheses log probs of hypotheses (vector)
+        - log_probs: scores of the hypotheses (vector, optional)
     """
+    assert n_best <= size, "Can only return up to beam size hypotheses."
     # init
     batch_size = src_mask.size(0)
-    # pylint: disable=protected-access
-    hidden = decoder._init_hidden(encoder_hidden)
-
-    # tile hidden decoder states and encoder output beam_size times
-    hidden = tile(hidden, size, dim=1)  # layers x batch*k x dec_hidden_size
-    att_vectors = None
-
-    encoder_output = tile(encoder_output.contiguous(), size,
-                          dim=0)  # batch*k x src_len x enc_hidden_size
-
-    src_mask = tile(src_mask, size, dim=0)  # batch*k x 1 x src_len
-
-    batch_offset = torch.arange(
-        batch_size, dtype=torch.long, device=encoder_output.device)
-    beam_offset = torch.arange(
-        0,
-        batch_size * size,
-        step=size,
-        dtype=torch.long,
-        device=encoder_output.device)
-    alive_seq = torch.full(
-        [batch_size * size, 1],
-        bos_index,
-        dtype=torch.long,
-        device=encoder_output.device)
-
-    # Give full probability to the first beam on the first step.
-    # pylint: disable=not-callable
-    topk_log_probs = (torch.tensor([0.0] + [float("-inf")] * (size - 1),
-                                   device=encoder_output.device).repeat(
-                                    batch_size))
-
-    # Structure that holds finished hypotheses.
-    hypotheses = [[] for _ in range(batch_size)]
-
-    results = {}
-    results["predictions"] = [[] for _ in range(batch_size)]
-    results["scores"] = [[] for _ in range(batch_size)]
-    results["gold_score"] = [0] * batch_size
-
+    device = encoder_output.device
+    src_length = src_mask.size(2)
+    vocab_size = decoder.output_size
+    output_layer = None
+    if shortlist is not None:
+        output_layer = shortlist_output_layer(decoder, shortlist)
+        vocab_size = shortlist.size(0)
+    topk = adaptive_softmax_topk(decoder)
+    if topk is not None:
+        output_layer = identity
+        # the expansions of each hypothesis are its 2k best words
+        vocab_size = min(2 * size, vocab_size)
+    state = decoder.init_state(encoder_output=encoder_output,
+                               encoder_hidden=encoder_hidden,
+                               src_mask=src_mask)
+
+    def length_penalty(length):
+        return ((5.0 + length) / 6.0) ** alpha if alpha > -1 else 1.0
+    if max_lengths is None:
+        max_lengths = torch.full([batch_size], max_output_length,
+                                 dtype=torch.long, device=device)
+    else:
+        max_lengths = max_lengths.to(device)
+    # largest length penalty of each batch entry, the penalty is monotonic
+    # in the length
+    max_penalty = torch.full([batch_size], length_penalty(1),
+                             device=device)
+    if alpha > -1:
+        max_penalty = torch.max(max_penalty,
+                                length_penalty(max_lengths.float()))
+
+    # number of hypotheses per unfinished batch entry, all entries start
+    # with one hypothesis (<s>): batch*beam x ...
+    beam = 1
+    # original batch positions of the unfinished batch entries
+    batch_offset = torch.arange(batch_size, device=device)
+    prev_y = torch.full([batch_size, 1], bos_index, dtype=torch.long,
+                        device=device)
+    alive_log_probs = encoder_output.new_zeros([batch_size])
+
+    # history of the alive hypotheses, by original batch position, beam
+    # position and step: the word, the beam position of the previous
+    # hypothesis and the attention scores
+    history_words = prev_y.new_full(
+        [batch_size, size, max_output_length], pad_index)
+    history_origins = prev_y.new_zeros([batch_size, size, max_output_length])
+    history_attention = encoder_output.new_zeros(
+        [batch_size, size, max_output_length, src_length])
+
+    # n best finished hypotheses of the unfinished batch entries: their
+    # score, length, last word and its attention scores, and the beam
+    # position of the previous hypothesis
+    finished_scores = torch.full([batch_size, n_best], float("-inf"),
+                                 device=device)
+    finished_lengths = prev_y.new_zeros([batch_size, n_best])
+    finished_words = prev_y.new_full([batch_size, n_best], pad_index)
+    finished_attention = encoder_output.new_zeros(
+        [batch_size, n_best, src_length])
+    finished_origins = prev_y.new_zeros([batch_size, n_best])
+
+    # results, by original batch position
+    final_scores = finished_scores.clone()
+    final_lengths = finished_lengths.clone()
+    final_words = finished_words.clone()
+    final_attention = finished_attention.clone()
+    final_origins = finished_origins.clone()
+
+    def gather(tensor: Tensor, index: Tensor) -> Tensor:
+        # select along dim 1 with an index of shape batch x n
+        index = index.view(list(index.size())
+                           + [1] * (tensor.dim() - index.dim()))
+        return tensor.gather(1, index.expand(
+            list(index.size()[:2]) + list(tensor.size()[2:])))
+
+    length = 0
     for step in range(max_output_length):
-        decoder_input = alive_seq[:, -1].view(-1, 1)
+        length = step + 1
+        remaining = batch_offset.size(0)
 
         # expand current hypotheses
         # decode one single step
         # out: logits for final softmax
-        # pylint: disable=unused-variable
-        out, hidden, att_scores, att_vectors = decoder(
-            encoder_output=encoder_output,
-            encoder_hidden=encoder_hidden,
-            src_mask=src_mask,
-            trg_embed=embed(decoder_input),
-            hidden=hidden,
-            prev_att_vector=att_vectors,
-            unrol_steps=1)
-
-        log_probs = F.log_softmax(out, dim=-1).squeeze(1)  # batch*k x trg_vocab
-
+        out, state, att_scores = decoder.step(prev_embed=embed(prev_y),
+                                              state=state,
+                                              output_layer=output_layer)
+
+        if topk is not None:
+            # best words of each hypothesis: batch*beam x vocab_size
+            log_probs, words = topk(out.squeeze(1), vocab_size)
+        else:
+            log_probs = F.log_softmax(out, dim=-1).squeeze(1)
         # multiply probs by the beam probability (=add logprobs)
-        log_probs += topk_log_probs.view(-1).unsqueeze(1)
-        curr_scores = log_probs
+        log_probs = log_probs \
+            + alive_log_probs.unsqueeze(1)  # batch*beam x trg_vocab
 
         # compute length penalty
-        if alpha > -1:
-            length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-            curr_scores /= length_penalty
-
+        penalty = length_penalty(length)
         # flatten log_probs into a list of possibilities
-        curr_scores = curr_scores.reshape(-1, size * decoder.output_size)
-
-        # pick currently best top k hypotheses (flattened order)
-        topk_scores, topk_ids = curr_scores.topk(size, dim=-1)
-
-        if alpha > -1:
-            # recover original log probs
-            topk_log_probs = topk_scores * length_penalty
+        curr_scores = (log_probs / penalty).view(remaining, beam * vocab_size)
 
+        # pick the 2k best expansions, at least k of them do not end
+        candidate_scores, candidate_ids = curr_scores.topk(
+            min(2 * size, beam * vocab_size), dim=-1)
         # reconstruct beam origin and true word ids from flattened order
-        topk_beam_index = topk_ids.div(decoder.output_size)
-        topk_ids = topk_ids.fmod(decoder.output_size)
-
-        # map beam_index to batch_index in the flat representation
-        batch_index = (
-            topk_beam_index
-            + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
-        select_indices = batch_index.view(-1)
-
-        # append latest prediction
-        alive_seq = torch.cat(
-            [alive_seq.index_select(0, select_indices),
-             topk_ids.view(-1, 1)], -1)  # batch_size*k x hyp_len
-
-        is_finished = topk_ids.eq(eos_index)
-        if step + 1 == max_output_length:
-            is_finished.fill_(1)
-        # end condition is whether the top beam is finished
-        end_condition = is_finished[:, 0].eq(1)
-
-        # save finished hypotheses
-        if is_finished.any():
-            predictions = alive_seq.view(-1, size, alive_seq.size(-1))
-            for i in range(is_finished.size(0)):
-                b = batch_offset[i]
-                if end_condition[i]:
-                    is_finished[i].fill_(1)
-                finished_hyp = is_finished[i].nonzero().view(-1)
-                # store finished hypotheses for this batch
-                for j in finished_hyp:
-                    hypotheses[b].append((
-                        topk_scores[i, j],
-                        predictions[i, j, 1:])  # ignore start_token
-                    )
-                # if the batch reached the end, save the n_best hypotheses
-                if end_condition[i]:
-                    best_hyp = sorted(
-                        hypotheses[b], key=lambda x: x[0], reverse=True)
-                    for n, (score, pred) in enumerate(best_hyp):
-                        if n >= n_best:
-                            break
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
-            non_finished = end_condition.eq(0).nonzero().view(-1)
+        candidate_words = candidate_ids % vocab_size
+        if shortlist is not None:
+            candidate_words = shortlist[candidate_words]
+        if topk is not None:
+            candidate_words = words.view(remaining, beam * vocab_size).gather(
+                1, candidate_ids)
+        candidate_beams = candidate_ids // vocab_size
+        candidate_origins = candidate_beams + torch.arange(
+            0, remaining * beam, step=beam, device=device).unsqueeze(1)
+        candidate_ends = candidate_words.eq(eos_index)
+        # all expansions of batch entries at their length limit end
+        candidate_ends |= max_lengths.index_select(0, batch_offset).le(
+            step + 1).unsqueeze(1)
+        att_scores = att_scores.view(remaining * beam, src_length)
+
+        # expansions of empty beam positions cannot be continued or end
+        candidate_valid = candidate_scores > float("-inf")
+        candidate_ends &= candidate_valid
+
+        # keep the n best finished hypotheses
+        if candidate_ends.any():
+            all_scores = torch.cat(
+                [finished_scores, candidate_scores.masked_fill(
+                    ~candidate_ends, float("-inf"))], dim=1)
+            finished_scores, finished_index = all_scores.topk(n_best, dim=1)
+            # entries with a score of -inf are no hypotheses
+            finished_lengths = torch.cat(
+                [finished_lengths, torch.full_like(candidate_words, length)],
+                dim=1).gather(1, finished_index).masked_fill(
+                    finished_scores.eq(float("-inf")), 0)
+            finished_words = torch.cat(
+                [finished_words, candidate_words], dim=1).gather(
+                    1, finished_index)
+            finished_origins = torch.cat(
+                [finished_origins, candidate_beams], dim=1).gather(
+                    1, finished_index)
+            finished_attention = gather(torch.cat(
+                [finished_attention,
+                 att_scores.index_select(0, candidate_origins.view(-1)).view(
+                     remaining, -1, src_length)], dim=1), finished_index)
+
+        # prune the expansions that cannot beat the n-th best finished
+        # hypothesis and the ones that are too bad or too many
+        candidate_log_probs = candidate_scores * penalty
+        pruned = candidate_ends \
+            | (candidate_log_probs
+               / max_penalty.index_select(0, batch_offset).unsqueeze(1)
+               < finished_scores[:, -1:])
+        if relative_threshold > 0:
+            pruned |= candidate_log_probs < candidate_log_probs[:, :1] \
+                + math.log(relative_threshold)
+        if absolute_threshold > 0:
+            pruned |= candidate_scores \
+                < candidate_scores[:, :1] - absolute_threshold
+        if max_candidates > 0:
+            # rank of each expansion among the expansions of its hypothesis
+            same_origin = candidate_origins.unsqueeze(2) \
+                == candidate_origins.unsqueeze(1)
+            rank = same_origin.tril(diagonal=-1).sum(dim=2)
+            pruned |= rank >= max_candidates
+        # continue the best expansion that does not end until n hypotheses
+        # have finished
+        open_candidates = candidate_valid & ~candidate_ends
+        best_open = open_candidates \
+            & open_candidates.long().cumsum(dim=1).eq(1)
+        pruned &= ~(best_open & finished_scores[:, -1:].eq(float("-inf")))
+
+        # continue with the k best hypotheses that are not pruned
+        alive_scores, alive_index = candidate_scores.masked_fill(
+            pruned, float("-inf")).topk(size, dim=1)
+        # shrink the beam to the largest number of hypotheses left
+        num_alive = (alive_scores > float("-inf")).sum(dim=1)
+        beam = max(int(num_alive.max()), 1)
+        alive_scores = alive_scores[:, :beam]
+        alive_index = alive_index[:, :beam]
+        alive_origins = candidate_origins.gather(1, alive_index).view(-1)
+        # recover original log probs
+        alive_log_probs = (alive_scores * penalty).view(-1)
+        alive_words = candidate_words.gather(1, alive_index)
+        history_words[batch_offset, :beam, step] = alive_words
+        history_origins[batch_offset, :beam, step] = \
+            candidate_beams.gather(1, alive_index)
+        history_attention[batch_offset, :beam, step] = \
+            att_scores.index_select(0, alive_origins).view(
+                remaining, beam, src_length)
+        prev_y = alive_words.view(-1, 1)
+        # reorder the decoder states
+        state = state.select_hypotheses(alive_origins)
+
+        # end condition is whether the best expansion ended after n
+        # hypotheses have finished, or all expansions were pruned (or ended
+        # at the length limit)
+        end_condition = (candidate_ends[:, 0]
+                         & finished_scores[:, -1].gt(float("-inf"))) \
+            | num_alive.eq(0)
+        if end_condition.any():
+            ended = end_condition.nonzero().view(-1)
+            positions = batch_offset.index_select(0, ended)
+            final_scores[positions] = finished_scores.index_select(0, ended)
+            final_lengths[positions] = finished_lengths.index_select(0, ended)
+            final_words[positions] = finished_words.index_select(0, ended)
+            final_attention[positions] = \
+                finished_attention.index_select(0, ended)
+            final_origins[positions] = finished_origins.index_select(0, ended)
+
+            non_finished = (~end_condition).nonzero().view(-1)
             # if all sentences are translated, no need to go further
-            # pylint: disable=len-as-condition
-            if len(non_finished) == 0:
+            if non_finished.numel() == 0:
                 break
             # remove finished batches for the next step
-            topk_log_probs = topk_log_probs.index_select(0, non_finished)
-            batch_index = batch_index.index_select(0, non_finished)
             batch_offset = batch_offset.index_select(0, non_finished)
-            alive_seq = predictions.index_select(0, non_finished) \
-                .view(-1, alive_seq.size(-1))
-
-            # reorder indices, outputs and masks
-            select_indices = batch_index.view(-1)
-            encoder_output = encoder_output.index_select(0, select_indices)
-            src_mask = src_mask.index_select(0, select_indices)
-
-            if isinstance(hidden, tuple):
-                # for LSTMs, states are tuples of tensors
-                h, c = hidden
-                h = h.index_select(1, select_indices)
-                c = c.index_select(1, select_indices)
-                hidden = (h, c)
-            else:
-                # for GRUs, states are single tensors
-                hidden = hidden.index_select(1, select_indices)
-
-            att_vectors = att_vectors.index_select(0, select_indices)
-
-    def pad_and_stack_hyps(hyps, pad_value):
-        filled = np.ones((len(hyps), max([h.shape[0] for h in hyps])),
-                         dtype=int) * pad_value
-        for j, h in enumerate(hyps):
-            for k, i in enumerate(h):
-                filled[j, k] = i
-        return filled
+            finished_scores = finished_scores.index_select(0, non_finished)
+            finished_lengths = finished_lengths.index_select(0, non_finished)
+            finished_words = finished_words.index_select(0, non_finished)
+            finished_attention = finished_attention.index_select(
+                0, non_finished)
+            finished_origins = finished_origins.index_select(0, non_finished)
+            beam = max(int(num_alive.index_select(0, non_finished).max()), 1)
+            rows = (non_finished.unsqueeze(1) * alive_scores.size(1)
+                    + torch.arange(beam, device=device)).view(-1)
+            alive_log_probs = alive_log_probs.index_select(0, rows)
+            prev_y = prev_y.index_select(0, rows)
+            state = state.select_hypotheses(rows,
+                                            sentence_index=non_finished)
+
+    # build the hypotheses backwards from their last words, following the
+    # backpointers
+    final_lengths = final_lengths.view(-1)
+    final_origins = final_origins.view(-1)
+    sentences = torch.arange(batch_size, device=device).repeat_interleave(
+        n_best)
+    hypotheses = torch.arange(batch_size * n_best, device=device)
+    output = prev_y.new_full([batch_size * n_best, length], pad_index)
+    attention = encoder_output.new_zeros(
+        [batch_size * n_best, length, src_length])
+    has_words = final_lengths > 0
+    output[hypotheses[has_words], final_lengths[has_words] - 1] = \
+        final_words.view(-1)[has_words]
+    attention[hypotheses[has_words], final_lengths[has_words] - 1] = \
+        final_attention.view(-1, src_length)[has_words]
+    # hypotheses stopped at their length limit are followed by </s>, so
+    # that they are cut before the padding
+    stopped = has_words & final_words.view(-1).ne(eos_index) \
+        & final_lengths.lt(length)
+    output[hypotheses[stopped], final_lengths[stopped]] = eos_index
+    for step in range(length - 2, -1, -1):
+        has_words = (final_lengths > step + 1).unsqueeze(1)
+        output[:, step] = torch.where(
+            has_words.squeeze(1),
+            history_words[sentences, final_origins, step], output[:, step])
+        attention[:, step] = torch.where(
+            has_words, history_attention[sentences, final_origins, step],
+            attention[:, step])
+        final_origins = torch.where(
+            has_words.squeeze(1),
+            history_origins[sentences, final_origins, step], final_origins)
 
     # from results to stacked outputs
-    assert n_best == 1
-    # only works for n_best=1 for now
-    final_outputs = pad_and_stack_hyps([r[0].cpu().numpy() for r in
-                                        results["predictions"]],
-                                       pad_value=pad_index)
-    if return_logp:
-        final_logprobs = np.array([r[0].item() for r in results["scores"]])
-    else:
-        final_logprobs = None
-
-    # TODO also return attention scores
-    return final_outputs, None, final_logprobs
+    final_outputs = output.cpu().numpy()
+    final_attention = attention.cpu().numpy()
+    final_logprobs = final_scores.view(-1).cpu().numpy() \
+        if return_logp else None
+    return final_outputs, final_attention, final_logprobs
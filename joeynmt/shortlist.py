@@ -0,0 +1,170 @@
+# coding: utf-8
+
+"""
+Lexical shortlists: the target tokens that are likely in the translation of
+a source sentence, so that decoding only has to compute the output layer
+for them instead of for the whole target vocabulary.
+"""
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from joeynmt.constants import UNK_TOKEN, EOS_TOKEN
+from joeynmt.helpers import ConfigurationError
+from joeynmt.vocabulary import Vocabulary
+
+
+class Shortlist:
+    """
+    Candidate target tokens of each source token, stored as one array of
+    candidates with the offsets of each source token's candidates (as in a
+    CSR matrix), plus target tokens that are always candidates.
+    """
+
+    def __init__(self, offsets: np.ndarray, candidates: np.ndarray,
+                 frequent: np.ndarray, trg_vocab_size: int) -> None:
+        """
+        :param offsets: the candidates of source token i are
+            `candidates[offsets[i]:offsets[i + 1]]`,
+            shape (src_vocab_size + 1)
+        :param candidates: candidate target token indices
+        :param frequent: target token indices that are always candidates
+        :param trg_vocab_size: size of the target vocabulary
+        """
+        self.offsets = offsets
+        self.candidates = candidates
+        self.frequent = frequent
+        self.src_vocab_size = len(offsets) - 1
+        self.trg_vocab_size = trg_vocab_size
+
+    # pylint: disable=too-many-locals
+    @classmethod
+    def build(cls, pairs: Iterable[Tuple[List[int], List[int]]],
+              src_vocab: Vocabulary, trg_vocab: Vocabulary,
+              num_frequent: int = 100, num_candidates: int = 50,
+              chunk_size: int = 10000) -> "Shortlist":
+        """
+        Build a shortlist from a parallel corpus: the candidates of a source
+        token are the target tokens that co-occur with it in the most
+        sentence pairs relative to their frequency (Dice coefficient), the
+        tokens that are always candidates are the most frequent target
+        tokens, </s> and <unk>.
+
+        :param pairs: source and target token indices of each sentence pair
+        :param src_vocab: source vocabulary
+        :param trg_vocab: target vocabulary
+        :param num_frequent: number of most frequent target tokens that are
+            always candidates
+        :param num_candidates: maximum number of candidates per source token
+        :param chunk_size: number of sentence pairs that are counted at once
+        :return: shortlist
+        """
+        src_vocab_size, trg_vocab_size = len(src_vocab), len(trg_vocab)
+        src_counts = np.zeros(src_vocab_size, dtype=np.int64)
+        trg_counts = np.zeros(trg_vocab_size, dtype=np.int64)
+        pair_keys, pair_counts = [], []
+
+        def count(chunk):
+            # co-occurrences as keys src * trg_vocab_size + trg
+            keys = np.concatenate(
+                [(src[:, None] * trg_vocab_size + trg[None, :]).ravel()
+                 for src, trg in chunk])
+            keys, counts = np.unique(keys, return_counts=True)
+            pair_keys.append(keys)
+            pair_counts.append(counts)
+
+        chunk = []
+        for src, trg in pairs:
+            src = np.unique(np.asarray(src, dtype=np.int64))
+            trg = np.unique(np.asarray(trg, dtype=np.int64))
+            src_counts[src] += 1
+            trg_counts[trg] += 1
+            chunk.append((src, trg))
+            if len(chunk) == chunk_size:
+                count(chunk)
+                chunk = []
+        if chunk:
+            count(chunk)
+
+        # sum the counts of all chunks
+        if pair_keys:
+            keys, inverse = np.unique(np.concatenate(pair_keys),
+                                      return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate(pair_counts))
+        else:
+            keys, counts = np.zeros(0, dtype=np.int64), np.zeros(0)
+        src_ids, trg_ids = keys // trg_vocab_size, keys % trg_vocab_size
+        dice = 2 * counts / (src_counts[src_ids] + trg_counts[trg_ids])
+
+        # the num_candidates best target tokens of each source token
+        order = np.lexsort((-dice, src_ids))
+        src_ids, trg_ids = src_ids[order], trg_ids[order]
+        starts = np.searchsorted(src_ids, np.arange(src_vocab_size))
+        rank = np.arange(len(src_ids)) - starts[src_ids]
+        keep = rank < num_candidates
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(
+            src_ids[keep], minlength=src_vocab_size))])
+
+        frequent = np.argsort(-trg_counts, kind="stable")[:num_frequent]
+        specials = [trg_vocab.stoi[EOS_TOKEN], trg_vocab.stoi[UNK_TOKEN]]
+        frequent = np.union1d(frequent, specials)
+        return cls(offsets=offsets, candidates=trg_ids[keep],
+                   frequent=frequent, trg_vocab_size=trg_vocab_size)
+
+    def save(self, path: str) -> None:
+        """
+        Save the shortlist as index file (numpy .npz archive).
+
+        :param path: path of the index file
+        """
+        with open(path, "wb") as open_file:
+            np.savez_compressed(
+                open_file, offsets=self.offsets,
+                candidates=self.candidates.astype(np.int32),
+                frequent=self.frequent, trg_vocab_size=self.trg_vocab_size)
+
+    @classmethod
+    def load(cls, path: str, src_vocab: Vocabulary = None,
+             trg_vocab: Vocabulary = None) -> "Shortlist":
+        """
+        Load a shortlist from an index file written by `save`.
+
+        :param path: path of the index file
+        :param src_vocab: if given, check that the shortlist was built for
+            a source vocabulary of this size
+        :param trg_vocab: if given, check that the shortlist was built for
+            a target vocabulary of this size
+        :return: shortlist
+        """
+        with np.load(path) as index:
+            shortlist = cls(offsets=index["offsets"],
+                            candidates=index["candidates"].astype(np.int64),
+                            frequent=index["frequent"],
+                            trg_vocab_size=int(index["trg_vocab_size"]))
+        if (src_vocab is not None
+                and shortlist.src_vocab_size != len(src_vocab)) \
+                or (trg_vocab is not None
+                    and shortlist.trg_vocab_size != len(trg_vocab)):
+            raise ConfigurationError(
+                "Shortlist {} was built for other vocabularies.".format(path))
+        return shortlist
+
+    def vocabulary(self, src: Union[Tensor, np.ndarray]) -> Tensor:
+        """
+        Target tokens to compute the output layer for when translating
+        the given source sentences: the candidates of all their tokens and
+        the tokens that are always candidates.
+
+        :param src: source token indices, e.g. a batch of sentences
+        :return: sorted target token indices (on the device of `src`)
+        """
+        src_ids = np.unique(src.cpu().numpy() if isinstance(src, Tensor)
+                            else src)
+        ids = np.concatenate(
+            [self.frequent] + [self.candidates[self.offsets[i]:
+                                               self.offsets[i + 1]]
+                               for i in src_ids])
+        index = torch.from_numpy(np.unique(ids))
+        return index.to(src.device) if isinstance(src, Tensor) else index
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+"""
+Simple recurrent unit
+"""
+from typing import Optional
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, \
+    pad_packed_sequence
+
+
+class SRU(nn.Module):
+    """
+    Simple recurrent unit (Lei et al., 2018: Simple Recurrent Units for
+    Highly Parallelizable Recurrence), with the interface of `nn.GRU`
+    (batch first).
+
+    The gates only depend on the input, not on the previous state:
+
+        x'_t = W x_t,  f_t = sigmoid(W_f x_t + b_f),
+        r_t = sigmoid(W_r x_t + b_r),
+        c_t = f_t * c_{t-1} + (1 - f_t) * x'_t,
+        h_t = r_t * tanh(c_t) + (1 - r_t) * x_t
+
+    so that the matrix multiplications of all time steps are one batched
+    matrix multiplication, and only the elementwise recurrence of c_t is
+    computed step by step. If the input size differs from the hidden size,
+    x_t in the highway connection is projected as well.
+    The state (`h_n` of `nn.GRU`) is c_t.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, input_size: int, hidden_size: int,
+                 num_layers: int = 1, batch_first: bool = True,
+                 dropout: float = 0., bidirectional: bool = False) -> None:
+        """
+        :param input_size: size of the inputs
+        :param hidden_size: size of the states of each direction
+        :param num_layers: number of layers
+        :param batch_first: has to be True
+        :param dropout: dropout on the outputs of each layer but the last
+        :param bidirectional: run a second unit over the reversed inputs
+        """
+        super(SRU, self).__init__()
+        assert batch_first, "SRU only supports batch first inputs."
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.bidirectional = bidirectional
+        self.num_directions = 2 if bidirectional else 1
+        self.dropout = nn.Dropout(p=dropout)
+
+        # one projection per layer and direction: x', f, r (and highway)
+        self.layers = nn.ModuleList()
+        for layer in range(num_layers):
+            layer_input_size = input_size if layer == 0 \
+                else hidden_size * self.num_directions
+            num_matrices = 3 if layer_input_size == hidden_size else 4
+            for _ in range(self.num_directions):
+                self.layers.append(nn.Linear(
+                    layer_input_size, num_matrices * hidden_size))
+
+    def _recurrence(self, x: Tensor, c: Tensor, projection: nn.Linear,
+                    mask: Optional[Tensor], reverse: bool) \
+            -> (Tensor, Tensor):
+        """
+        One layer in one direction.
+
+        :param x: inputs, shape (batch_size, length, layer input size)
+        :param c: initial state, shape (batch_size, hidden_size)
+        :param projection: projection of the layer and direction
+        :param mask: True at the valid positions, shape
+            (batch_size, length, 1), None if all are valid
+        :param reverse: run from the last to the first position
+        :return:
+            - outputs: shape (batch_size, length, hidden_size)
+            - state after the last valid position: (batch_size, hidden_size)
+        """
+        batch_size, length = x.size(0), x.size(1)
+        # all time steps at once: batch x length x matrices x hidden
+        u = projection(x).view(batch_size, length, -1, self.hidden_size)
+        forget = torch.sigmoid(u[:, :, 1])
+        reset = torch.sigmoid(u[:, :, 2])
+        highway = u[:, :, 3] if u.size(2) == 4 else x
+        # c_t = forget_t * c_{t-1} + candidate_t
+        candidate = (1 - forget) * u[:, :, 0]
+        if mask is not None:
+            # padding keeps the state
+            forget = forget.masked_fill(~mask, 1.)
+            candidate = candidate.masked_fill(~mask, 0.)
+
+        states = [None] * length
+        steps = range(length - 1, -1, -1) if reverse else range(length)
+        for t in steps:
+            c = forget[:, t] * c + candidate[:, t]
+            states[t] = c
+        states = torch.stack(states, dim=1)
+        output = reset * torch.tanh(states) + (1 - reset) * highway
+        return output, c
+
+    # pylint: disable=arguments-differ
+    def forward(self, inputs, hidden: Optional[Tensor] = None) \
+            -> (Tensor, Tensor):
+        """
+        :param inputs: inputs, shape (batch_size, length, input_size), or a
+            `PackedSequence` (then positions after the end of a sequence do
+            not change its state)
+        :param hidden: initial states, zeros if None,
+            shape (num_layers * num_directions, batch_size, hidden_size)
+        :return:
+            - outputs of the last layer, shape (batch_size, length,
+              num_directions * hidden_size), a `PackedSequence` if
+              `inputs` is one
+            - states after the last valid position (after the first one
+              for the backward direction), same shape as `hidden`
+        """
+        mask = None
+        packed = isinstance(inputs, PackedSequence)
+        if packed:
+            inputs, lengths = pad_packed_sequence(inputs, batch_first=True)
+            mask = (torch.arange(inputs.size(1))[None, :]
+                    < lengths[:, None]).to(inputs.device).unsqueeze(2)
+        if hidden is None:
+            hidden = inputs.new_zeros(
+                [self.num_layers * self.num_directions, inputs.size(0),
+                 self.hidden_size])
+
+        x = inputs
+        states = []
+        for layer in range(self.num_layers):
+            outputs = []
+            for direction in range(self.num_directions):
+                i = layer * self.num_directions + direction
+                output, state = self._recurrence(
+                    x, hidden[i], self.layers[i], mask,
+                    reverse=direction == 1)
+                outputs.append(output)
+                states.append(state)
+            x = torch.cat(outputs, dim=2) if self.bidirectional \
+                else outputs[0]
+            if layer < self.num_layers - 1:
+                x = self.dropout(x)
+
+        if packed:
+            x = pack_padded_sequence(x, lengths, batch_first=True,
+                                     enforce_sorted=False)
+        return x, torch.stack(states, dim=0)
+
+    def __repr__(self):
+        return "SRU(%d, %d, num_layers=%d, bidirectional=%r)" % (
+            self.input_size, self.hidden_size, self.num_layers,
+            self.bidirectional)
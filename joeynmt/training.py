@@ -22,14 +22,16 @@ from torchtext.data import Dataset
 from tensorboardX import SummaryWriter
 
 from joeynmt.model import build_model
-from joeynmt.batch import Batch
+from joeynmt.batch import Batch, BatchPrefetcher, TokenAccumulator
 from joeynmt.helpers import log_data_info, load_config, log_cfg, \
     store_attention_plots, load_checkpoint, make_model_dir, \
     make_logger, set_seed, symlink_update, ConfigurationError, \
     get_latest_checkpoint
 from joeynmt.model import Model
-from joeynmt.prediction import validate_on_data
+from joeynmt.prediction import validate_on_data, ValidationCache, \
+    count_length_limit_hits
 from joeynmt.data import load_data, make_data_iter
+from joeynmt.shortlist import Shortlist
 from joeynmt.builders import build_optimizer, build_scheduler, \
     build_gradient_clipper
 from joeynmt.loss import WeightedCrossEntropy
@@ -127,10 +129,27 @@ class TrainManager:
         self.shuffle = train_config.get("shuffle", True)
         self.epochs = train_config["epochs"]
         self.batch_size = train_config["batch_size"]
+        self.batch_type = train_config.get("batch_type", "sentence")
+        if self.batch_type == "tokens":  # accepted as alias
+            self.batch_type = "token"
+        if self.batch_type not in ["sentence", "token"]:
+            raise ConfigurationError("Invalid batch type. "
+                                     "Valid options: 'sentence', 'token'.")
         self.batch_multiplier = train_config.get("batch_multiplier", 1)
+        # number of batches to prepare in the background
+        self.prefetch_batches = train_config.get("prefetch_batches", 0)
+        self.sentence_weights = \
+            config["data"].get("feedback_level", "token") == "sentence"
+        # streamed training data is bucketed and shuffled in a buffer
+        self.shuffle_buffer_size = None
+        if config["data"].get("streaming", False):
+            self.shuffle_buffer_size = config["data"].get(
+                "shuffle_buffer_size", 100000)
 
         # generation
         self.max_output_length = train_config.get("max_output_length", None)
+        self.length_ratio = train_config.get("max_output_length_ratio", None)
+        self.length_offset = train_config.get("max_output_length_offset", 0)
 
         # CPU / GPU
         self.use_cuda = train_config["use_cuda"]
@@ -148,6 +167,8 @@ class TrainManager:
         # stop training if this flag is True by reaching learning rate minimum
         self.stop = False
         self.total_tokens = 0
+        # batches accumulated for the next update (batch_type "token")
+        self.accumulated_batches = 0
         self.best_ckpt_iteration = 0
         # initial values for best scores
         self.best_ckpt_score = np.inf if self.minimize_metric else -np.inf
@@ -159,6 +180,8 @@ class TrainManager:
         if config["data"].get("feedback", None) is not None:
             self.logger.info("Learning with token-level feedback.")
         self.return_logp = config["testing"].get("return_logp", False)
+        # dev batches, built at the first validation and reused afterwards
+        self.valid_cache = None
 
 
     def _save_checkpoint(self) -> None:
@@ -237,7 +260,14 @@ class TrainManager:
         :param valid_data: validation data
         """
         train_iter = make_data_iter(train_data, batch_size=self.batch_size,
-                                    train=True, shuffle=self.shuffle)
+                                    batch_type=self.batch_type,
+                                    train=True, shuffle=self.shuffle,
+                                    buffer_size=self.shuffle_buffer_size)
+        # create Batch objects from torchtext batches
+        train_batches = BatchPrefetcher(train_iter, self.pad_index,
+                                        use_cuda=self.use_cuda,
+                                        num_batches=self.prefetch_batches,
+                                        sentence_weights=self.sentence_weights)
         for epoch_no in range(self.epochs):
             self.logger.info("EPOCH %d", epoch_no + 1)
 
@@ -250,25 +280,38 @@ class TrainManager:
             total_valid_duration = 0
             processed_tokens = self.total_tokens
             count = 0
+            accumulator = TokenAccumulator(self.batch_size,
+                                           self.batch_multiplier)
             epoch_loss = 0
+            epoch_real_tokens = 0
+            epoch_padded_tokens = 0
 
-            for batch in iter(train_iter):
+            for batch in iter(train_batches):
                 # reactivate training
                 self.model.train()
-                # create a Batch object from torchtext batch
-                batch = Batch(batch, self.pad_index, use_cuda=self.use_cuda)
-
-                # only update every batch_multiplier batches
-                # see https://medium.com/@davidlmorton/
-                # increasing-mini-batch-size-without-increasing-
-                # memory-6794e10db672
-                update = count == 0
-                # print(count, update, self.steps)
-                batch_loss = self._train_batch(batch, update=update)
+
+                # tokens before and after padding (src + trg)
+                real_tokens = batch.src_lengths.sum().item() + batch.ntokens
+                padded_tokens = batch.src.numel() + batch.trg.numel()
+                epoch_real_tokens += real_tokens
+                epoch_padded_tokens += padded_tokens
+
+                if self.batch_type == "token":
+                    # update once about batch_multiplier * batch_size tokens
+                    # have been accumulated
+                    update = accumulator.add(batch)
+                    batch_loss = self._train_batch(batch, update=update)
+                else:
+                    # only update every batch_multiplier batches
+                    # see https://medium.com/@davidlmorton/
+                    # increasing-mini-batch-size-without-increasing-
+                    # memory-6794e10db672
+                    update = count == 0
+                    batch_loss = self._train_batch(batch, update=update)
+                    count = self.batch_multiplier if update else count
+                    count -= 1
                 self.tb_writer.add_scalar("train/train_batch_loss", batch_loss,
                                           self.steps)
-                count = self.batch_multiplier if update else count
-                count -= 1
                 epoch_loss += batch_loss.detach().cpu().numpy()
 
                 # log learning progress
@@ -288,17 +331,27 @@ class TrainManager:
 
                     valid_start_time = time.time()
 
+                    if self.valid_cache is None:
+                        self.valid_cache = ValidationCache(
+                            data=valid_data, batch_size=self.batch_size,
+                            pad_index=self.pad_index, use_cuda=self.use_cuda,
+                            level=self.level, batch_type=self.batch_type)
+
                     valid_score, valid_loss, valid_ppl, valid_sources, \
                         valid_sources_raw, valid_references, valid_hypotheses, \
                         valid_hypotheses_raw, valid_attention_scores, \
                         valid_logps = validate_on_data(
                             batch_size=self.batch_size, data=valid_data,
+                            batch_type=self.batch_type,
                             eval_metric=self.eval_metric,
                             level=self.level, model=self.model,
                             use_cuda=self.use_cuda,
                             max_output_length=self.max_output_length,
                             loss_function=self.loss,
-                            return_logp=self.return_logp)
+                            return_logp=self.return_logp,
+                            cache=self.valid_cache,
+                            length_ratio=self.length_ratio,
+                            length_offset=self.length_offset)
 
                     self.tb_writer.add_scalar("valid/valid_loss",
                                               valid_loss, self.steps)
@@ -391,6 +444,12 @@ class TrainManager:
 
             self.logger.info('Epoch %d: total training loss %.2f', epoch_no+1,
                              epoch_loss)
+            if epoch_padded_tokens > 0:
+                self.logger.info(
+                    'Epoch %d: padding efficiency %.2f%% '
+                    '(%d real / %d padded tokens)', epoch_no + 1,
+                    100. * epoch_real_tokens / epoch_padded_tokens,
+                    epoch_real_tokens, epoch_padded_tokens)
         else:
             self.logger.info('Training ended after %d epochs.', epoch_no+1)
 
@@ -419,17 +478,34 @@ class TrainManager:
             raise NotImplementedError("Only normalize by 'batch' or 'tokens'")
 
         norm_batch_loss = batch_loss / normalizer
-        # division needed since loss.backward sums the gradients until updated
-        norm_batch_multiply = norm_batch_loss / self.batch_multiplier
+        if self.batch_type == "token":
+            # the number of batches per update varies with their lengths,
+            # so gradients are averaged when the update is made
+            norm_batch_multiply = norm_batch_loss
+            self.accumulated_batches += 1
+        else:
+            # division needed since loss.backward sums the gradients until
+            # updated
+            norm_batch_multiply = norm_batch_loss / self.batch_multiplier
 
         # compute gradients
         norm_batch_multiply.backward()
 
-        if self.clip_grad_fun is not None:
+        if self.clip_grad_fun is not None and self.batch_type != "token":
             # clip gradients (in-place)
             self.clip_grad_fun(params=self.model.parameters())
 
         if update:
+            if self.batch_type == "token":
+                if self.accumulated_batches > 1:
+                    for p in self.model.parameters():
+                        if p.grad is not None:
+                            p.grad.div_(self.accumulated_batches)
+                self.accumulated_batches = 0
+                # clip the averaged gradients once per update
+                if self.clip_grad_fun is not None:
+                    self.clip_grad_fun(params=self.model.parameters())
+
             # make gradient step
             self.optimizer.step()
             self.optimizer.zero_grad()
@@ -562,6 +638,20 @@ def train(cfg_file: str) -> None:
                   test_data=test_data, src_vocab=src_vocab, trg_vocab=trg_vocab,
                   logging_function=trainer.logger.info)
 
+    if getattr(train_data, "zero_feedback_dropped", None) is not None:
+        dropped_examples, dropped_src_tokens, dropped_trg_tokens = \
+            train_data.zero_feedback_dropped
+        # forward and backward pass: about 6 FLOPs per parameter and token
+        encoder_params = sum(p.numel() for p in model.encoder.parameters())
+        decoder_params = sum(p.numel() for p in model.decoder.parameters())
+        saved_flops = 6 * (encoder_params * dropped_src_tokens +
+                           decoder_params * dropped_trg_tokens)
+        trainer.logger.info(
+            "Dropped %d training examples with zero feedback "
+            "(%d src + %d trg tokens), saving about %.2e FLOPs per epoch.",
+            dropped_examples, dropped_src_tokens, dropped_trg_tokens,
+            saved_flops)
+
     # store the vocabs
     src_vocab_file = "{}/src_vocab.txt".format(cfg["training"]["model_dir"])
     src_vocab.to_file(src_vocab_file)
@@ -598,20 +688,32 @@ def train(cfg_file: str) -> None:
             beam_size = cfg["testing"].get("beam_size", 0)
             beam_alpha = cfg["testing"].get("alpha", -1)
             return_logp = cfg["testing"].get("return_logp", False)
+            num_slots = cfg["testing"].get("num_slots", 0)
+            pruning = cfg["testing"].get("pruning", {})
+            shortlist_path = cfg["testing"].get("shortlist", None)
         else:
             beam_size = 0
             beam_alpha = -1
             return_logp = False
+            num_slots = 0
+            pruning = {}
+            shortlist_path = None
+        shortlist = Shortlist.load(shortlist_path, src_vocab=src_vocab,
+                                   trg_vocab=trg_vocab) \
+            if shortlist_path is not None else None
 
         # pylint: disable=unused-variable
         score, loss, ppl, sources, sources_raw, references, hypotheses, \
             hypotheses_raw, attention_scores, log_probs = validate_on_data(
                 data=test_data, batch_size=trainer.batch_size,
+                batch_type=trainer.batch_type,
                 eval_metric=trainer.eval_metric, level=trainer.level,
                 max_output_length=trainer.max_output_length,
                 model=model, use_cuda=trainer.use_cuda, loss_function=None,
                 beam_size=beam_size, beam_alpha=beam_alpha,
-                return_logp=return_logp)
+                return_logp=return_logp, num_slots=num_slots,
+                pruning=pruning, length_ratio=trainer.length_ratio,
+                length_offset=trainer.length_offset, shortlist=shortlist)
 
         if "trg" in test_data.fields:
             decoding_description = "Greedy decoding" if beam_size == 0 else \
@@ -624,6 +726,13 @@ def train(cfg_file: str) -> None:
             trainer.logger.info(
                 "No references given for %s.%s -> no evaluation.",
                 cfg["data"]["test"], cfg["data"]["src"])
+        trainer.logger.info(
+            "%d of %d test hypotheses reached their maximum length",
+            count_length_limit_hits(
+                sources_raw, hypotheses_raw,
+                max_output_length=trainer.max_output_length,
+                length_ratio=trainer.length_ratio,
+                length_offset=trainer.length_offset), len(hypotheses_raw))
 
         output_path_set = "{}/{}.{}".format(
             trainer.model_dir, "test", cfg["data"]["trg"])
@@ -0,0 +1,270 @@
+# coding: utf-8
+
+"""
+Layers of the Transformer (Vaswani et al., 2017: Attention is all you need)
+"""
+import math
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+class MultiHeadedAttention(nn.Module):
+    """
+    Multi-head attention: scaled dot-product attention in several heads,
+    each on its own projection of queries, keys and values.
+
+    Keys and values are projected separately (`project_keys_values`), so
+    that they can be computed once and reused, e.g. the encoder states in
+    every decoding step.
+    """
+
+    def __init__(self, num_heads: int, size: int, dropout: float = 0.1) \
+            -> None:
+        """
+        :param num_heads: number of heads
+        :param size: model size, divisible by `num_heads`
+        :param dropout: dropout of the attention probabilities
+        """
+        super(MultiHeadedAttention, self).__init__()
+        assert size % num_heads == 0, \
+            "The model size has to be divisible by the number of heads."
+
+        self.head_size = size // num_heads
+        self.model_size = size
+        self.num_heads = num_heads
+
+        self.k_layer = nn.Linear(size, size)
+        self.v_layer = nn.Linear(size, size)
+        self.q_layer = nn.Linear(size, size)
+        self.output_layer = nn.Linear(size, size)
+        self.dropout = nn.Dropout(dropout)
+
+    def _split_heads(self, x: Tensor) -> Tensor:
+        # batch x length x size -> batch x heads x length x head_size
+        return x.view(x.size(0), -1, self.num_heads,
+                      self.head_size).transpose(1, 2)
+
+    def project_keys_values(self, x: Tensor) -> (Tensor, Tensor):
+        """
+        Project the keys and values for `self.forward`.
+
+        :param x: keys and values, shape (batch_size, length, size)
+        :return: projected keys and values,
+            each shape (batch_size, num_heads, length, head_size)
+        """
+        return self._split_heads(self.k_layer(x)), \
+            self._split_heads(self.v_layer(x))
+
+    # pylint: disable=arguments-differ
+    def forward(self, query: Tensor, keys: Tensor, values: Tensor,
+                mask: Optional[Tensor] = None) -> (Tensor, Tensor):
+        """
+        Attend to the (projected) keys and values.
+
+        There can be several queries per key sequence (e.g. the hypotheses
+        of a beam), in consecutive rows: the keys and values are then
+        broadcast to all their queries instead of being copied.
+
+        :param query: queries,
+            shape (batch_size * queries per sequence, query_length, size)
+        :param keys: projected keys, see `project_keys_values`,
+            shape (batch_size, num_heads, key_length, head_size)
+        :param values: projected values, same shape as `keys`
+        :param mask: True at the keys that can be attended to,
+            shape (batch_size or 1, 1 or query_length, key_length)
+        :return:
+            - context: shape (batch_size * queries per sequence,
+              query_length, size),
+            - att_probs: attention probabilities averaged over the heads,
+              shape (batch_size * queries per sequence, query_length,
+              key_length)
+        """
+        batch_size = keys.size(0)
+        num_queries, query_length = query.size(0), query.size(1)
+        # batch x heads x queries*query_length x head_size
+        q = self._split_heads(
+            self.q_layer(query).view(batch_size, -1, self.model_size))
+        q = q / math.sqrt(self.head_size)
+
+        # batch x heads x queries*query_length x key_length
+        scores = torch.matmul(q, keys.transpose(2, 3))
+        if mask is not None:
+            if mask.size(1) > 1 and num_queries > batch_size:
+                mask = mask.repeat(1, num_queries // batch_size, 1)
+            scores = scores.masked_fill(~mask.unsqueeze(1), float("-inf"))
+
+        att_probs = torch.softmax(scores, dim=-1)
+        context = torch.matmul(self.dropout(att_probs), values)
+        context = context.transpose(1, 2).reshape(
+            num_queries, query_length, self.model_size)
+        return self.output_layer(context), \
+            att_probs.mean(dim=1).view(num_queries, query_length, -1)
+
+
+class PositionwiseFeedForward(nn.Module):
+    """
+    Feed-forward layer applied to each position, with a residual
+    connection: layer norm, projection to `ff_size`, ReLU, projection back.
+    """
+
+    def __init__(self, input_size: int, ff_size: int,
+                 dropout: float = 0.1) -> None:
+        """
+        :param input_size: model size
+        :param ff_size: size of the hidden layer
+        :param dropout: dropout after the hidden layer and the output
+        """
+        super(PositionwiseFeedForward, self).__init__()
+        self.layer_norm = nn.LayerNorm(input_size, eps=1e-6)
+        self.pwff_layer = nn.Sequential(
+            nn.Linear(input_size, ff_size),
+            nn.ReLU(),
+            nn.Dropout(dropout),
+            nn.Linear(ff_size, input_size),
+            nn.Dropout(dropout))
+
+    # pylint: disable=arguments-differ
+    def forward(self, x: Tensor) -> Tensor:
+        """
+        :param x: inputs, shape (..., input_size)
+        :return: outputs, same shape
+        """
+        return self.pwff_layer(self.layer_norm(x)) + x
+
+
+class PositionalEncoding(nn.Module):
+    """
+    Adds sinusoidal position encodings to embeddings.
+    The encodings are computed for the positions that are needed, so that
+    there is no maximum length.
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        :param size: embedding size, even
+        """
+        super(PositionalEncoding, self).__init__()
+        assert size % 2 == 0, \
+            "Positional encodings need an even embedding size."
+        self.size = size
+
+    # pylint: disable=arguments-differ
+    def forward(self, emb: Tensor, offset: int = 0) -> Tensor:
+        """
+        :param emb: embeddings, shape (batch_size, length, size)
+        :param offset: position of the first embedding
+        :return: embeddings with position encodings, same shape
+        """
+        positions = torch.arange(offset, offset + emb.size(1),
+                                 dtype=torch.float, device=emb.device)
+        div_term = torch.exp(torch.arange(
+            0, self.size, 2, dtype=torch.float, device=emb.device)
+                             * -(math.log(10000.0) / self.size))
+        angles = positions.unsqueeze(1) * div_term.unsqueeze(0)
+        # length x size/2 x 2 -> length x size, alternating sin and cos
+        encoding = torch.stack([torch.sin(angles), torch.cos(angles)],
+                               dim=2).view(emb.size(1), self.size)
+        return emb + encoding.unsqueeze(0).type_as(emb)
+
+
+class TransformerEncoderLayer(nn.Module):
+    """
+    Transformer encoder layer: self-attention and feed-forward layer, each
+    with layer norm before and a residual connection.
+    """
+
+    def __init__(self, size: int, ff_size: int, num_heads: int,
+                 dropout: float = 0.1) -> None:
+        """
+        :param size: model size
+        :param ff_size: size of the hidden layer of the feed-forward layer
+        :param num_heads: number of attention heads
+        :param dropout: dropout
+        """
+        super(TransformerEncoderLayer, self).__init__()
+        self.layer_norm = nn.LayerNorm(size, eps=1e-6)
+        self.src_src_att = MultiHeadedAttention(num_heads, size,
+                                                dropout=dropout)
+        self.feed_forward = PositionwiseFeedForward(size, ff_size,
+                                                    dropout=dropout)
+        self.dropout = nn.Dropout(dropout)
+
+    # pylint: disable=arguments-differ
+    def forward(self, x: Tensor, mask: Tensor) -> Tensor:
+        """
+        :param x: inputs, shape (batch_size, src_length, size)
+        :param mask: source mask, shape (batch_size, 1, src_length)
+        :return: outputs, same shape as `x`
+        """
+        x_norm = self.layer_norm(x)
+        h, _ = self.src_src_att(
+            x_norm, *self.src_src_att.project_keys_values(x_norm), mask=mask)
+        return self.feed_forward(self.dropout(h) + x)
+
+
+class TransformerDecoderLayer(nn.Module):
+    """
+    Transformer decoder layer: self-attention on the target, attention on
+    the encoder states and feed-forward layer, each with layer norm before
+    and a residual connection.
+    """
+
+    def __init__(self, size: int, ff_size: int, num_heads: int,
+                 dropout: float = 0.1) -> None:
+        """
+        :param size: model size
+        :param ff_size: size of the hidden layer of the feed-forward layer
+        :param num_heads: number of attention heads
+        :param dropout: dropout
+        """
+        super(TransformerDecoderLayer, self).__init__()
+        self.x_layer_norm = nn.LayerNorm(size, eps=1e-6)
+        self.trg_trg_att = MultiHeadedAttention(num_heads, size,
+                                                dropout=dropout)
+        self.dec_layer_norm = nn.LayerNorm(size, eps=1e-6)
+        self.src_trg_att = MultiHeadedAttention(num_heads, size,
+                                                dropout=dropout)
+        self.feed_forward = PositionwiseFeedForward(size, ff_size,
+                                                    dropout=dropout)
+        self.dropout = nn.Dropout(dropout)
+
+    # pylint: disable=arguments-differ,too-many-arguments
+    def forward(self, x: Tensor, memory_keys: Tensor, memory_values: Tensor,
+                src_mask: Tensor, trg_mask: Optional[Tensor] = None,
+                cache: Optional[Tuple[Tensor, Tensor]] = None) \
+            -> (Tensor, Tensor, Tuple[Tensor, Tensor]):
+        """
+        :param x: inputs, shape (hypotheses, trg_length, size)
+        :param memory_keys: projected encoder states (keys) of
+            `src_trg_att`, shape (batch_size, num_heads, src_length,
+            head_size), shared by consecutive hypotheses
+        :param memory_values: projected encoder states (values), same shape
+        :param src_mask: source mask, shape (batch_size, 1, src_length)
+        :param trg_mask: target mask, True where a position can attend to
+            another one, shape (1, trg_length, trg_length), None to attend
+            to all positions
+        :param cache: projected keys and values of the self-attention for
+            the previous positions, shape (hypotheses, num_heads,
+            previous_length, head_size) each, None if there are none
+        :return:
+            - outputs: same shape as `x`,
+            - att_probs: attention probabilities on the encoder states,
+              shape (hypotheses, trg_length, src_length),
+            - cache: `cache` extended by the keys and values of `x`
+        """
+        x_norm = self.x_layer_norm(x)
+        keys, values = self.trg_trg_att.project_keys_values(x_norm)
+        if cache is not None:
+            keys = torch.cat([cache[0], keys], dim=2)
+            values = torch.cat([cache[1], values], dim=2)
+        h1, _ = self.trg_trg_att(x_norm, keys, values, mask=trg_mask)
+        h1 = self.dropout(h1) + x
+
+        h1_norm = self.dec_layer_norm(h1)
+        h2, att_probs = self.src_trg_att(h1_norm, memory_keys, memory_values,
+                                         mask=src_mask)
+        h2 = self.dropout(h2) + h1
+        return self.feed_forward(h2), att_probs, (keys, values)
@@ -3,7 +3,7 @@
 """
 Vocabulary module
 """
-from collections import defaultdict, Counter
+from collections import Counter
 from typing import List
 import numpy as np
 
@@ -13,6 +13,17 @@ from joeynmt.constants import UNK_TOKEN, DEFAULT_UNK_ID, \
     EOS_TOKEN, BOS_TOKEN, PAD_TOKEN
 
 
+class TokenIndex(dict):
+    """
+    Mapping from tokens to indices that maps unknown tokens to the index of
+    the unk token. Unlike a `defaultdict`, it doesn't store unknown tokens,
+    so it doesn't grow with lookups.
+    """
+
+    def __missing__(self, token: str) -> int:
+        return DEFAULT_UNK_ID()
+
+
 class Vocabulary:
     """ Vocabulary represents mapping between tokens and indices. """
 
@@ -27,13 +38,14 @@ class Vocabulary:
         :param file: file to load vocabulary from
         """
         # don't rename stoi and itos since needed for torchtext
-        # warning: stoi grows with unknown tokens, don't use for saving or size
 
         # special symbols
         self.specials = [UNK_TOKEN, PAD_TOKEN, BOS_TOKEN, EOS_TOKEN]
 
-        self.stoi = defaultdict(DEFAULT_UNK_ID)
+        self.stoi = TokenIndex()
         self.itos = []
+        # itos as numpy array for decoding whole batches, built on demand
+        self._itos_array = None
         if tokens is not None:
             self._from_list(tokens)
         elif file is not None:
@@ -83,11 +95,11 @@ class Vocabulary:
         :param tokens: list of tokens to add to the vocabulary
         """
         for t in tokens:
-            new_index = len(self.itos)
-            # add to vocab if not already there
-            if t not in self.itos:
+            # add to vocab if not already there (hash lookup in stoi)
+            if t not in self.stoi:
+                self.stoi[t] = len(self.itos)
                 self.itos.append(t)
-                self.stoi[t] = new_index
+        self._itos_array = None
 
     def is_unk(self, token: str) -> bool:
         """
@@ -124,20 +136,35 @@ class Vocabulary:
         Convert multiple arrays containing sequences of token IDs to their
         sentences, optionally cutting them off at the end-of-sequence token.
 
+        A 2D array is converted at once: the first <eos> of every row is
+        located with numpy and all IDs are mapped to tokens with one lookup
+        in an array version of `itos`.
+
         :param arrays: 2D array containing indices
-        :param vocabulary: defines mapping of indices to tokens
+            (or list of 1D arrays of different lengths)
         :param cut_at_eos: cut the decoded sentences at the first <eos>
         :return: list of list of strings (tokens)
         """
-        sentences = []
-        for array in arrays:
-            sentences.append(
-                self.array_to_sentence(array=array, cut_at_eos=cut_at_eos))
-        return sentences
+        if not isinstance(arrays, np.ndarray) or arrays.ndim != 2:
+            return [self.array_to_sentence(array=array, cut_at_eos=cut_at_eos)
+                    for array in arrays]
+
+        batch_size, max_length = arrays.shape
+        lengths = np.full(batch_size, max_length)
+        if cut_at_eos:
+            is_eos = arrays == self.stoi[EOS_TOKEN]
+            has_eos = is_eos.any(axis=1)
+            # argmax finds the first True in every row
+            lengths[has_eos] = is_eos.argmax(axis=1)[has_eos]
+
+        if self._itos_array is None:
+            self._itos_array = np.array(self.itos, dtype=object)
+        tokens = self._itos_array[arrays]
+        return [row[:length].tolist() for row, length in zip(tokens, lengths)]
 
 
 def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
-                vocab_file: str = None) -> Vocabulary:
+                vocab_file: str = None, counter: Counter = None) -> Vocabulary:
     """
     Builds vocabulary for a torchtext `field` from given`dataset` or
     `vocab_file`.
@@ -148,6 +175,8 @@ def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
     :param dataset: dataset to load data for field from
     :param vocab_file: file to store the vocabulary,
         if not None, load vocabulary from here
+    :param counter: token frequencies for `field` in `dataset`,
+        if None, they are counted here
     :return: Vocabulary created from either `dataset` or `vocab_file`
     """
 
@@ -172,14 +201,11 @@ def build_vocab(field: str, max_size: int, min_freq: int, dataset: Dataset,
             vocab_tokens = [i[0] for i in tokens_and_frequencies[:limit]]
             return vocab_tokens
 
-        tokens = []
-        for i in dataset.examples:
-            if field == "src":
-                tokens.extend(i.src)
-            elif field == "trg":
-                tokens.extend(i.trg)
+        if counter is None:
+            counter = Counter()
+            for i in dataset.examples:
+                counter.update(getattr(i, field))
 
-        counter = Counter(tokens)
         if min_freq > -1:
             counter = filter_min(counter, min_freq)
         vocab_tokens = sort_and_cut(counter, max_size)
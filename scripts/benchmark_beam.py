@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark beam search: decoding time of `joeynmt.search.beam_search` for
+different beam sizes, with a randomly initialized or a trained model, and
+the effect of beam pruning on the number of decoding steps and on BLEU.
+"""
+
+import argparse
+import time
+
+import torch
+
+from joeynmt.batch import Batch
+from joeynmt.constants import PAD_TOKEN
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.helpers import load_config, load_checkpoint
+from joeynmt.model import build_model
+from joeynmt.prediction import validate_on_data
+from joeynmt.search import beam_search
+
+
+# pylint: disable=too-many-locals
+def benchmark(cfg_file: str, ckpt: str, beam_sizes: list, batch_size: int,
+              max_output_length: int, alpha: float, repetitions: int,
+              use_cuda: bool) -> None:
+    """
+    Decode the development data `repetitions` times with beam search for
+    each beam size and print the time per sentence.
+
+    :param cfg_file: configuration file with data and model sections
+    :param ckpt: checkpoint of a trained model, if None the model is
+        randomly initialized
+    :param beam_sizes: beam sizes to measure
+    :param batch_size: number of sentences that are decoded together
+    :param max_output_length: maximum number of decoding steps
+    :param alpha: length penalty
+    :param repetitions: number of timed runs
+    :param use_cuda: decode on the GPU
+    """
+    cfg = load_config(cfg_file)
+    _, dev_data, _, src_vocab, trg_vocab = load_data(cfg["data"])
+    model = build_model(cfg["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    if ckpt is not None:
+        model.load_state_dict(load_checkpoint(ckpt, use_cuda)["model_state"])
+    if use_cuda:
+        model.cuda()
+    model.eval()
+
+    # encode once, only the search is timed
+    encoded = []
+    dev_iter = make_data_iter(dev_data, batch_size=batch_size, train=False)
+    with torch.no_grad():
+        for torch_batch in iter(dev_iter):
+            batch = Batch(torch_batch, src_vocab.stoi[PAD_TOKEN],
+                          use_cuda=use_cuda)
+            batch.sort_by_src_lengths()
+            encoder_output, encoder_hidden = model.encode(
+                batch.src, batch.src_lengths, batch.src_mask)
+            encoded.append((encoder_output, encoder_hidden, batch.src_mask))
+
+    def decode(beam_size):
+        for encoder_output, encoder_hidden, src_mask in encoded:
+            beam_search(decoder=model.decoder, size=beam_size,
+                        bos_index=model.bos_index, eos_index=model.eos_index,
+                        pad_index=model.pad_index,
+                        encoder_output=encoder_output,
+                        encoder_hidden=encoder_hidden, src_mask=src_mask,
+                        max_output_length=max_output_length, alpha=alpha,
+                        embed=model.trg_embed)
+
+    for beam_size in beam_sizes:
+        with torch.no_grad():
+            decode(beam_size)  # warm-up
+            if use_cuda:
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(repetitions):
+                decode(beam_size)
+            if use_cuda:
+                torch.cuda.synchronize()
+            elapsed = time.time() - start
+        print("beam size {:3d}: {:.2f} ms per sentence ({} sentences)".format(
+            beam_size, 1e3 * elapsed / (repetitions * len(dev_data)),
+            len(dev_data)))
+
+
+# pylint: disable=too-many-locals
+def evaluate_pruning(cfg_file: str, ckpt: str, beam_sizes: list,
+                     max_output_length: int, alpha: float, pruning: dict,
+                     use_cuda: bool) -> None:
+    """
+    Translate the development data sentence by sentence with beam search
+    for each beam size and print the average number of decoding steps and
+    decoded hypotheses per sentence, and the BLEU score.
+
+    :param cfg_file: configuration file with data and model sections
+    :param ckpt: checkpoint of the trained model
+    :param beam_sizes: beam sizes to evaluate
+    :param max_output_length: maximum number of decoding steps
+    :param alpha: length penalty
+    :param pruning: pruning options of `beam_search`
+    :param use_cuda: decode on the GPU
+    """
+    cfg = load_config(cfg_file)
+    _, dev_data, _, src_vocab, trg_vocab = load_data(cfg["data"])
+    model = build_model(cfg["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    model.load_state_dict(load_checkpoint(ckpt, use_cuda)["model_state"])
+    if use_cuda:
+        model.cuda()
+
+    # number of hypotheses in each decoding step
+    rows = []
+    model.decoder.output_layer.register_forward_hook(
+        lambda module, inputs, output: rows.append(output.size(0)))
+
+    for beam_size in beam_sizes:
+        rows.clear()
+        bleu = validate_on_data(
+            model, data=dev_data, batch_size=1, use_cuda=use_cuda,
+            max_output_length=max_output_length, level=cfg["data"]["level"],
+            eval_metric="bleu", beam_size=beam_size, beam_alpha=alpha,
+            pruning=pruning)[0]
+        print("beam size {:3d}: {:.2f} steps and {:.1f} hypotheses per "
+              "sentence, BLEU {:.2f}".format(
+                  beam_size, len(rows) / len(dev_data),
+                  sum(rows) / len(dev_data), bleu))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark beam search.")
+    parser.add_argument("config", type=str,
+                        help="Configuration file, e.g. configs/small.yaml.")
+    parser.add_argument("--ckpt", type=str, default=None,
+                        help="Checkpoint of a trained model.")
+    parser.add_argument("--beam_sizes", type=int, nargs="+",
+                        default=[5, 10, 15, 20], help="Beam sizes.")
+    parser.add_argument("--batch_size", type=int, default=10,
+                        help="Number of sentences decoded together.")
+    parser.add_argument("--max_output_length", type=int, default=50,
+                        help="Maximum number of decoding steps.")
+    parser.add_argument("--alpha", type=float, default=1.0,
+                        help="Length penalty.")
+    parser.add_argument("--relative_threshold", type=float, default=0.,
+                        help="Beam pruning: relative threshold.")
+    parser.add_argument("--absolute_threshold", type=float, default=0.,
+                        help="Beam pruning: absolute threshold.")
+    parser.add_argument("--max_candidates", type=int, default=0,
+                        help="Beam pruning: maximum number of expansions "
+                             "of the same hypothesis.")
+    parser.add_argument("--steps", action="store_true",
+                        help="Print the decoding steps and BLEU of the "
+                             "trained model (--ckpt) instead of the time.")
+    parser.add_argument("--repetitions", type=int, default=5,
+                        help="Number of timed decoding runs.")
+    parser.add_argument("--cuda", action="store_true",
+                        help="Decode on the GPU.")
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    if args.steps:
+        pruning = {name: value for name, value in [
+            ("relative_threshold", args.relative_threshold),
+            ("absolute_threshold", args.absolute_threshold),
+            ("max_candidates", args.max_candidates)] if value > 0}
+        evaluate_pruning(args.config, args.ckpt, args.beam_sizes,
+                         args.max_output_length, args.alpha, pruning,
+                         args.cuda)
+        return
+    benchmark(args.config, args.ckpt, args.beam_sizes, args.batch_size,
+              args.max_output_length, args.alpha, args.repetitions,
+              args.cuda)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark greedy decoding: per-token latency of `joeynmt.search.greedy`
+for a randomly initialized model of a given configuration, and the decoder
+FLOPs that removing finished hypotheses saves for a trained model.
+"""
+
+import argparse
+import time
+
+import torch
+
+from joeynmt.batch import Batch
+from joeynmt.constants import PAD_TOKEN
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.helpers import load_config, load_checkpoint
+from joeynmt.model import build_model
+from joeynmt.search import greedy
+
+
+# pylint: disable=too-many-locals
+def benchmark(cfg_file: str, batch_size: int, max_output_length: int,
+              repetitions: int, use_cuda: bool) -> None:
+    """
+    Decode the first batch of the development data `repetitions` times and
+    print the time per decoded token.
+
+    :param cfg_file: configuration file with data and model sections
+    :param batch_size: number of sentences that are decoded together
+    :param max_output_length: number of decoding steps
+    :param repetitions: number of timed runs
+    :param use_cuda: decode on the GPU
+    """
+    cfg = load_config(cfg_file)
+    _, dev_data, _, src_vocab, trg_vocab = load_data(cfg["data"])
+    model = build_model(cfg["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    if use_cuda:
+        model.cuda()
+    model.eval()
+
+    dev_iter = make_data_iter(dev_data, batch_size=batch_size, train=False)
+    batch = Batch(next(iter(dev_iter)), src_vocab.stoi[PAD_TOKEN],
+                  use_cuda=use_cuda)
+    batch.sort_by_src_lengths()
+
+    with torch.no_grad():
+        encoder_output, encoder_hidden = model.encode(
+            batch.src, batch.src_lengths, batch.src_mask)
+
+        def decode():
+            return greedy(src_mask=batch.src_mask, embed=model.trg_embed,
+                          bos_index=model.bos_index,
+                          eos_index=model.eos_index,
+                          max_output_length=max_output_length,
+                          decoder=model.decoder,
+                          encoder_output=encoder_output,
+                          encoder_hidden=encoder_hidden,
+                          return_logp=True)
+
+        decode()  # warm-up
+        if use_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        tokens = 0
+        for _ in range(repetitions):
+            output, _, _ = decode()
+            tokens += output.size
+        elapsed = time.time() - start
+
+    print("{} sentences, {} steps: {:.1f} us per token, {:.2f} ms per "
+          "step".format(batch.nseqs, output.shape[1], 1e6 * elapsed / tokens,
+                        1e3 * elapsed / (repetitions * output.shape[1])))
+
+
+# pylint: disable=too-many-locals
+def count_decoder_flops(cfg_file: str, ckpt: str, dataset: str,
+                        batch_size: int, max_output_length: int,
+                        use_cuda: bool) -> None:
+    """
+    Decode a dataset greedily with a trained model and print the decoder
+    FLOPs spent on the hypotheses that were still decoded in each step,
+    compared to decoding the full batch until its last hypothesis ends.
+
+    A decoder step is counted as 2 FLOPs per decoder parameter and
+    hypothesis (multiply and add).
+
+    :param cfg_file: configuration file with data and model sections
+    :param ckpt: checkpoint of the trained model
+    :param dataset: "dev" or "test"
+    :param batch_size: number of sentences that are decoded together
+    :param max_output_length: maximum number of decoding steps
+    :param use_cuda: decode on the GPU
+    """
+    cfg = load_config(cfg_file)
+    _, dev_data, test_data, src_vocab, trg_vocab = load_data(cfg["data"])
+    data = dev_data if dataset == "dev" else test_data
+    model = build_model(cfg["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    model.load_state_dict(load_checkpoint(ckpt, use_cuda)["model_state"])
+    if use_cuda:
+        model.cuda()
+    model.eval()
+
+    # number of hypotheses the output layer is applied to
+    rows = []
+    model.decoder.output_layer.register_forward_hook(
+        lambda module, inputs, output: rows.append(output.size(0)))
+
+    computed, full = 0, 0
+    data_iter = make_data_iter(data, batch_size=batch_size, train=False)
+    with torch.no_grad():
+        for torch_batch in iter(data_iter):
+            batch = Batch(torch_batch, src_vocab.stoi[PAD_TOKEN],
+                          use_cuda=use_cuda)
+            batch.sort_by_src_lengths()
+            encoder_output, encoder_hidden = model.encode(
+                batch.src, batch.src_lengths, batch.src_mask)
+            rows.clear()
+            output, _, _ = greedy(
+                src_mask=batch.src_mask, embed=model.trg_embed,
+                bos_index=model.bos_index, eos_index=model.eos_index,
+                max_output_length=max_output_length, decoder=model.decoder,
+                encoder_output=encoder_output,
+                encoder_hidden=encoder_hidden)
+            computed += sum(rows)
+            full += batch.nseqs * output.shape[1]
+
+    params = sum(p.numel() for p in model.decoder.parameters())
+    print("{} {} sentences, batch size {}: {:.3g} decoder FLOPs instead of "
+          "{:.3g} ({:.1f}% saved)".format(
+              len(data), dataset, batch_size, 2 * params * computed,
+              2 * params * full, 100 * (1 - computed / full)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark greedy decoding.")
+    parser.add_argument("config", type=str,
+                        help="Configuration file, e.g. configs/small.yaml.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+",
+                        default=[1, 10, 50],
+                        help="Number of sentences decoded together.")
+    parser.add_argument("--max_output_length", type=int, default=50,
+                        help="Number of decoding steps.")
+    parser.add_argument("--repetitions", type=int, default=20,
+                        help="Number of timed decoding runs.")
+    parser.add_argument("--cuda", action="store_true",
+                        help="Decode on the GPU.")
+    parser.add_argument("--ckpt", type=str, default=None,
+                        help="Count the decoder FLOPs of this trained model "
+                             "instead of measuring the latency.")
+    parser.add_argument("--datasets", type=str, nargs="+",
+                        default=["dev", "test"],
+                        help="Datasets to count the decoder FLOPs on.")
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    for batch_size in args.batch_sizes:
+        if args.ckpt is not None:
+            for dataset in args.datasets:
+                count_decoder_flops(args.config, args.ckpt, dataset,
+                                    batch_size, args.max_output_length,
+                                    args.cuda)
+        else:
+            benchmark(args.config, batch_size, args.max_output_length,
+                      args.repetitions, args.cuda)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark training: target tokens per second of the forward and backward
+pass of `Model.get_loss_for_batch` for a randomly initialized model of a
+given configuration, for variants of the configuration, e.g.
+
+    python scripts/benchmark_training.py configs/iwslt_envi_luong.yaml \
+        --variants model.decoder.input_feeding=True \
+        model.decoder.input_feeding=False
+"""
+
+import argparse
+import copy
+import time
+
+import torch
+import yaml
+
+from joeynmt.batch import Batch
+from joeynmt.constants import PAD_TOKEN
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.helpers import load_config
+from joeynmt.loss import WeightedCrossEntropy
+from joeynmt.model import build_model
+
+
+def apply_overrides(cfg: dict, overrides: str) -> dict:
+    """
+    Copy of a configuration with some of its values replaced.
+
+    :param cfg: configuration
+    :param overrides: comma-separated `key.subkey=value` pairs, the values
+        are parsed as YAML
+    :return: new configuration
+    """
+    cfg = copy.deepcopy(cfg)
+    for override in filter(None, overrides.split(",")):
+        keys, value = override.split("=", 1)
+        keys = keys.split(".")
+        section = cfg
+        for key in keys[:-1]:
+            section = section.setdefault(key, {})
+        section[keys[-1]] = yaml.safe_load(value)
+    return cfg
+
+
+# pylint: disable=too-many-locals
+def benchmark(cfg: dict, data: tuple, batch_size: int, num_batches: int,
+              repetitions: int, use_cuda: bool) -> float:
+    """
+    Compute the loss and the gradients of the first training batches
+    `repetitions` times and return the number of target tokens per second.
+
+    :param cfg: configuration with a model section
+    :param data: training data, source and target vocabulary
+    :param batch_size: number of sentences per batch
+    :param num_batches: number of batches per run
+    :param repetitions: number of timed runs
+    :param use_cuda: train on the GPU
+    :return: target tokens per second
+    """
+    train_data, src_vocab, trg_vocab = data
+    torch.manual_seed(42)
+    model = build_model(cfg["model"], src_vocab=src_vocab,
+                        trg_vocab=trg_vocab)
+    if use_cuda:
+        model.cuda()
+    model.train()
+    loss_function = WeightedCrossEntropy(ignore_index=model.pad_index)
+
+    train_iter = make_data_iter(train_data, batch_size=batch_size,
+                                train=True, shuffle=False)
+    batches = []
+    for torch_batch in iter(train_iter):
+        batch = Batch(torch_batch, src_vocab.stoi[PAD_TOKEN],
+                      use_cuda=use_cuda)
+        batches.append(batch)
+        if len(batches) == num_batches:
+            break
+
+    def run():
+        for batch in batches:
+            model.get_loss_for_batch(batch, loss_function).backward()
+            model.zero_grad()
+
+    run()  # warm-up
+    if use_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repetitions):
+        run()
+    if use_cuda:
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+    return repetitions * sum(batch.ntokens for batch in batches) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark training throughput.")
+    parser.add_argument("config", type=str,
+                        help="Configuration file, e.g. configs/small.yaml.")
+    parser.add_argument("--variants", type=str, nargs="+", default=[""],
+                        help="Variants of the configuration, each as "
+                             "comma-separated key.subkey=value pairs.")
+    parser.add_argument("--batch_size", type=int, default=64,
+                        help="Number of sentences per batch.")
+    parser.add_argument("--num_batches", type=int, default=10,
+                        help="Number of batches per run.")
+    parser.add_argument("--repetitions", type=int, default=3,
+                        help="Number of timed runs.")
+    parser.add_argument("--cuda", action="store_true",
+                        help="Train on the GPU.")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    train_data, _, _, src_vocab, trg_vocab = load_data(cfg["data"])
+    for variant in args.variants:
+        tokens_per_sec = benchmark(
+            apply_overrides(cfg, variant), (train_data, src_vocab, trg_vocab),
+            args.batch_size, args.num_batches, args.repetitions, args.cuda)
+        print("{}: {:.0f} target tokens/sec".format(variant or "default",
+                                                    tokens_per_sec))
+
+
+if __name__ == "__main__":
+    main()
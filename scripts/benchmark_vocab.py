@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark loading vocabulary files of different sizes and looking up
+unknown tokens.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from joeynmt.vocabulary import Vocabulary
+
+
+def benchmark(size: int, lookups: int) -> None:
+    """
+    Write a vocabulary file with `size` entries, load it and look up
+    `lookups` unknown tokens.
+
+    :param size: number of tokens in the vocabulary file
+    :param lookups: number of lookups of unknown tokens
+    """
+    fd, path = tempfile.mkstemp(suffix=".vocab")
+    with os.fdopen(fd, "w") as vocab_file:
+        for i in range(size):
+            vocab_file.write("token{}@@\n".format(i))
+    try:
+        start = time.time()
+        vocab = Vocabulary(file=path)
+        load_time = time.time() - start
+    finally:
+        os.remove(path)
+
+    start = time.time()
+    for i in range(lookups):
+        vocab.stoi["unknown{}".format(i)]  # pylint: disable=pointless-statement
+    lookup_time = time.time() - start
+
+    print("{:>8d} entries: load {:8.3f}s, {} unknown lookups {:6.3f}s, "
+          "stoi size after lookups {}".format(size, load_time, lookups,
+                                              lookup_time, len(vocab.stoi)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark vocabulary loading and lookups.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 50000, 100000],
+                        help="Number of entries of the vocabulary files.")
+    parser.add_argument("--lookups", type=int, default=100000,
+                        help="Number of lookups of unknown tokens.")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        benchmark(size, args.lookups)
+
+
+if __name__ == "__main__":
+    main()
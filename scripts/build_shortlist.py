@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Build the shortlist index of a model from its training data: the target
+tokens that decoding scores for each source token (see
+`joeynmt.shortlist.Shortlist` and the `shortlist` option of `testing`).
+"""
+
+import argparse
+import time
+
+from joeynmt.data import load_data
+from joeynmt.helpers import load_config
+from joeynmt.shortlist import Shortlist
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a vocabulary shortlist from the training data.")
+    parser.add_argument("config", type=str,
+                        help="Configuration file of the model.")
+    parser.add_argument("--output", type=str, required=True,
+                        help="Index file to write, e.g. "
+                             "my_model/shortlist.npz.")
+    parser.add_argument("--num_frequent", type=int, default=100,
+                        help="Number of most frequent target tokens that "
+                             "are always scored.")
+    parser.add_argument("--num_candidates", type=int, default=50,
+                        help="Maximum number of target tokens per source "
+                             "token.")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    train_data, _, _, src_vocab, trg_vocab = load_data(cfg["data"])
+
+    # preprocessed training data contains token IDs instead of tokens
+    def to_ids(tokens, vocab):
+        return [t if isinstance(t, int) else vocab.stoi[t] for t in tokens]
+
+    start = time.time()
+    shortlist = Shortlist.build(
+        ((to_ids(example.src, src_vocab), to_ids(example.trg, trg_vocab))
+         for example in train_data),
+        src_vocab=src_vocab, trg_vocab=trg_vocab,
+        num_frequent=args.num_frequent, num_candidates=args.num_candidates)
+    shortlist.save(args.output)
+    print("Shortlist with {} candidates for {} source tokens and {} frequent "
+          "target tokens built in {:.1f}s, saved to {}".format(
+              len(shortlist.candidates), shortlist.src_vocab_size,
+              len(shortlist.frequent), time.time() - start, args.output))
+
+
+if __name__ == "__main__":
+    main()
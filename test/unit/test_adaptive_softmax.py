@@ -0,0 +1,132 @@
+import torch
+import torch.nn.functional as F
+
+from joeynmt.adaptive_softmax import AdaptiveSoftmax
+from joeynmt.batch import Batch
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.helpers import ConfigurationError
+from joeynmt.loss import WeightedCrossEntropy
+from joeynmt.model import build_model
+from joeynmt.prediction import validate_on_data
+from joeynmt.search import greedy, beam_search
+from .test_helpers import TensorTestCase
+
+
+class TestAdaptiveSoftmax(TensorTestCase):
+
+    def setUp(self):
+        seed = 42
+        torch.manual_seed(seed)
+        self.layer = AdaptiveSoftmax(input_size=6, vocab_size=20,
+                                     cutoffs=[4, 10], div_value=2.)
+
+    def testCutoffs(self):
+        for cutoffs in [[], [0, 10], [10, 4], [4, 20]]:
+            with self.assertRaises(ConfigurationError):
+                AdaptiveSoftmax(input_size=6, vocab_size=20, cutoffs=cutoffs)
+
+    def testLogProbs(self):
+        att_vectors = torch.rand(3, 5, 6)
+        log_probs = self.layer(att_vectors)
+        self.assertEqual(log_probs.shape, (3, 5, 20))
+        self.assertTensorAlmostEqual(log_probs.exp().sum(dim=-1),
+                                     torch.ones(3, 5))
+        target = torch.randint(20, (3, 5))
+        self.assertTensorAlmostEqual(
+            self.layer.target_log_probs(att_vectors, target),
+            log_probs.gather(2, target.unsqueeze(2)).squeeze(2))
+
+    def testTopk(self):
+        att_vectors = torch.rand(7, 6) * 4
+        log_probs = self.layer(att_vectors)
+        for k in [1, 3, 8, 20, 25]:
+            scores, ids = self.layer.topk(att_vectors, k)
+            expected_scores, _ = log_probs.topk(min(k, 20), dim=1)
+            self.assertTensorAlmostEqual(scores, expected_scores)
+            self.assertTensorAlmostEqual(log_probs.gather(1, ids), scores)
+
+    def testLoss(self):
+        loss_function = WeightedCrossEntropy(ignore_index=1)
+        att_vectors = torch.rand(8, 6)
+        target = torch.tensor([0, 1, 5, 12, 1, 19, 3, 9])
+        weights = torch.rand(8)
+        log_probs = self.layer(att_vectors)
+        self.assertTensorAlmostEqual(
+            loss_function(self.layer.target_log_probs(att_vectors, target),
+                          target, weights),
+            loss_function(log_probs, target, weights))
+
+
+class TestAdaptiveSoftmaxModel(TensorTestCase):
+
+    def setUp(self):
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": True, "max_sent_length": 10}
+        _, self.dev_data, _, src_vocab, trg_vocab = load_data(data_cfg)
+        torch.manual_seed(42)
+        model_cfg = {
+            "encoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 7, "num_layers": 2},
+            "decoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 9, "num_layers": 2,
+                        "adaptive_softmax": {"cutoffs": [8, 20]}}}
+        self.model = build_model(model_cfg, src_vocab=src_vocab,
+                                 trg_vocab=trg_vocab)
+        self.model.eval()
+
+    def testLoss(self):
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), self.model.pad_index)
+        batch.sort_by_src_lengths()
+        loss_function = WeightedCrossEntropy(
+            ignore_index=self.model.pad_index)
+        with torch.no_grad():
+            loss = self.model.get_loss_for_batch(batch, loss_function)
+            out, _, _, _ = self.model(
+                src=batch.src, trg_input=batch.trg_input,
+                src_mask=batch.src_mask, src_lengths=batch.src_lengths)
+            expected = loss_function(
+                F.log_softmax(out, dim=-1).view(-1, out.size(-1)),
+                batch.trg.contiguous().view(-1))
+        self.assertTensorAlmostEqual(loss, expected)
+
+    def testDecoding(self):
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), self.model.pad_index)
+        batch.sort_by_src_lengths()
+        encoder_output, encoder_hidden = self.model.encode(
+            batch.src, batch.src_lengths, batch.src_mask)
+        kwargs = {"decoder": self.model.decoder,
+                  "embed": self.model.trg_embed,
+                  "bos_index": self.model.bos_index,
+                  "eos_index": self.model.eos_index,
+                  "encoder_output": encoder_output,
+                  "encoder_hidden": encoder_hidden,
+                  "src_mask": batch.src_mask, "max_output_length": 15,
+                  "return_logp": True}
+
+        with torch.no_grad():
+            # the top-k path gives the same result as scoring all tokens
+            greedy_output, _, greedy_log_probs = greedy(**kwargs)
+            beam_output, _, beam_scores = beam_search(
+                size=3, alpha=1, pad_index=self.model.pad_index, **kwargs)
+            self.model.decoder.output_layer.topk = None
+            full_greedy_output, _, full_greedy_log_probs = greedy(**kwargs)
+            full_beam_output, _, full_beam_scores = beam_search(
+                size=3, alpha=1, pad_index=self.model.pad_index, **kwargs)
+        self.assertEqual(greedy_output.tolist(), full_greedy_output.tolist())
+        self.assertTensorAlmostEqual(torch.Tensor(greedy_log_probs),
+                                     torch.Tensor(full_greedy_log_probs))
+        self.assertEqual(beam_output.tolist(), full_beam_output.tolist())
+        self.assertTensorAlmostEqual(torch.Tensor(beam_scores),
+                                     torch.Tensor(full_beam_scores))
+
+    def testContinuousGreedy(self):
+        outputs = [validate_on_data(
+            self.model, data=self.dev_data, batch_size=4, use_cuda=False,
+            max_output_length=10, level="word", eval_metric="bleu",
+            return_logp=True, num_slots=num_slots) for num_slots in [0, 3]]
+        self.assertEqual(outputs[0][7], outputs[1][7])
+        self.assertTensorAlmostEqual(torch.Tensor(outputs[0][9]),
+                                     torch.Tensor(outputs[1][9]))
@@ -146,6 +146,26 @@ class TestBahdanauAttention(TensorTestCase):
         )
         self.assertTensorAlmostEqual(attention_probs_targets, attention_probs)
 
+    def test_bahdanau_shared_keys(self):
+        # several queries per source sentence give the same results as
+        # copying the keys for each query
+        src_length, batch_size, queries_per_sentence = 5, 3, 4
+        keys = torch.rand(size=(batch_size, src_length, self.key_size))
+        mask = torch.ones(size=(batch_size, 1, src_length)).bool()
+        mask[0, 0, -2:] = False
+        query = torch.rand(size=(batch_size * queries_per_sentence, 1,
+                                 self.query_size))
+        rows = torch.arange(batch_size).repeat_interleave(
+            queries_per_sentence)
+        self.bahdanau_att.compute_proj_keys(keys=keys)
+        context, att_probs = self.bahdanau_att(query=query, mask=mask,
+                                               values=keys)
+        self.bahdanau_att.compute_proj_keys(keys=keys[rows])
+        copied_context, copied_att_probs = self.bahdanau_att(
+            query=query, mask=mask[rows], values=keys[rows])
+        self.assertTensorAlmostEqual(context, copied_context)
+        self.assertTensorAlmostEqual(att_probs, copied_att_probs)
+
     def test_bahdanau_precompute_None(self):
         self.assertIsNone(self.bahdanau_att.proj_keys)
         self.assertIsNone(self.bahdanau_att.proj_query)
@@ -326,6 +346,26 @@ class TestLuongAttention(TensorTestCase):
               [0.2859, 0.1874, 0.2083, 0.1583, 0.1601]]])
         self.assertTensorAlmostEqual(attention_probs_targets, attention_probs)
 
+    def test_luong_shared_keys(self):
+        # several queries per source sentence give the same results as
+        # copying the keys for each query
+        src_length, batch_size, queries_per_sentence = 5, 3, 4
+        keys = torch.rand(size=(batch_size, src_length, self.key_size))
+        mask = torch.ones(size=(batch_size, 1, src_length)).bool()
+        mask[0, 0, -2:] = False
+        query = torch.rand(size=(batch_size * queries_per_sentence, 1,
+                                 self.hidden_size))
+        rows = torch.arange(batch_size).repeat_interleave(
+            queries_per_sentence)
+        self.luong_att.compute_proj_keys(keys=keys)
+        context, att_probs = self.luong_att(query=query, mask=mask,
+                                               values=keys)
+        self.luong_att.compute_proj_keys(keys=keys[rows])
+        copied_context, copied_att_probs = self.luong_att(
+            query=query, mask=mask[rows], values=keys[rows])
+        self.assertTensorAlmostEqual(context, copied_context)
+        self.assertTensorAlmostEqual(att_probs, copied_att_probs)
+
     def test_luong_precompute_None(self):
         self.assertIsNone(self.luong_att.proj_keys)
 
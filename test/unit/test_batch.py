@@ -3,9 +3,10 @@ import random
 
 from torchtext.data.batch import Batch as TorchTBatch
 
-from joeynmt.batch import Batch
+from joeynmt.batch import Batch, BatchPrefetcher, TokenAccumulator
 from joeynmt.data import load_data, make_data_iter
-from joeynmt.constants import PAD_TOKEN
+from joeynmt.constants import PAD_TOKEN, EOS_TOKEN
+from joeynmt.prediction import ValidationCache
 from .test_helpers import TensorTestCase
 
 
@@ -28,6 +29,7 @@ class TestData(TensorTestCase):
         self.train_data, self.dev_data, self.test_data, src_vocab, trg_vocab = \
             load_data(self.data_cfg)
         self.pad_index = trg_vocab.stoi[PAD_TOKEN]
+        self.src_vocab = src_vocab
         # random seeds
         seed = 42
         torch.manual_seed(seed)
@@ -134,3 +136,142 @@ class TestData(TensorTestCase):
         self.assertEqual(total_samples, len(self.dev_data))
 
 
+    def testTokenBatchTrainIterator(self):
+
+        batch_size = 100  # number of padded src+trg tokens
+        train_iter = make_data_iter(self.train_data, train=True, shuffle=True,
+                                    batch_size=batch_size, batch_type="token")
+
+        total_samples = 0
+        for b in iter(train_iter):
+            b = Batch(torch_batch=b, pad_index=self.pad_index)
+            # src has </s>, trg has <s> and </s>
+            padded_tokens = b.src.numel() + b.trg.numel() + b.nseqs
+            if b.nseqs > 1:
+                self.assertLessEqual(padded_tokens, batch_size)
+            total_samples += b.nseqs
+        self.assertEqual(total_samples, len(self.train_data))
+
+    def testTokenAccumulator(self):
+
+        batch_size = 100
+        train_iter = make_data_iter(self.train_data, train=True, shuffle=True,
+                                    batch_size=batch_size, batch_type="tokens")
+        batches = [Batch(torch_batch=b, pad_index=self.pad_index)
+                   for b in iter(train_iter)]
+
+        # one update per batch
+        accumulator = TokenAccumulator(batch_size, batch_multiplier=1)
+        self.assertTrue(all(accumulator.add(b) for b in batches))
+
+        # updates for more than 2 and at most 3 batch sizes
+        accumulator = TokenAccumulator(batch_size, batch_multiplier=3)
+        tokens = 0
+        num_updates = 0
+        for b in batches:
+            tokens += b.src.numel() + b.trg.numel() + b.nseqs
+            if accumulator.add(b):
+                self.assertGreater(tokens, 2 * batch_size)
+                self.assertLessEqual(tokens, 3 * batch_size)
+                tokens = 0
+                num_updates += 1
+        self.assertGreater(num_updates, 0)
+        self.assertLess(num_updates, len(batches))
+
+    def testTokenBatchDevIterator(self):
+
+        batch_size = 100
+        dev_iter = make_data_iter(self.dev_data, train=False, shuffle=False,
+                                  batch_size=batch_size, batch_type="token")
+
+        # order of the examples is kept
+        src = []
+        for b in iter(dev_iter):
+            b = Batch(torch_batch=b, pad_index=self.pad_index)
+            padded_tokens = b.src.numel() + b.trg.numel() + b.nseqs
+            if b.nseqs > 1:
+                self.assertLessEqual(padded_tokens, batch_size)
+            src.extend([s[:l].tolist() for s, l in zip(b.src, b.src_lengths)])
+        eos_index = self.src_vocab.stoi[EOS_TOKEN]
+        expected_src = [[self.src_vocab.stoi[t] for t in ex.src] + [eos_index]
+                        for ex in self.dev_data.examples]
+        self.assertEqual(src, expected_src)
+
+    def testSortByLengthWithWeights(self):
+        data_cfg = dict(self.data_cfg, trg="mt", feedback="feedback",
+                        level="word", max_sent_length=30)
+        train_data, _, _, _, trg_vocab = load_data(data_cfg)
+        train_iter = make_data_iter(train_data, train=False, batch_size=5)
+        torch_batch = next(iter(train_iter))
+        b = Batch(torch_batch=torch_batch, pad_index=self.pad_index)
+
+        # weights are padded with 0s after the artificial weight for </s>
+        for weights, ex_weights, trg_len in zip(b.weights, torch_batch.weights,
+                                                torch_batch.trg[1]):
+            expected = list(ex_weights) + [1.0] + [0.0] * (
+                b.trg.size(1) - len(ex_weights) - 1)
+            self.assertTensorAlmostEqual(torch.Tensor(expected), weights)
+            self.assertEqual(trg_len.item(), len(ex_weights) + 2)
+
+        src, trg, weights = b.src.clone(), b.trg.clone(), b.weights.clone()
+        rev_index = b.sort_by_src_lengths()
+        lengths = b.src_lengths.tolist()
+        self.assertEqual(lengths, sorted(lengths, reverse=True))
+        rev_index = torch.from_numpy(rev_index)
+        self.assertTensorEqual(b.src[rev_index], src)
+        self.assertTensorEqual(b.trg[rev_index], trg)
+        self.assertTensorEqual(b.weights[rev_index], weights)
+
+    def testBatchPrefetcher(self):
+        train_iter = make_data_iter(self.train_data, train=False,
+                                    batch_size=2)
+        expected = [Batch(b, self.pad_index) for b in iter(train_iter)]
+        for num_batches in [0, 1, 3]:
+            prefetcher = BatchPrefetcher(train_iter, self.pad_index,
+                                         num_batches=num_batches)
+            # same batches in the same order, in every epoch
+            for _ in range(2):
+                batches = list(iter(prefetcher))
+                self.assertEqual(len(batches), len(expected))
+                for b, expected_b in zip(batches, expected):
+                    self.assertTensorEqual(b.src, expected_b.src)
+                    self.assertTensorEqual(b.trg, expected_b.trg)
+            # stopping early doesn't block the producer
+            for i, _ in enumerate(prefetcher):
+                if i == 1:
+                    break
+
+    def testSentenceWeights(self):
+        train_iter = make_data_iter(self.train_data, train=False, batch_size=3)
+        torch_batch = next(iter(train_iter))
+        torch_batch.weights = [[0.5], [0.0], [2.0]]
+        b = Batch(torch_batch=torch_batch, pad_index=self.pad_index,
+                  sentence_weights=True)
+        # the weight of each sentence is given to all of its target tokens
+        expected = torch.Tensor([[0.5], [0.0], [2.0]]) * b.trg_mask.float()
+        self.assertTensorEqual(b.weights, expected)
+
+    def testValidationCache(self):
+        cache = ValidationCache(self.dev_data, batch_size=3,
+                                pad_index=self.pad_index, use_cuda=False,
+                                level="char")
+        self.assertTrue(cache.matches(self.dev_data, batch_size=3,
+                                      use_cuda=False, level="char",
+                                      batch_type="sentence"))
+        self.assertFalse(cache.matches(self.dev_data, batch_size=4,
+                                       use_cuda=False, level="char",
+                                       batch_type="sentence"))
+        self.assertEqual(len(cache.sources), len(self.dev_data))
+        self.assertEqual(cache.references[0],
+                         "".join(self.dev_data.examples[0].trg))
+
+        # batches are sorted, the reverse index restores the data order
+        src = []
+        for b, rev_index in zip(cache.batches, cache.sort_reverse_indices):
+            lengths = b.src_lengths.tolist()
+            self.assertEqual(lengths, sorted(lengths, reverse=True))
+            src.extend([b.src[i, :b.src_lengths[i] - 1].tolist()
+                        for i in rev_index])
+        expected_src = [[self.src_vocab.stoi[t] for t in ex.src]
+                        for ex in self.dev_data.examples]
+        self.assertEqual(src, expected_src)
@@ -1,6 +1,13 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from joeynmt.data import MonoDataset, TranslationDataset, load_data
+import numpy as np
+
+from joeynmt.data import MonoDataset, TranslationDataset, BinarizedDataset, \
+    StreamingTranslationDataset, MultiCorpusDataset, load_data, \
+    make_data_iter
 
 
 class TestData(unittest.TestCase):
@@ -110,4 +117,239 @@ class TestData(unittest.TestCase):
                             comparison_src = expected_srcs[level].split()
                             comparison_trg = expected_trgs[level].split()
                     self.assertEqual(train_data.examples[0].src, comparison_src)
-                    self.assertEqual(train_data.examples[0].trg, comparison_trg)
\ No newline at end of file
+                    self.assertEqual(train_data.examples[0].trg, comparison_trg)
+
+    def testBinarizedCache(self):
+        cache_dir = tempfile.mkdtemp()
+        current_cfg = self.data_cfg.copy()
+        current_cfg["level"] = "word"
+        current_cfg["lowercase"] = True
+        train_data, _, _, src_vocab, trg_vocab = load_data(current_cfg)
+
+        current_cfg["cache_dir"] = cache_dir
+        try:
+            # first call writes the cache, second call reads it
+            for _ in range(2):
+                cached_data, _, _, cached_src_vocab, cached_trg_vocab = \
+                    load_data(current_cfg)
+                self.assertIs(type(cached_data), BinarizedDataset)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertEqual(src_vocab.itos, cached_src_vocab.itos)
+                self.assertEqual(trg_vocab.itos, cached_trg_vocab.itos)
+                self.assertEqual(len(cached_data), len(train_data))
+                for ex, cached_ex in zip(train_data, cached_data):
+                    self.assertEqual([src_vocab.stoi[t] for t in ex.src],
+                                     cached_ex.src)
+                    self.assertEqual([trg_vocab.stoi[t] for t in ex.trg],
+                                     cached_ex.trg)
+
+            # a different configuration gets a different cache
+            current_cfg["max_sent_length"] = self.max_sent_length + 1
+            load_data(current_cfg)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testStreamingShards(self):
+        current_cfg = self.data_cfg.copy()
+        current_cfg["level"] = "word"
+        current_cfg["lowercase"] = True
+        train_data, _, _, src_vocab, trg_vocab = load_data(current_cfg)
+
+        # split the training data into two shards
+        shard_dir = tempfile.mkdtemp()
+        for lang in ["de", "en"]:
+            with open("{}.{}".format(self.train_path, lang)) as train_file:
+                lines = train_file.readlines()
+            for i, shard in enumerate([lines[:100], lines[100:]]):
+                shard_path = os.path.join(shard_dir,
+                                          "train.{}.{}".format(i, lang))
+                with open(shard_path, "w") as shard_file:
+                    shard_file.writelines(shard)
+        current_cfg["train"] = os.path.join(shard_dir, "train.*")
+        current_cfg["streaming"] = True
+        try:
+            streamed_data, _, _, streamed_src_vocab, streamed_trg_vocab = \
+                load_data(current_cfg)
+            self.assertIs(type(streamed_data), StreamingTranslationDataset)
+            self.assertEqual(len(streamed_data.shards), 2)
+            # counted while building the vocabularies
+            self.assertEqual(streamed_data.num_examples, len(train_data))
+            self.assertEqual(src_vocab.itos, streamed_src_vocab.itos)
+            self.assertEqual(trg_vocab.itos, streamed_trg_vocab.itos)
+
+            # every example is batched exactly once per epoch
+            buffer_size = 50
+            train_iter = make_data_iter(streamed_data, batch_size=7,
+                                        train=True, shuffle=True,
+                                        buffer_size=buffer_size)
+            for _ in range(2):
+                src_lengths = []
+                for batch in train_iter:
+                    lengths = batch.src[1].tolist()
+                    self.assertEqual(lengths, sorted(lengths, reverse=True))
+                    src_lengths.extend(lengths)
+                self.assertEqual(sorted(src_lengths),
+                                 sorted(len(ex.src) + 1 for ex in train_data))
+
+            # with given vocabularies, the data is not read before training
+            for side, vocab in [("src", src_vocab), ("trg", trg_vocab)]:
+                vocab_file = os.path.join(shard_dir, side + "_vocab.txt")
+                vocab.to_file(vocab_file)
+                current_cfg[side + "_vocab"] = vocab_file
+            streamed_data, _, _, _, _ = load_data(current_cfg)
+            self.assertIsNone(streamed_data.num_examples)
+            with self.assertRaises(TypeError):
+                len(streamed_data)
+            # streamed corpora are measured by their lines
+            current_cfg["train"] = [os.path.join(shard_dir, "train.*"),
+                                    self.dev_path]
+            multi_data, _, _, _, _ = load_data(current_cfg)
+            num_lines = 0
+            for path in [self.train_path, self.dev_path]:
+                with open(path + ".de") as src_file:
+                    num_lines += len(src_file.readlines())
+            self.assertEqual(len(multi_data), num_lines)
+        finally:
+            shutil.rmtree(shard_dir)
+
+    def testParallelLoading(self):
+        for level in self.levels:
+            for trg, feedback in [("en", None), ("mt", "feedback")]:
+                current_cfg = self.data_cfg.copy()
+                current_cfg.update({"level": level, "lowercase": True,
+                                    "trg": trg, "feedback": feedback,
+                                    "max_sent_length": 30})
+                train_data, _, _, src_vocab, trg_vocab = \
+                    load_data(current_cfg)
+
+                current_cfg["num_workers"] = 3
+                parallel_data, _, _, parallel_src_vocab, \
+                    parallel_trg_vocab = load_data(current_cfg)
+
+                # workers yield the same examples in the same order
+                self.assertEqual(len(parallel_data), len(train_data))
+                for ex, parallel_ex in zip(train_data, parallel_data):
+                    self.assertEqual(ex.src, parallel_ex.src)
+                    self.assertEqual(ex.trg, parallel_ex.trg)
+                    if feedback is not None:
+                        self.assertEqual(ex.weights.tolist(),
+                                         parallel_ex.weights.tolist())
+                self.assertEqual(src_vocab.itos, parallel_src_vocab.itos)
+                self.assertEqual(trg_vocab.itos, parallel_trg_vocab.itos)
+
+                # counting pass for streamed data
+                current_cfg["streaming"] = True
+                streamed_data, _, _, streamed_src_vocab, _ = \
+                    load_data(current_cfg)
+                self.assertEqual(streamed_data.num_examples, len(train_data))
+                self.assertEqual(src_vocab.itos, streamed_src_vocab.itos)
+
+    def testFeedbackWeights(self):
+        current_cfg = self.data_cfg.copy()
+        current_cfg.update({"lowercase": True, "trg": "mt",
+                            "feedback": "feedback", "max_sent_length": 30})
+        for level in self.levels:
+            current_cfg["level"] = level
+            train_data, _, _, _, _ = load_data(current_cfg)
+            # weights are views on one float32 buffer
+            self.assertEqual(train_data.weights_buffer.dtype, np.float32)
+            self.assertEqual(len(train_data.weights_offsets),
+                             len(train_data) + 1)
+            for ex in train_data.examples:
+                self.assertTrue(np.shares_memory(ex.weights,
+                                                 train_data.weights_buffer))
+                self.assertEqual(len(ex.weights), len(ex.trg))
+
+        # one weight per sentence, every second one is zero
+        tmp_dir = tempfile.mkdtemp()
+        with open(self.train_path + ".feedback") as feedback_file:
+            num_lines = len(feedback_file.readlines())
+        with open(os.path.join(tmp_dir, "train.feedback"), "w") as out_file:
+            for i in range(num_lines):
+                out_file.write("{}\n".format(0.0 if i % 2 else 0.5))
+        for lang in ["de", "mt"]:
+            shutil.copy("{}.{}".format(self.train_path, lang), tmp_dir)
+        current_cfg.update({"train": os.path.join(tmp_dir, "train"),
+                            "level": "word", "feedback_level": "sentence"})
+        try:
+            train_data, _, _, _, _ = load_data(current_cfg)
+            self.assertIsNone(train_data.zero_feedback_dropped)
+            self.assertTrue(all(len(ex.weights) == 1
+                                for ex in train_data.examples))
+            num_zero = sum(1 for ex in train_data.examples
+                           if ex.weights[0] == 0)
+
+            # drop all examples with zero feedback
+            current_cfg["keep_zero_feedback"] = 0.0
+            sampled_data, _, _, _, _ = load_data(current_cfg)
+            self.assertEqual(sampled_data.zero_feedback_dropped[0], num_zero)
+            self.assertEqual(len(sampled_data), len(train_data) - num_zero)
+            self.assertTrue(all(ex.weights[0] == 0.5
+                                for ex in sampled_data.examples))
+
+            # the cache keeps all examples, every run samples and reports
+            current_cfg["cache_dir"] = os.path.join(tmp_dir, "cache")
+            for _ in range(2):
+                cached_data, _, _, _, _ = load_data(current_cfg)
+                self.assertIs(type(cached_data), BinarizedDataset)
+                self.assertEqual(cached_data.zero_feedback_dropped,
+                                 sampled_data.zero_feedback_dropped)
+                self.assertEqual(len(cached_data), len(sampled_data))
+                self.assertTrue(all(ex.weights[0] == 0.5
+                                    for ex in cached_data))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def testMultipleCorpora(self):
+        current_cfg = self.data_cfg.copy()
+        current_cfg.update({"level": "word", "lowercase": True})
+
+        # concatenation of training and dev data as a single corpus
+        tmp_dir = tempfile.mkdtemp()
+        for lang in ["de", "en"]:
+            with open(os.path.join(tmp_dir, "all." + lang), "w") as out_file:
+                for path in [self.train_path, self.dev_path]:
+                    with open("{}.{}".format(path, lang)) as in_file:
+                        out_file.write(in_file.read())
+        current_cfg["train"] = os.path.join(tmp_dir, "all")
+        try:
+            all_data, _, _, all_src_vocab, all_trg_vocab = \
+                load_data(current_cfg)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        current_cfg["train"] = [{"path": self.train_path, "weight": 2.0},
+                                self.dev_path]
+        for temperature in [1.0, 2.0]:
+            current_cfg["temperature"] = temperature
+            train_data, _, _, src_vocab, trg_vocab = load_data(current_cfg)
+            self.assertIs(type(train_data), MultiCorpusDataset)
+            self.assertEqual(len(train_data), len(all_data))
+            # the vocabularies are built from all corpora together
+            self.assertEqual(src_vocab.itos, all_src_vocab.itos)
+            self.assertEqual(trg_vocab.itos, all_trg_vocab.itos)
+
+            sizes = [len(corpus) for corpus in train_data.datasets]
+            scores = [(2.0 * sizes[0]) ** (1 / temperature),
+                      sizes[1] ** (1 / temperature)]
+            for probability, score in zip(train_data.probabilities, scores):
+                self.assertAlmostEqual(probability, score / sum(scores))
+
+        # each batch comes from one corpus, an epoch has about the same size
+        train_iter = make_data_iter(train_data, batch_size=5, train=True,
+                                    shuffle=True)
+        dev_srcs = set(tuple(ex.src) for ex in train_data.datasets[1])
+        num_examples = 0
+        num_dev_batches = 0
+        for batch in train_iter:
+            srcs = [tuple(src[:length - 1]) for src, length in
+                    zip(batch.src[0].tolist(), batch.src[1].tolist())]
+            srcs = [tuple(src_vocab.itos[t] for t in src) for src in srcs]
+            from_dev = [src in dev_srcs for src in srcs]
+            self.assertIn(sum(from_dev), [0, len(srcs)])
+            num_dev_batches += from_dev[0]
+            num_examples += len(srcs)
+        self.assertGreater(num_dev_batches, 0)
+        self.assertGreaterEqual(num_examples, len(train_data))
+        self.assertLess(num_examples, len(train_data) + 5)
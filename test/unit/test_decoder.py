@@ -231,3 +231,131 @@ class TestRecurrentDecoder(TensorTestCase):
         # att_probs should be a distribution over the output vocabulary
         self.assertTensorAlmostEqual(att_probs.sum(2),
                                      torch.ones(batch_size, time_dim))
+
+    def test_recurrent_step(self):
+        time_dim = 4
+        batch_size = 3
+        for rnn_type, attention in [("gru", "bahdanau"), ("lstm", "luong")]:
+            decoder = RecurrentDecoder(rnn_type=rnn_type,
+                                       hidden_size=self.hidden_size,
+                                       encoder=self.encoders[0],
+                                       attention=attention,
+                                       emb_size=self.emb_size,
+                                       vocab_size=self.vocab_size,
+                                       num_layers=self.num_layers,
+                                       init_hidden="bridge",
+                                       input_feeding=True)
+            encoder_states = torch.rand(size=(batch_size, time_dim,
+                                              self.encoders[0].output_size))
+            trg_inputs = torch.rand(size=(batch_size, time_dim,
+                                          self.emb_size))
+            mask = torch.ones(size=(batch_size, 1, time_dim)) > 0
+            mask[0, 0, -1] = False
+            output, _, att_probs, _ = decoder(
+                trg_inputs, encoder_hidden=encoder_states[:, -1, :],
+                encoder_output=encoder_states, src_mask=mask,
+                unrol_steps=time_dim)
+
+            # step by step with the same results, rows can be reordered
+            state = decoder.init_state(encoder_output=encoder_states,
+                                       encoder_hidden=encoder_states[:, -1, :],
+                                       src_mask=mask)
+            reverse = torch.arange(batch_size - 1, -1, -1)
+            state = state.index_select(reverse)
+            for i in range(time_dim):
+                step_output, state, step_att_probs = decoder.step(
+                    trg_inputs[reverse, i].unsqueeze(1), state,
+                    check_shapes=True)
+                self.assertTensorAlmostEqual(output[reverse, i],
+                                             step_output.squeeze(1))
+                self.assertTensorAlmostEqual(att_probs[reverse, i],
+                                             step_att_probs.squeeze(1))
+
+    def test_recurrent_forward_sequence(self):
+        time_dim = 5
+        batch_size = 3
+        for rnn_type, attention in [("gru", "bahdanau"), ("lstm", "luong")]:
+            decoder = RecurrentDecoder(rnn_type=rnn_type,
+                                       hidden_size=self.hidden_size,
+                                       encoder=self.encoders[1],
+                                       attention=attention,
+                                       emb_size=self.emb_size,
+                                       vocab_size=self.vocab_size,
+                                       num_layers=self.num_layers,
+                                       init_hidden="bridge",
+                                       input_feeding=False)
+            encoder_states = torch.rand(size=(batch_size, time_dim,
+                                              self.encoders[1].output_size))
+            trg_inputs = torch.rand(size=(batch_size, time_dim,
+                                          self.emb_size))
+            mask = torch.ones(size=(batch_size, 1, time_dim)) > 0
+            mask[0, 0, -2:] = False
+            output, hidden, att_probs, att_vectors = decoder(
+                trg_inputs, encoder_hidden=encoder_states[:, -1, :],
+                encoder_output=encoder_states, src_mask=mask,
+                unrol_steps=time_dim)
+
+            # all steps at once give the same results as one step at a time
+            step_att_vectors, step_hidden, step_att_probs = decoder._unroll(
+                trg_embed=trg_inputs, encoder_output=encoder_states,
+                src_mask=mask, unrol_steps=time_dim,
+                hidden=decoder._init_hidden(encoder_states[:, -1, :]))
+            self.assertTensorAlmostEqual(att_vectors, step_att_vectors)
+            self.assertTensorAlmostEqual(att_probs, step_att_probs)
+            self.assertTensorAlmostEqual(
+                output, decoder.output_layer(step_att_vectors))
+            if rnn_type == "lstm":
+                hidden, step_hidden = hidden[0], step_hidden[0]
+            self.assertTensorAlmostEqual(hidden, step_hidden)
+
+    def test_recurrent_skip_padding(self):
+        time_dim = 5
+        batch_size = 4
+        trg_lengths = torch.tensor([3, 5, 1, 4])
+        for rnn_type, input_feeding in [("gru", True), ("lstm", True),
+                                        ("lstm", False)]:
+            decoder = RecurrentDecoder(rnn_type=rnn_type,
+                                       hidden_size=self.hidden_size,
+                                       encoder=self.encoders[0],
+                                       attention="bahdanau",
+                                       emb_size=self.emb_size,
+                                       vocab_size=self.vocab_size,
+                                       num_layers=self.num_layers,
+                                       init_hidden="bridge",
+                                       input_feeding=input_feeding,
+                                       skip_padding=True)
+            encoder_states = torch.rand(size=(batch_size, time_dim,
+                                              self.encoders[0].output_size))
+            trg_inputs = torch.rand(size=(batch_size, time_dim,
+                                          self.emb_size))
+            mask = torch.ones(size=(batch_size, 1, time_dim)) > 0
+            kwargs = {"encoder_hidden": encoder_states[:, -1, :],
+                      "encoder_output": encoder_states, "src_mask": mask,
+                      "unrol_steps": time_dim}
+            output, hidden, att_probs, _ = decoder(
+                trg_inputs, trg_lengths=trg_lengths, **kwargs)
+            full_output, _, full_att_probs, _ = decoder(trg_inputs, **kwargs)
+
+            # the same results before the end of each target
+            for i, length in enumerate(trg_lengths.tolist()):
+                self.assertTensorAlmostEqual(output[i, :length],
+                                             full_output[i, :length])
+                self.assertTensorAlmostEqual(att_probs[i, :length],
+                                             full_att_probs[i, :length])
+                if input_feeding:
+                    # steps after the end are not computed
+                    self.assertTensorAlmostEqual(
+                        att_probs[i, length:],
+                        torch.zeros_like(att_probs[i, length:]))
+                # the hidden state after the last step of the target
+                _, last_hidden, _, _ = decoder(
+                    trg_inputs[i:i + 1, :length],
+                    encoder_hidden=encoder_states[i:i + 1, -1, :],
+                    encoder_output=encoder_states[i:i + 1],
+                    src_mask=mask[i:i + 1], unrol_steps=length)
+                if rnn_type == "lstm":
+                    self.assertTensorAlmostEqual(hidden[0][:, i],
+                                                 last_hidden[0][:, 0])
+                else:
+                    self.assertTensorAlmostEqual(hidden[:, i],
+                                                 last_hidden[:, 0])
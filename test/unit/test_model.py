@@ -0,0 +1,48 @@
+import torch
+
+from joeynmt.batch import Batch
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.loss import WeightedCrossEntropy
+from joeynmt.model import build_model
+from .test_helpers import TensorTestCase
+
+
+class TestModel(TensorTestCase):
+
+    def setUp(self):
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": True, "max_sent_length": 10}
+        _, self.dev_data, _, src_vocab, trg_vocab = load_data(data_cfg)
+        self.model_cfg = {
+            "encoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 7, "num_layers": 2},
+            "decoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 9, "num_layers": 2}}
+        self.vocabs = {"src_vocab": src_vocab, "trg_vocab": trg_vocab}
+
+    def testChunkedLoss(self):
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), pad_index=1)
+        batch.sort_by_src_lengths()
+        # feedback weights, some of them zero
+        batch.weights = torch.rand(batch.trg.size()).masked_fill(
+            torch.rand(batch.trg.size()) < 0.3, 0.)
+        losses = []
+        grads = []
+        for chunk_size in [0, 1, 7]:
+            torch.manual_seed(42)
+            self.model_cfg["loss_chunk_size"] = chunk_size
+            model = build_model(self.model_cfg, **self.vocabs)
+            loss = model.get_loss_for_batch(
+                batch, WeightedCrossEntropy(ignore_index=model.pad_index))
+            loss.backward()
+            losses.append(loss.detach())
+            grads.append([p.grad.clone() for p in model.parameters()
+                          if p.grad is not None])
+
+        for loss, grad in zip(losses[1:], grads[1:]):
+            self.assertTensorAlmostEqual(loss, losses[0])
+            self.assertEqual(len(grad), len(grads[0]))
+            for chunk_grad, full_grad in zip(grad, grads[0]):
+                self.assertTensorAlmostEqual(chunk_grad, full_grad)
@@ -0,0 +1,220 @@
+from unittest import mock
+
+import torch
+
+from joeynmt import model as model_module
+from joeynmt.batch import Batch
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.model import build_model
+from joeynmt.prediction import validate_on_data, \
+    count_length_limit_hits, ValidationCache
+from joeynmt.search import greedy, beam_search, output_length_limits
+from .test_helpers import TensorTestCase
+
+
+class TestSearch(TensorTestCase):
+
+    def setUp(self):
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": True, "max_sent_length": 10}
+        _, self.dev_data, _, src_vocab, trg_vocab = load_data(data_cfg)
+
+        seed = 42
+        torch.manual_seed(seed)
+        self.model_cfg = {
+            "encoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 7, "num_layers": 2},
+            "decoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 9, "num_layers": 2}}
+        self.vocabs = {"src_vocab": src_vocab, "trg_vocab": trg_vocab}
+
+    def _build_model(self, rnn_type, attention):
+        self.model_cfg["encoder"]["rnn_type"] = rnn_type
+        self.model_cfg["decoder"]["rnn_type"] = rnn_type
+        self.model_cfg["decoder"]["attention"] = attention
+        model = build_model(self.model_cfg, **self.vocabs)
+        # let hypotheses end after different numbers of steps
+        weight = model.decoder.output_layer.weight
+        with torch.no_grad():
+            weight[model.eos_index] = weight.mean(dim=0) \
+                + 3 * torch.randn(weight.size(1))
+        return model
+
+    def testContinuousGreedy(self):
+        for rnn_type, attention in [("gru", "bahdanau"), ("lstm", "luong")]:
+            model = self._build_model(rnn_type, attention)
+            outputs = {}
+            for num_slots in [0, 1, 3, 8]:
+                _, _, _, _, _, _, hypotheses, _, attention_scores, \
+                    log_probs = validate_on_data(
+                        model, data=self.dev_data, batch_size=8,
+                        use_cuda=False, max_output_length=20, level="word",
+                        eval_metric="bleu", return_logp=True,
+                        num_slots=num_slots)
+                outputs[num_slots] = (hypotheses, log_probs)
+                self.assertEqual(len(attention_scores), len(self.dev_data))
+
+            # same translations as batch by batch, in the same order
+            for num_slots in [1, 3, 8]:
+                self.assertEqual(outputs[num_slots][0], outputs[0][0])
+                self.assertTensorAlmostEqual(
+                    torch.Tensor(outputs[0][1]),
+                    torch.Tensor(outputs[num_slots][1]))
+            self.assertGreater(len(set(len(h.split())
+                                       for h in outputs[0][0])), 1)
+
+    def testBeamSearch(self):
+        model = self._build_model("gru", "bahdanau")
+        model.eval()
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), model.pad_index)
+        batch.sort_by_src_lengths()
+        encoder_output, encoder_hidden = model.encode(
+            batch.src, batch.src_lengths, batch.src_mask)
+        kwargs = {"decoder": model.decoder, "embed": model.trg_embed,
+                  "bos_index": model.bos_index, "eos_index": model.eos_index,
+                  "encoder_output": encoder_output,
+                  "encoder_hidden": encoder_hidden,
+                  "src_mask": batch.src_mask, "max_output_length": 15}
+
+        with torch.no_grad():
+            # a beam of size 1 is greedy decoding
+            greedy_output, _, _ = greedy(**kwargs)
+            output, attention, _ = beam_search(
+                size=1, alpha=-1, pad_index=model.pad_index, **kwargs)
+            self.assertEqual(
+                model.trg_vocab.arrays_to_sentences(output),
+                model.trg_vocab.arrays_to_sentences(greedy_output))
+            self.assertEqual(attention.shape[0], batch.nseqs)
+            self.assertEqual(attention.shape[2], batch.src.size(1))
+
+            # the search continues until n hypotheses have finished, so the
+            # best of them is at least as good as the 1 best hypothesis
+            _, _, best_scores = beam_search(
+                size=4, alpha=1, pad_index=model.pad_index, n_best=1,
+                return_logp=True, **kwargs)
+            for n_best in [3, 4]:
+                output, attention, scores = beam_search(
+                    size=4, alpha=1, pad_index=model.pad_index,
+                    n_best=n_best, return_logp=True, **kwargs)
+                self.assertEqual(output.shape[0], n_best * batch.nseqs)
+                self.assertEqual(attention.shape[:2], output.shape)
+                # no empty hypotheses
+                self.assertTrue((scores > float("-inf")).all())
+                self.assertTrue((output[:, 0] != model.pad_index).all())
+                scores = scores.reshape(batch.nseqs, n_best)
+                self.assertTrue((scores[:, :-1] >= scores[:, 1:]).all())
+                self.assertTrue((scores[:, 0] >= best_scores - 1e-4).all())
+
+    def testBeamSearchPruning(self):
+        model = self._build_model("lstm", "luong")
+        model.eval()
+        settings = [{}, {"relative_threshold": 1e-30},
+                    {"absolute_threshold": 1e30}, {"max_candidates": 4},
+                    {"relative_threshold": 0.5, "absolute_threshold": 0.5,
+                     "max_candidates": 1}]
+        outputs = []
+        for pruning in settings:
+            _, _, _, _, _, _, hypotheses, _, attention_scores, \
+                log_probs = validate_on_data(
+                    model, data=self.dev_data, batch_size=8,
+                    use_cuda=False, max_output_length=20, level="word",
+                    eval_metric="bleu", return_logp=True, beam_size=4,
+                    beam_alpha=1, pruning=pruning)
+            self.assertEqual(len(attention_scores), len(self.dev_data))
+            self.assertTrue(all(lp > float("-inf") for lp in log_probs))
+            outputs.append((hypotheses, log_probs))
+
+        # thresholds that do not prune anything do not change the result
+        for hypotheses, log_probs in outputs[1:4]:
+            self.assertEqual(hypotheses, outputs[0][0])
+            self.assertTensorAlmostEqual(torch.Tensor(log_probs),
+                                         torch.Tensor(outputs[0][1]))
+        # pruning all but the best expansion is greedy decoding with the
+        # length penalty applied to the score
+        greedy_hypotheses = validate_on_data(
+            model, data=self.dev_data, batch_size=8, use_cuda=False,
+            max_output_length=20, level="word", eval_metric="bleu")[6]
+        self.assertEqual(outputs[4][0], greedy_hypotheses)
+
+    def testValidationCache(self):
+        # the same results with cached batches as with batches created one
+        # at a time
+        model = self._build_model("gru", "bahdanau")
+        cache = ValidationCache(self.dev_data, batch_size=8,
+                                pad_index=model.pad_index, use_cuda=False,
+                                level="word")
+        for num_slots in [0, 3]:
+            outputs = [validate_on_data(
+                model, data=self.dev_data, batch_size=8, use_cuda=False,
+                max_output_length=20, level="word", eval_metric="bleu",
+                return_logp=True, num_slots=num_slots, cache=valid_cache)
+                       for valid_cache in [None, cache]]
+            self.assertEqual(outputs[0][3:8], outputs[1][3:8])
+            self.assertTensorAlmostEqual(torch.Tensor(outputs[0][9]),
+                                         torch.Tensor(outputs[1][9]))
+
+    def testLengthLimits(self):
+        src_lengths = torch.tensor([2, 4, 10])
+        self.assertEqual(output_length_limits(src_lengths).tolist(),
+                         [3, 6, 15])
+        self.assertEqual(output_length_limits(
+            src_lengths, max_output_length=7).tolist(), [7, 7, 7])
+        self.assertEqual(output_length_limits(
+            src_lengths, max_output_length=7, ratio=1.,
+            offset=-3).tolist(), [1, 1, 7])
+
+        model = self._build_model("gru", "bahdanau")
+        for beam_size in [0, 3]:
+            outputs = {}
+            for length_ratio in [None, 0.5]:
+                _, _, _, _, sources_raw, _, _, hypotheses_raw, _, \
+                    _ = validate_on_data(
+                        model, data=self.dev_data, batch_size=8,
+                        use_cuda=False, max_output_length=20, level="word",
+                        eval_metric="bleu", beam_size=beam_size,
+                        beam_alpha=-1, length_ratio=length_ratio,
+                        length_offset=1)
+                limits = [int(0.5 * (len(src) + 1) + 1) if length_ratio
+                          else 20 for src in sources_raw]
+                self.assertTrue(all(len(hyp) <= limit for hyp, limit
+                                    in zip(hypotheses_raw, limits)))
+                outputs[length_ratio] = (sources_raw, hypotheses_raw)
+            # hypotheses stop at their own limit, not the batch's longest
+            hits = count_length_limit_hits(
+                *outputs[0.5], max_output_length=20, length_ratio=0.5,
+                length_offset=1)
+            self.assertGreater(hits, 0)
+            if beam_size == 0:
+                for (hyp, limited) in zip(outputs[None][1], outputs[0.5][1]):
+                    self.assertEqual(hyp[:len(limited)], limited)
+
+    def testLengthLimitsDevice(self):
+        # the source lengths stay on the CPU, the limits are moved to the
+        # device of the encoder states
+        use_cuda = torch.cuda.is_available()
+        model = self._build_model("gru", "bahdanau")
+        if use_cuda:
+            model.cuda()
+        dev_iter = make_data_iter(self.dev_data, batch_size=4, train=False,
+                                  shuffle=False)
+        batch = Batch(next(iter(dev_iter)), model.pad_index,
+                      use_cuda=use_cuda)
+        batch.sort_by_src_lengths()
+        self.assertEqual(batch.src_lengths.device.type, "cpu")
+        model.eval()
+        for beam_size, search in [(0, "greedy"), (3, "beam_search")]:
+            search_fn = getattr(model_module, search)
+            with torch.no_grad():
+                with mock.patch.object(model_module, search,
+                                       wraps=search_fn) as wrapped:
+                    model.run_batch(batch, max_output_length=None,
+                                    beam_size=beam_size, beam_alpha=1.,
+                                    length_ratio=1.5)
+                kwargs = wrapped.call_args[1]
+                self.assertEqual(kwargs["max_lengths"].device,
+                                 kwargs["encoder_output"].device)
+                # limits on the CPU work with device tensors as well
+                kwargs["max_lengths"] = kwargs["max_lengths"].cpu()
+                search_fn(**kwargs)
@@ -0,0 +1,105 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from joeynmt.constants import EOS_TOKEN, UNK_TOKEN
+from joeynmt.data import load_data
+from joeynmt.helpers import ConfigurationError
+from joeynmt.model import build_model
+from joeynmt.prediction import validate_on_data
+from joeynmt.shortlist import Shortlist
+from .test_helpers import TensorTestCase
+
+
+class TestShortlist(TensorTestCase):
+
+    def setUp(self):
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": True, "max_sent_length": 10}
+        self.train_data, self.dev_data, _, self.src_vocab, self.trg_vocab = \
+            load_data(data_cfg)
+
+    def _build(self, **kwargs):
+        pairs = [([self.src_vocab.stoi[t] for t in example.src],
+                  [self.trg_vocab.stoi[t] for t in example.trg])
+                 for example in self.train_data]
+        return Shortlist.build(pairs, src_vocab=self.src_vocab,
+                               trg_vocab=self.trg_vocab, **kwargs)
+
+    def testBuild(self):
+        shortlist = self._build(num_frequent=5, num_candidates=3,
+                                chunk_size=7)
+        self.assertEqual(shortlist.src_vocab_size, len(self.src_vocab))
+        self.assertEqual(len(shortlist.offsets), len(self.src_vocab) + 1)
+        self.assertTrue(np.all(np.diff(shortlist.offsets) <= 3))
+        self.assertTrue(np.all(shortlist.candidates < len(self.trg_vocab)))
+        self.assertIn(self.trg_vocab.stoi[EOS_TOKEN], shortlist.frequent)
+        self.assertIn(self.trg_vocab.stoi[UNK_TOKEN], shortlist.frequent)
+        # counting in chunks does not change the result
+        unchunked = self._build(num_frequent=5, num_candidates=3)
+        self.assertTrue(np.array_equal(shortlist.offsets, unchunked.offsets))
+        self.assertTrue(np.array_equal(shortlist.candidates,
+                                       unchunked.candidates))
+
+        # a source word that always occurs with a target word has it as
+        # its best candidate
+        src = [self.src_vocab.stoi[t] for t in self.train_data[0].src]
+        trg = [self.trg_vocab.stoi[t] for t in self.train_data[0].trg]
+        vocabulary = shortlist.vocabulary(torch.tensor([src]))
+        self.assertEqual(vocabulary.tolist(), sorted(vocabulary.tolist()))
+        self.assertTrue(set(shortlist.frequent.tolist())
+                        <= set(vocabulary.tolist()))
+        self.assertTrue(set(trg) & set(vocabulary.tolist()))
+
+    def testSaveLoad(self):
+        shortlist = self._build(num_frequent=5, num_candidates=3)
+        fd, path = tempfile.mkstemp(suffix=".npz")
+        os.close(fd)
+        try:
+            shortlist.save(path)
+            loaded = Shortlist.load(path, src_vocab=self.src_vocab,
+                                    trg_vocab=self.trg_vocab)
+            with self.assertRaises(ConfigurationError):
+                Shortlist.load(path, src_vocab=self.trg_vocab,
+                               trg_vocab=self.src_vocab)
+        finally:
+            os.remove(path)
+        for name in ["offsets", "candidates", "frequent"]:
+            self.assertTrue(np.array_equal(getattr(shortlist, name),
+                                           getattr(loaded, name)))
+        self.assertEqual(loaded.trg_vocab_size, len(self.trg_vocab))
+
+    def testDecoding(self):
+        torch.manual_seed(42)
+        model_cfg = {
+            "encoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 7, "num_layers": 2},
+            "decoder": {"rnn_type": "gru", "embeddings": {"embedding_dim": 8},
+                        "hidden_size": 9, "num_layers": 2,
+                        "attention": "bahdanau"}}
+        model = build_model(model_cfg, src_vocab=self.src_vocab,
+                            trg_vocab=self.trg_vocab)
+        # a shortlist of the whole vocabulary does not change the output
+        full = self._build(num_frequent=len(self.trg_vocab))
+        small = self._build(num_frequent=5, num_candidates=3)
+        for beam_size in [0, 3]:
+            outputs = {}
+            for name, shortlist in [("none", None), ("full", full),
+                                    ("small", small)]:
+                outputs[name] = validate_on_data(
+                    model, data=self.dev_data, batch_size=4, use_cuda=False,
+                    max_output_length=10, level="word", eval_metric="bleu",
+                    beam_size=beam_size, beam_alpha=1, return_logp=True,
+                    shortlist=shortlist, num_slots=2)
+            self.assertEqual(outputs["full"][7], outputs["none"][7])
+            self.assertTensorAlmostEqual(torch.Tensor(outputs["full"][9]),
+                                         torch.Tensor(outputs["none"][9]))
+            # a smaller shortlist only produces the words it lists
+            words = {self.trg_vocab.itos[i] for i in range(len(
+                self.trg_vocab)) if i in set(small.frequent.tolist())
+                     | set(small.candidates.tolist())}
+            self.assertTrue(all(set(hyp) <= words
+                                for hyp in outputs["small"][7]))
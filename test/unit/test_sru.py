@@ -0,0 +1,84 @@
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from joeynmt.decoders import RecurrentDecoder
+from joeynmt.encoders import RecurrentEncoder
+from joeynmt.sru import SRU
+from .test_helpers import TensorTestCase
+
+
+class TestSRU(TensorTestCase):
+
+    def setUp(self):
+        self.input_size = 5
+        self.hidden_size = 4
+        seed = 42
+        torch.manual_seed(seed)
+
+    def test_sru_shapes(self):
+        for bidirectional in [False, True]:
+            sru = SRU(self.input_size, self.hidden_size, num_layers=3,
+                      bidirectional=bidirectional)
+            directions = 2 if bidirectional else 1
+            output, hidden = sru(torch.rand(2, 6, self.input_size))
+            self.assertEqual(output.shape,
+                             (2, 6, directions * self.hidden_size))
+            self.assertEqual(hidden.shape,
+                             (3 * directions, 2, self.hidden_size))
+
+    def test_sru_steps(self):
+        # one step at a time from the previous state gives the same outputs
+        sru = SRU(self.input_size, self.hidden_size, num_layers=2)
+        inputs = torch.rand(3, 4, self.input_size)
+        output, hidden = sru(inputs)
+        state = None
+        for t in range(inputs.size(1)):
+            step_output, state = sru(inputs[:, t:t + 1], state)
+            self.assertTensorAlmostEqual(step_output[:, 0], output[:, t])
+        self.assertTensorAlmostEqual(state, hidden)
+
+    def test_sru_packed(self):
+        # padding does not change the outputs and final states
+        sru = SRU(self.input_size, self.hidden_size, num_layers=2,
+                  bidirectional=True)
+        inputs = torch.rand(3, 5, self.input_size)
+        lengths = torch.tensor([5, 3, 2])
+        output, hidden = sru(pack_padded_sequence(inputs, lengths,
+                                                  batch_first=True))
+        output, _ = pad_packed_sequence(output, batch_first=True)
+        for i, length in enumerate(lengths.tolist()):
+            single_output, single_hidden = sru(inputs[i:i + 1, :length])
+            self.assertTensorAlmostEqual(output[i, :length],
+                                         single_output[0])
+            self.assertTensorAlmostEqual(hidden[:, i], single_hidden[:, 0])
+
+    def test_sru_encoder_decoder(self):
+        encoder = RecurrentEncoder(rnn_type="sru", emb_size=self.input_size,
+                                   hidden_size=self.hidden_size,
+                                   num_layers=2, bidirectional=True)
+        src = torch.rand(3, 5, self.input_size)
+        src_length = torch.tensor([5, 4, 2])
+        src_mask = (torch.arange(5)[None, :] < src_length[:, None]) \
+            .unsqueeze(1)
+        encoder_output, encoder_hidden = encoder(src, src_length, src_mask)
+        self.assertEqual(encoder_hidden.shape, (3, 2 * self.hidden_size))
+
+        for input_feeding in [True, False]:
+            decoder = RecurrentDecoder(rnn_type="sru", emb_size=6,
+                                       hidden_size=self.hidden_size,
+                                       encoder=encoder, num_layers=2,
+                                       vocab_size=7, init_hidden="bridge",
+                                       input_feeding=input_feeding)
+            trg_embed = torch.rand(3, 4, 6)
+            output, _, _, _ = decoder(
+                trg_embed, encoder_output=encoder_output,
+                encoder_hidden=encoder_hidden, src_mask=src_mask,
+                unrol_steps=4)
+            state = decoder.init_state(encoder_output=encoder_output,
+                                       encoder_hidden=encoder_hidden,
+                                       src_mask=src_mask)
+            for t in range(4):
+                step_output, state, _ = decoder.step(
+                    trg_embed[:, t:t + 1], state, check_shapes=True)
+                self.assertTensorAlmostEqual(step_output[:, 0],
+                                             output[:, t])
@@ -0,0 +1,149 @@
+import torch
+
+from joeynmt.batch import Batch
+from joeynmt.data import load_data, make_data_iter
+from joeynmt.decoders import TransformerDecoder
+from joeynmt.encoders import TransformerEncoder
+from joeynmt.loss import WeightedCrossEntropy
+from joeynmt.model import build_model
+from joeynmt.prediction import validate_on_data
+from joeynmt.search import greedy, beam_search
+from .test_helpers import TensorTestCase
+
+
+class TestTransformer(TensorTestCase):
+
+    def setUp(self):
+        self.hidden_size = 12
+        self.vocab_size = 7
+        seed = 42
+        torch.manual_seed(seed)
+        self.encoder = TransformerEncoder(hidden_size=self.hidden_size,
+                                          ff_size=24, num_layers=2,
+                                          num_heads=3, dropout=0.,
+                                          emb_dropout=0.)
+        self.decoder = TransformerDecoder(hidden_size=self.hidden_size,
+                                          ff_size=24, num_layers=2,
+                                          num_heads=3, dropout=0.,
+                                          emb_dropout=0.,
+                                          vocab_size=self.vocab_size)
+
+    def test_transformer_encoder(self):
+        batch_size, src_len = 3, 5
+        embed_src = torch.rand(batch_size, src_len, self.hidden_size)
+        mask = torch.ones(batch_size, 1, src_len) > 0
+        mask[1, 0, 3:] = False
+        output, hidden = self.encoder(embed_src, torch.tensor([5, 3, 5]),
+                                      mask)
+        self.assertEqual(output.shape, (batch_size, src_len,
+                                        self.hidden_size))
+        self.assertIsNone(hidden)
+        # padding does not change the other positions
+        short_output, _ = self.encoder(embed_src[1:2, :3], torch.tensor([3]),
+                                       mask[1:2, :, :3])
+        self.assertTensorAlmostEqual(output[1, :3], short_output[0])
+
+    def test_transformer_decoder_step(self):
+        batch_size, src_len, trg_len = 3, 5, 4
+        encoder_output = torch.rand(batch_size, src_len, self.hidden_size)
+        mask = torch.ones(batch_size, 1, src_len) > 0
+        mask[0, 0, -2:] = False
+        trg_embed = torch.rand(batch_size, trg_len, self.hidden_size)
+        output, hidden, att_probs, att_vectors = self.decoder(
+            trg_embed, encoder_output=encoder_output, encoder_hidden=None,
+            src_mask=mask, unrol_steps=trg_len)
+        self.assertEqual(output.shape, (batch_size, trg_len,
+                                        self.vocab_size))
+        self.assertIsNone(hidden)
+        self.assertEqual(att_vectors.shape, (batch_size, trg_len,
+                                             self.hidden_size))
+        self.assertTensorAlmostEqual(att_probs.sum(2),
+                                     torch.ones(batch_size, trg_len))
+        self.assertTensorAlmostEqual(att_probs[0, :, -2:],
+                                     torch.zeros(trg_len, 2))
+
+        # step by step with cached self-attention gives the same results,
+        # also with several hypotheses per sentence and reordered rows
+        state = self.decoder.init_state(encoder_output=encoder_output,
+                                        encoder_hidden=None, src_mask=mask)
+        rows = torch.tensor([0, 0, 1, 1, 2, 2])
+        for i in range(trg_len):
+            step_output, state, step_att_probs = self.decoder.step(
+                trg_embed[rows, i].unsqueeze(1), state, check_shapes=True)
+            self.assertTensorAlmostEqual(output[rows, i],
+                                         step_output.squeeze(1))
+            self.assertTensorAlmostEqual(att_probs[rows, i],
+                                         step_att_probs.squeeze(1))
+            # swap the hypotheses of each sentence
+            state = state.select_hypotheses(torch.tensor([1, 0, 3, 2, 5, 4]))
+        reverse = torch.arange(2, -1, -1)
+        state = state.select_hypotheses(torch.tensor([5, 3, 1]),
+                                        sentence_index=reverse)
+        self.assertEqual(state.encoder_output[0].tolist(),
+                         encoder_output[2].tolist())
+        self.assertEqual(state.step, trg_len)
+
+
+class TestTransformerModel(TensorTestCase):
+
+    def setUp(self):
+        data_cfg = {"src": "de", "trg": "en", "train": "test/data/toy/train",
+                    "dev": "test/data/toy/dev", "level": "word",
+                    "lowercase": True, "max_sent_length": 10}
+        _, self.dev_data, _, src_vocab, trg_vocab = load_data(data_cfg)
+        torch.manual_seed(42)
+        layer_cfg = {"type": "transformer", "hidden_size": 8, "ff_size": 16,
+                     "num_layers": 2, "num_heads": 2,
+                     "embeddings": {"embedding_dim": 8, "scale": True}}
+        self.model_cfg = {"encoder": dict(layer_cfg),
+                          "decoder": dict(layer_cfg)}
+        self.model = build_model(self.model_cfg, src_vocab=src_vocab,
+                                 trg_vocab=trg_vocab)
+        self.vocabs = {"src_vocab": src_vocab, "trg_vocab": trg_vocab}
+
+    def testTraining(self):
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), self.model.pad_index)
+        loss = self.model.get_loss_for_batch(
+            batch, WeightedCrossEntropy(ignore_index=self.model.pad_index))
+        loss.backward()
+        self.assertTrue(all(p.grad is not None
+                            for p in self.model.decoder.parameters()))
+
+        # a model built from the same config loads the parameters
+        model = build_model(self.model_cfg, **self.vocabs)
+        model.load_state_dict(self.model.state_dict())
+
+    def testDecoding(self):
+        self.model.eval()
+        dev_iter = make_data_iter(self.dev_data, batch_size=6, train=False)
+        batch = Batch(next(iter(dev_iter)), self.model.pad_index)
+        batch.sort_by_src_lengths()
+        encoder_output, encoder_hidden = self.model.encode(
+            batch.src, batch.src_lengths, batch.src_mask)
+        kwargs = {"decoder": self.model.decoder,
+                  "embed": self.model.trg_embed,
+                  "bos_index": self.model.bos_index,
+                  "eos_index": self.model.eos_index,
+                  "encoder_output": encoder_output,
+                  "encoder_hidden": encoder_hidden,
+                  "src_mask": batch.src_mask, "max_output_length": 10}
+        with torch.no_grad():
+            greedy_output, _, _ = greedy(**kwargs)
+            output, attention, _ = beam_search(
+                size=1, alpha=-1, pad_index=self.model.pad_index, **kwargs)
+            self.assertEqual(
+                self.model.trg_vocab.arrays_to_sentences(output),
+                self.model.trg_vocab.arrays_to_sentences(greedy_output))
+            self.assertEqual(attention.shape[2], batch.src.size(1))
+            output, _, _ = beam_search(
+                size=3, alpha=1, pad_index=self.model.pad_index, n_best=2,
+                **kwargs)
+        self.assertEqual(output.shape[0], 2 * batch.nseqs)
+
+        # continuous batching falls back to batch by batch decoding
+        outputs = [validate_on_data(
+            self.model, data=self.dev_data, batch_size=4, use_cuda=False,
+            max_output_length=10, level="word", eval_metric="bleu",
+            num_slots=num_slots)[7] for num_slots in [0, 3]]
+        self.assertEqual(outputs[0], outputs[1])
@@ -1,6 +1,8 @@
 import unittest
 import os
 
+import numpy as np
+
 from joeynmt.vocabulary import Vocabulary
 
 
@@ -51,3 +53,30 @@ class TestVocabulary(unittest.TestCase):
         self.assertFalse(self.word_vocab.is_unk("Die"))
         self.assertTrue(self.char_vocab.is_unk("x"))
         self.assertFalse(self.char_vocab.is_unk("d"))
+
+    def testLookupDoesNotGrow(self):
+        size = len(self.word_vocab.stoi)
+        self.assertEqual(self.word_vocab.stoi["BLA"],
+                         self.word_vocab.stoi["<unk>"])
+        self.assertNotIn("BLA", self.word_vocab.stoi)
+        self.assertEqual(len(self.word_vocab.stoi), size)
+
+    def testDuplicateTokens(self):
+        vocab = Vocabulary(tokens=["a", "b", "a", "<unk>", "c"])
+        self.assertEqual(vocab.itos[4:], ["a", "b", "c"])
+        self.assertEqual([vocab.stoi[t] for t in vocab.itos],
+                         list(range(len(vocab))))
+
+    def testArraysToSentences(self):
+        eos = self.word_vocab.stoi["</s>"]
+        arrays = np.array([[4, 5, eos, 6, eos],
+                           [7, 8, 9, 10, 11],
+                           [eos, 4, 4, 4, 4]])
+        for cut_at_eos in [True, False]:
+            expected = [self.word_vocab.array_to_sentence(
+                array, cut_at_eos=cut_at_eos) for array in arrays]
+            self.assertEqual(self.word_vocab.arrays_to_sentences(
+                arrays, cut_at_eos=cut_at_eos), expected)
+        self.assertEqual(self.word_vocab.arrays_to_sentences(arrays)[0],
+                         ["Die", "Geschichte"])
+        self.assertEqual(self.word_vocab.arrays_to_sentences(arrays)[2], [])